@@ -0,0 +1,100 @@
+"""Bounded queue of Scality prefixes processed in background threads.
+Used by the prefetcher and the prefix statistics, both can be paused during transfers.
+"""
+import logging
+from abc import ABC, abstractmethod
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event, Lock
+
+
+class BackgroundQueue(ABC):
+    """ Last in first out queue of prefixes, the most recently shown folders are processed first.
+    Subclasses implement process. """
+
+    def __init__(self, max_workers: int, max_queue: int, thread_name_prefix: str):
+        """
+        Args:
+            max_workers : int
+                number of prefixes processed concurrently
+            max_queue : int
+                number of queued prefixes, the oldest are dropped first
+            thread_name_prefix : str
+                name of the worker threads
+        """
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.lock = Lock()
+        self.queue = deque()
+        # prefix: cancel Event
+        self.in_flight = {}
+        self.paused = False
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=thread_name_prefix)
+
+    def enqueue(self, items: list):
+        """ Queue items to process
+            Args:
+                items: list
+                    tuples starting with the prefix, they are passed to process
+        """
+        with self.lock:
+            # Keep the first item of a batch on top
+            for item in reversed(items):
+                if not self.skip(item[0]) and item[0] not in self.in_flight:
+                    self.queue.append(item)
+            while len(self.queue) > self.max_queue:
+                self.queue.popleft()
+        self._dispatch()
+
+    def skip(self, prefix: str) -> bool:
+        """ Return True if the prefix does not need to be processed, called with the lock held """
+        return False
+
+    def cancel(self, prefix: str):
+        """ Drop the queued items below a prefix and stop the ones in progress, the prefix itself is kept """
+        with self.lock:
+            self.queue = deque(item for item in self.queue if item[0] == prefix or not item[0].startswith(prefix))
+            for key, cancelled in self.in_flight.items():
+                if key != prefix and key.startswith(prefix):
+                    cancelled.set()
+
+    def pause(self):
+        """ Stop starting new items, e.g. during a transfer. Items in progress finish. """
+        with self.lock:
+            self.paused = True
+
+    def resume(self):
+        with self.lock:
+            self.paused = False
+        self._dispatch()
+
+    def _dispatch(self):
+        """ Start queued items up to the concurrency limit """
+        with self.lock:
+            while not self.paused and len(self.in_flight) < self.max_workers and len(self.queue) > 0:
+                item = self.queue.pop()
+                if self.skip(item[0]) or item[0] in self.in_flight:
+                    continue
+                cancelled = Event()
+                self.in_flight[item[0]] = cancelled
+                self.executor.submit(self._run, item, cancelled)
+
+    def _run(self, item: tuple, cancelled: Event):
+        """ Worker thread """
+        try:
+            self.process(item, cancelled)
+        except Exception as e:
+            logging.warning("Failed to process {} in the background: {}".format(item[0], e))
+        finally:
+            with self.lock:
+                self.in_flight.pop(item[0], None)
+            self._dispatch()
+
+    @abstractmethod
+    def process(self, item: tuple, cancelled: Event):
+        """ Process an item in a worker thread, stop when cancelled is set """
+
+    def shutdown(self):
+        with self.lock:
+            self.queue.clear()
+        self.executor.shutdown(wait=False, cancel_futures=True)
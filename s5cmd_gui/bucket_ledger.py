@@ -0,0 +1,171 @@
+"""Persistent ledger of the bucket usage.
+Seeded once by listing the whole bucket, then updated from the transfers and deletes done by this program
+and reconciled in the background. The free space check becomes a lookup instead of a full listing.
+"""
+import logging
+import sqlite3
+import time
+from datetime import timedelta
+from os import getenv
+from pathlib import Path
+from threading import Lock, Thread
+
+from utils import get_cachefolder
+
+# Seconds after which the ledger is reconciled with a full listing
+DEFAULT_RECONCILE_INTERVAL = 24 * 3600
+
+# Only one reconciliation per process
+_reconcile_lock = Lock()
+
+
+class BucketLedger:
+    """ Used bytes and number of objects of the bucket """
+
+    def __init__(self, s3, bucket_name: str, db_path: Path = None):
+        """
+        Args:
+            s3 : boto3 S3 client
+                used for the full listings
+            bucket_name : str
+                name of the bucket
+            db_path : Path
+                SQLite database, defaults to bucket_ledger.sqlite in the cache folder
+        """
+        self.s3 = s3
+        self.bucket_name = bucket_name
+        self.endpoint_url = getenv('ENDPOINT') or ''
+        self.reconcile_interval = int(getenv('LEDGER_RECONCILE_INTERVAL', DEFAULT_RECONCILE_INTERVAL))
+        if db_path is None:
+            db_path = get_cachefolder().joinpath('bucket_ledger.sqlite')
+        self.lock = Lock()
+        self.db = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("""CREATE TABLE IF NOT EXISTS ledger (
+                endpoint TEXT, bucket TEXT, used_bytes INTEGER, objects INTEGER, reconciled_at REAL,
+                stale INTEGER DEFAULT 0, PRIMARY KEY (endpoint, bucket))""")
+            # Ledgers created before the stale flag
+            if 'stale' not in [column[1] for column in self.db.execute("PRAGMA table_info(ledger)")]:
+                self.db.execute("ALTER TABLE ledger ADD COLUMN stale INTEGER DEFAULT 0")
+            # Changes are kept to replay those made during a reconciliation
+            self.db.execute("""CREATE TABLE IF NOT EXISTS changes (
+                endpoint TEXT, bucket TEXT, bytes INTEGER, objects INTEGER, changed_at REAL)""")
+
+    def usage(self):
+        """ Return:
+                None if the ledger is not seeded, otherwise:
+                (objects, used_bytes, age, stale)
+                age is the number of seconds since the last reconciliation,
+                stale is True if a transfer with an unknown effect ran since, see mark_stale
+        """
+        with self.lock:
+            result = self.db.execute(
+                "SELECT objects, used_bytes, reconciled_at, stale FROM ledger WHERE endpoint=? AND bucket=?",
+                (self.endpoint_url, self.bucket_name)).fetchone()
+        if result is None:
+            return None
+        objects, used_bytes, reconciled_at, stale = result
+        return objects, used_bytes, time.time() - reconciled_at, bool(stale)
+
+    def staleness(self) -> str:
+        """ Describe how old the ledger is, for the logs and UI """
+        usage = self.usage()
+        if usage is None:
+            return "Bucket ledger not seeded yet"
+        age = timedelta(seconds=int(usage[2]))
+        stale = ", outdated by an interrupted transfer" if usage[3] else ""
+        return f"Bucket usage from ledger: {usage[0]} objects, last reconciled {age} ago{stale}"
+
+    def needs_reconcile(self) -> bool:
+        usage = self.usage()
+        return usage is None or usage[3] or usage[2] > self.reconcile_interval
+
+    def record_change(self, size: int, objects: int):
+        """ Apply an upload (positive) or delete (negative) to the ledger
+            Args:
+                size: int
+                    bytes added or removed
+                objects: int
+                    objects added or removed
+        """
+        try:
+            with self.lock, self.db:
+                self.db.execute("UPDATE ledger SET used_bytes=max(used_bytes + ?, 0), objects=max(objects + ?, 0) "
+                                "WHERE endpoint=? AND bucket=?",
+                                (size, objects, self.endpoint_url, self.bucket_name))
+                self.db.execute("INSERT INTO changes VALUES (?, ?, ?, ?, ?)",
+                                (self.endpoint_url, self.bucket_name, size, objects, time.time()))
+        except sqlite3.Error as e:
+            logging.warning("Failed to update bucket ledger: {}".format(e))
+
+    def mark_stale(self):
+        """ The effect of a transfer is unknown (e.g. it failed halfway), reconcile at the next chance """
+        try:
+            with self.lock, self.db:
+                self.db.execute("UPDATE ledger SET stale=1 WHERE endpoint=? AND bucket=?",
+                                (self.endpoint_url, self.bucket_name))
+        except sqlite3.Error as e:
+            logging.warning("Failed to mark the bucket ledger stale: {}".format(e))
+
+    def reconcile(self):
+        """ List the whole bucket and store the totals, changes made during the listing are replayed.
+            Return:
+                (objects, used_bytes)
+        """
+        with _reconcile_lock:
+            return self._reconcile()
+
+    def _reconcile(self):
+        """ Reconcile, the caller holds the reconcile lock """
+        started_at = time.time()
+        logging.info("Reconciling bucket ledger of {}".format(self.bucket_name))
+        used_bytes = 0
+        objects = 0
+        paginator = self.s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket_name):
+            contents = page.get('Contents', [])
+            used_bytes += sum(obj['Size'] for obj in contents)
+            objects += len(contents)
+        with self.lock, self.db:
+            changed_bytes, changed_objects = self.db.execute(
+                "SELECT coalesce(sum(bytes), 0), coalesce(sum(objects), 0) FROM changes "
+                "WHERE endpoint=? AND bucket=? AND changed_at>=?",
+                (self.endpoint_url, self.bucket_name, started_at)).fetchone()
+            used_bytes = max(used_bytes + changed_bytes, 0)
+            objects = max(objects + changed_objects, 0)
+            self.db.execute("INSERT OR REPLACE INTO ledger "
+                            "(endpoint, bucket, used_bytes, objects, reconciled_at, stale) VALUES (?, ?, ?, ?, ?, 0)",
+                            (self.endpoint_url, self.bucket_name, used_bytes, objects, started_at))
+            self.db.execute("DELETE FROM changes WHERE endpoint=? AND bucket=? AND changed_at<?",
+                            (self.endpoint_url, self.bucket_name, started_at))
+        logging.info("Bucket ledger reconciled: {} objects, {} bytes, took {}".format(
+            objects, used_bytes, timedelta(seconds=int(time.time() - started_at))))
+        return objects, used_bytes
+
+    def reconcile_in_background(self):
+        """ Reconcile in a daemon thread if the ledger is stale and no reconciliation is running """
+        if not self.needs_reconcile() or _reconcile_lock.locked():
+            return
+        Thread(target=self._reconcile_quietly, name='bucket_ledger', daemon=True).start()
+
+    def _reconcile_quietly(self):
+        try:
+            with _reconcile_lock:
+                # Another thread may have reconciled in the meantime
+                if self.needs_reconcile():
+                    self._reconcile()
+        except Exception as e:
+            logging.warning("Failed to reconcile bucket ledger of {}: {}".format(self.bucket_name, e))
+
+    def get_usage(self):
+        """ Return the usage, the ledger is seeded by a full listing if needed
+            Return:
+                (objects, used_bytes)
+        """
+        usage = self.usage()
+        if usage is None:
+            return self.reconcile()
+        if usage[3] or usage[2] > self.reconcile_interval:
+            self.reconcile_in_background()
+        return usage[0], usage[1]
@@ -0,0 +1,64 @@
+"""Datadelete class"""
+import logging
+from datetime import datetime
+from pathlib import Path
+from PySide6.QtCore import QObject, Signal
+
+from data_operation import DataOperation
+from path import ScalityPath
+
+
+class DataDelete(QObject):
+    """ Deletes data in a background thread, called from the main UI
+    See run for the flow """
+    finished = Signal(bool)
+    progress = Signal(str)
+
+    def __init__(self, stop_worker, data_operations: DataOperation = None):
+        super().__init__()
+        self.stop_worker = stop_worker
+        self.data_operations = data_operations if data_operations is not None else DataOperation()
+
+    def progress_and_logg(self, msg: str):
+        """ Emit message as progress update to the UI and log it
+            Args:
+                msg : str
+                    Message to be emitted
+        """
+        self.progress.emit(msg)
+        logging.info(msg)
+
+    def set_params(self, target: Path | ScalityPath):
+        """ Set the parameters for the deletion
+            Args:
+                target : Path | ScalityPath
+                    local or scality folder to delete
+        """
+        self.target = target
+
+    def run(self):
+        """ Main function of the background thread """
+        self.delete(self.target)
+
+    def delete(self, target: Path | ScalityPath):
+        """ Delete the data and report the progress
+            Args:
+                target : Path | ScalityPath
+                    local or scality folder to delete
+        """
+        start_time = datetime.now()
+        self.progress_and_logg(f"starting deletion of {target}")
+        if isinstance(target, Path):
+            deleted, errors = self.data_operations.delete_local_data(target, self.progress_and_logg, self.stop_worker)
+            unit = 'files'
+        else:
+            deleted, errors = self.data_operations.delete_bucket_data(target, self.progress_and_logg,
+                                                                      self.stop_worker)
+            unit = 'objects'
+        for error in errors[:10]:
+            self.progress_and_logg(f"Failed to delete {error}")
+        if len(errors) > 10:
+            self.progress_and_logg(f"... and {len(errors) - 10} more failures, see the log")
+        self.progress_and_logg(f"{target}: deleted {deleted} {unit} with {len(errors)} failures, "
+                               f"it took: {datetime.now() - start_time}")
+        self.finished.emit(len(errors) == 0)
@@ -1,18 +1,20 @@
-import boto3
 import logging
 import re
 from psutil import disk_usage
-from datetime import datetime
-from shutil import rmtree
-from os import getenv, path
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime, timedelta
+from queue import Queue
+from threading import Event, Lock
+from os import getenv, path, rmdir, scandir, unlink
 from pathlib import Path
 from path import ScalityPath
-import platform
-if platform.system() == "Windows":
-    import win32com.client as com
-    import pythoncom
-else:
-    raise EnvironmentError("This script can only be run on Windows.")
+from listing_cache import ListingCache
+from bucket_ledger import BucketLedger
+from transfer_history import TransferHistory
+from utils import size_fmt
+from s3_client import bucket_exists, get_s3_client
+from local_scan import ScanCache, ScanResult, list_files, scan_path
+from existence_check import ExistenceChecker
 
 
 class DataOperation():
@@ -22,20 +24,23 @@ class DataOperation():
         self.endpoint_url = getenv('ENDPOINT')
         self.aws_profile = getenv('AWS_PROFILE')
         self.processed_files = []
+        self.listing_cache = ListingCache()
+        self.scan_cache = ScanCache() if getenv('LOCAL_SCAN_CACHE', 'Y').upper() == 'Y' else None
         try:
-            session = boto3.Session(profile_name=self.aws_profile)
-            self.s3 = session.client('s3', endpoint_url=self.endpoint_url)
+            self.s3 = get_s3_client(self.aws_profile, self.endpoint_url)
         except Exception as e:
             msg = "Could not open session: {}".format(e)
             logging.error(msg)
             exit(1)
+        self.bucket_ledger = BucketLedger(self.s3, self.bucket_name)
+        self.transfer_history = TransferHistory()
 
         if not self.check_bucket(self.bucket_name):
             msg = "Could not find bucket: {}".format(self.bucket_name)
             logging.error(msg)
 
     def check_bucket(self, bucket_name: str):
-        """Check if the bucket exists
+        """Check if the bucket exists, the result is cached for the process
             Args:
                 bucket_name: str
                     name of the bucket
@@ -43,11 +48,7 @@ class DataOperation():
                 boolean
                     True is the bucket exists, False if not
         """
-        response = self.s3.list_buckets()
-        for bucket in response['Buckets']:
-            if bucket['Name'] == bucket_name:
-                return True
-        return False
+        return bucket_exists(bucket_name, self.aws_profile, self.endpoint_url)
 
     # def check_local_folder_exists(self, source_folder: str):
     #     """Check if the folder exists on the local disk
@@ -70,10 +71,30 @@ class DataOperation():
                     Trur if the folder exists, False otherwise
         """
         try:
-            response = self.s3.list_objects_v2(Bucket=self.bucket_name, Prefix=scality_path)
+            return ExistenceChecker(self.s3, self.bucket_name).prefix_exists(str(scality_path))
         except Exception as e:
             logging.warning("Error in checking for {} in bucket {}: {}".format(scality_path, self.bucket_name, e))
-        return 'Contents' in response
+        return False
+
+    def find_upload_collisions(self, source_path: Path, destination_path: ScalityPath):
+        """Find the objects an upload would overwrite
+            Args:
+                source_path: Path
+                    local file or folder to upload
+                destination_path: ScalityPath
+                    scality folder the source is uploaded into
+            Return:
+                list
+                    keys of the existing objects that would be overwritten
+        """
+        destination = str(destination_path.joinpath(source_path.name))
+        if source_path.is_file():
+            keys = [destination]
+            common_prefix = destination
+        else:
+            keys = [destination + '/' + file for file in list_files(source_path)]
+            common_prefix = destination + '/'
+        return ExistenceChecker(self.s3, self.bucket_name).existing_keys(keys, common_prefix)
 
     def get_local_freespace(self, data_path: Path):
         """Retreive the free space on the local disk
@@ -86,8 +107,22 @@ class DataOperation():
         usage = disk_usage(data_path.drive + f'{path.sep}')
         return usage.free
 
+    def get_local_usedspace(self, data_path: Path):
+        """Retreive the used space of the filesystem that holds a file or folder, an upper bound of what can be
+            uploaded from it
+            Args:
+                path: Path
+            Return:
+                used_space: int
+                    number of bytes used on the filesystem
+        """
+        usage = disk_usage(str(data_path if data_path.is_dir() else data_path.parent))
+        return usage.used
+
     def get_bucket_freespace(self, foldername: str = ''):
         """Retreive the free space in the bucket
+            Without foldername the usage of the whole bucket is taken from the bucket ledger,
+            the ledger is seeded by listing the bucket the first time.
             Args:
                 foldername: str
                     name of the folder in the bucket
@@ -103,16 +138,41 @@ class DataOperation():
         total_size = 0
         num_files = 0
         try:
-            paginator = self.s3.get_paginator('list_objects_v2')
-            # Iterate over all objects in the bucket
-            for page in paginator.paginate(Bucket=self.bucket_name, Prefix=foldername):
-                total_size += sum(obj['Size'] for obj in page.get('Contents', []))
-                num_files += len(page.get('Contents', []))
+            if foldername == '':
+                num_files, total_size = self.bucket_ledger.get_usage()
+                logging.info(self.bucket_ledger.staleness())
+            else:
+                paginator = self.s3.get_paginator('list_objects_v2')
+                # Iterate over all objects in the folder
+                for page in paginator.paginate(Bucket=self.bucket_name, Prefix=foldername):
+                    total_size += sum(obj['Size'] for obj in page.get('Contents', []))
+                    num_files += len(page.get('Contents', []))
             bucket_free_size = self.parse_size(self.bucket_size) - total_size
         except Exception as e:
             logging.warning("Failed to compute free space for bucket {}: {}".format(self.bucket_name, e))
         return (num_files, total_size, bucket_free_size)
 
+    def scan_bucket_data(self, foldername: str, callback=None) -> ScanResult:
+        """Count the objects in a folder, their size and size histogram with one listing
+            Args:
+                foldername: str
+                    name of the folder in the bucket
+                callback: callable
+                    called with the running totals after every page, optional
+            Return:
+                ScanResult
+        """
+        scan = ScanResult()
+        paginator = self.s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=foldername):
+            for obj in page.get('Contents', []):
+                scan.add_file(obj['Size'])
+            if callback is not None:
+                callback(scan)
+        logging.info("{}: {} objects, {}".format(foldername, scan.num_files, size_fmt(scan.total_size)))
+        logging.info("Object size histogram: {}".format(scan.histogram_summary()))
+        return scan
+
     def get_local_datasize(self, local_path: Path):
         """Get the size of a file or folder on the local disk
             Args:
@@ -124,13 +184,11 @@ class DataOperation():
                 size: int
                     size of the file or folder in bytes
         """
-        if local_path.is_file():
-            return (1, local_path.stat().st_size)
-        else:
-            return self.get_local_foldersize(local_path)
+        scan = self.scan_local_data(local_path)
+        return (scan.num_files, scan.total_size)
 
     def get_local_foldersize(self, local_path: Path):
-        """ os.walk and pathlib take quite some time, on Windows the com object provides a fast alternative
+        """ Size of a folder, see scan_local_data
             Args:
                 local_path: Path
                     complete path to the folder on the local disk
@@ -140,22 +198,25 @@ class DataOperation():
                 foldersize: int
                     size of the folder on disk
         """
+        return self.get_local_datasize(local_path)
+
+    def scan_local_data(self, local_path: Path, callback=None) -> ScanResult:
+        """ Count the files, their size and size histogram in a single parallel scandir pass,
+            directories that did not change since the previous scan are taken from the scan cache.
+            Args:
+                local_path: Path
+                    path to the file or folder on the local disk
+            Return:
+                ScanResult
+        """
         logging.info("Calculating size of: {}".format(local_path))
-        if platform.system() == "Windows":
-            # Enable com usage from threads
-            pythoncom.CoInitialize()
-            fso = com.Dispatch("Scripting.FileSystemObject")
-            folder = fso.GetFolder(local_path)
-            size = folder.Size
-            num_files = sum(1 for _ in local_path.glob('**/*') if _.is_file())
-        else:
-            num_files = 0
-            size = 0
-            for f in local_path.glob('**/*'):
-                if f.is_file():
-                    num_files += 1
-                    size += f.stat().st_size
-        return (num_files, size)
+        start_time = datetime.now()
+        scan = scan_path(local_path, scan_cache=self.scan_cache, callback=callback)
+        logging.info("{}: {} files, {}, took {}, {} directories read and {} from the scan cache".format(
+            local_path, scan.num_files, size_fmt(scan.total_size), datetime.now() - start_time,
+            scan.dirs_scanned, scan.dirs_cached))
+        logging.info("File size histogram: {}".format(scan.histogram_summary()))
+        return scan
 
     def parse_size(self, size: str):
         """ The units are added added with the value, this function converts it to bytes
@@ -181,52 +242,204 @@ class DataOperation():
                 str
                     size unit
         """
-        for unit in ("", "KB", "MB", "GB", "TB", "PB"):
-            if abs(num) < 2**10:
-                return f"{num:3.1f} {unit}"
-            num /= 2**10
-        return "Not implemented"
+        return size_fmt(num)
 
-    def delete_local_data(self, local_path: Path):
+    def delete_local_data(self, local_path: Path, progress=None, stop_worker: Event = None):
         """ Remove data in folder
+            LOCAL_DELETE_WORKERS threads read the directories and unlink their files in chunks,
+            the directories are removed bottom-up afterwards.
             Args:
                 local_path: Path
                     path to the files on the local file system
+                progress: callable
+                    called with a status message about once per second, optional
+                stop_worker: Event
+                    stops the deletion when set, optional
             Return:
-                -
+                deleted_files: int
+                    number of deleted files
+                errors: list
+                    "path: message" of the files and directories that could not be removed
         """
         logging.info("Removing: {}".format(local_path))
-        if local_path.is_file():
-            local_path.unlink()
-        elif local_path.is_dir():
-            rmtree(local_path)
+        if not local_path.is_dir() or local_path.is_symlink():
+            try:
+                local_path.unlink()
+            except OSError as e:
+                return 0, [f"{local_path}: {e}"]
+            return 1, []
+        num_workers = int(getenv('LOCAL_DELETE_WORKERS', 16))
+        chunk_size = 256
+        lock = Lock()
+        status = {'deleted': 0}
+        errors = []
+        directories = []
+        start_time = last_report_time = datetime.now()
+
+        def report(force: bool = False):
+            nonlocal last_report_time
+            current_time = datetime.now()
+            if progress is None or (not force and current_time - last_report_time < timedelta(seconds=1)):
+                return
+            last_report_time = current_time
+            rate = status['deleted'] / max((current_time - start_time).total_seconds(), 1e-3)
+            progress(f"deleted {status['deleted']} files, {rate:.0f} files/s")
+
+        def unlink_files(files: list):
+            deleted = 0
+            for file in files:
+                if stop_worker is not None and stop_worker.is_set():
+                    break
+                try:
+                    unlink(file)
+                    deleted += 1
+                except OSError as e:
+                    with lock:
+                        errors.append(f"{file}: {e}")
+            with lock:
+                status['deleted'] += deleted
+            return []
+
+        def read_directory(directory: str):
+            """ Return the unlink chunks and subdirectories of a directory as new tasks """
+            files = []
+            subdirectories = []
+            try:
+                with scandir(directory) as entries:
+                    for entry in entries:
+                        # Symlinks to directories are unlinked, not followed
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirectories.append(entry.path)
+                        else:
+                            files.append(entry.path)
+            except OSError as e:
+                with lock:
+                    errors.append(f"{directory}: {e}")
+            with lock:
+                directories.append(directory)
+            tasks = [(unlink_files, files[i:i + chunk_size]) for i in range(0, len(files), chunk_size)]
+            return tasks + [(read_directory, subdirectory) for subdirectory in subdirectories]
 
-    def delete_bucket_data(self, prefix: ScalityPath = '*'):
+        with ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix='delete_local_data') as executor:
+            pending = {executor.submit(read_directory, str(local_path))}
+            while pending:
+                done, pending = wait(pending, timeout=1, return_when=FIRST_COMPLETED)
+                for future in done:
+                    if stop_worker is not None and stop_worker.is_set():
+                        continue
+                    pending.update(executor.submit(task, argument) for task, argument in future.result())
+                report()
+        if stop_worker is None or not stop_worker.is_set():
+            # Children have more path separators than their parents
+            for directory in sorted(directories, key=lambda directory: directory.count(path.sep), reverse=True):
+                try:
+                    rmdir(directory)
+                except OSError as e:
+                    errors.append(f"{directory}: {e}")
+        report(force=True)
+
+        for error in errors:
+            logging.warning(f"Failed to delete: {error}")
+        if len(errors) == 0:
+            logging.info(f"{local_path} deleted, took {datetime.now() - start_time}.")
+        return status['deleted'], errors
+
+    def delete_bucket_data(self, prefix: ScalityPath = '*', progress=None, stop_worker: Event = None):
         """Deleting all the objects in the bucket with the specified prefix: foldername
+            A lister produces batches of up to 1000 keys into a bounded queue,
+            DELETE_WORKERS threads drain it with delete_objects.
             Args:
                 prefix: str
                     path to the files in the bucket
+                progress: callable
+                    called with a status message about once per second, optional
+                stop_worker: Event
+                    stops the deletion when set, optional
             Return:
-                -
+                deleted_objects: int
+                    number of deleted objects
+                errors: list
+                    "key: message" of the objects or batches that failed
         """
-        try:
-            while True:
-                # List objects in batches of 1000
-                response = self.s3.list_objects_v2(Bucket=self.bucket_name, Prefix=str(prefix) + '/')
-                if 'Contents' not in response:
-                    break  # Exit if the bucket is empty
-
-                # Delete the objects in a batch
-                delete_keys = {'Objects': [{'Key': obj['Key']} for obj in response['Contents']]}
-                self.s3.delete_objects(Bucket=self.bucket_name, Delete=delete_keys)
-
-                # Handle pagination if the bucket is very large
-                if not response.get('IsTruncated', False):
-                    break
+        prefix = str(prefix) + '/'
+        num_workers = int(getenv('DELETE_WORKERS', 8))
+        batches = Queue(maxsize=2 * num_workers)
+        lock = Lock()
+        status = {'listed': 0, 'deleted': 0, 'deleted_size': 0, 'listing_done': False}
+        errors = []
+        # The total is known if the folder was counted in the Scality tree
+        cached_stats = self.listing_cache.get_stats(prefix)
+        total = cached_stats[1] if cached_stats is not None else None
+        start_time = last_report_time = datetime.now()
 
-            logging.info(f"All objects with prefix '{prefix}' deleted from bucket.")
-        except Exception as e:
-            logging.warning(f"Failed to delete objects with prefix '{prefix}': {e}")
+        def report(force: bool = False):
+            nonlocal last_report_time
+            current_time = datetime.now()
+            if progress is None or (not force and current_time - last_report_time < timedelta(seconds=1)):
+                return
+            last_report_time = current_time
+            rate = status['deleted'] / max((current_time - start_time).total_seconds(), 1e-3)
+            if status['listing_done'] or total is None:
+                remaining = f"{status['listed'] - status['deleted']}{'' if status['listing_done'] else '+'}"
+            else:
+                remaining = f"~{max(total - status['deleted'], 0)}"
+            progress(f"deleted {status['deleted']} objects, {rate:.0f} keys/s, remaining {remaining}")
+
+        def lister():
+            try:
+                paginator = self.s3.get_paginator('list_objects_v2')
+                # The paginator follows NextContinuationToken instead of listing from the start again
+                for page in paginator.paginate(Bucket=self.bucket_name, Prefix=prefix,
+                                               PaginationConfig={'PageSize': 1000}):
+                    if stop_worker is not None and stop_worker.is_set():
+                        break
+                    contents = page.get('Contents', [])
+                    if len(contents) == 0:
+                        continue
+                    with lock:
+                        status['listed'] += len(contents)
+                    batches.put([(obj['Key'], obj['Size']) for obj in contents])
+            except Exception as e:
+                with lock:
+                    errors.append(f"{prefix}: listing failed: {e}")
+            finally:
+                with lock:
+                    status['listing_done'] = True
+                for _ in range(num_workers):
+                    batches.put(None)
+
+        def deleter():
+            while (batch := batches.get()) is not None:
+                sizes = dict(batch)
+                try:
+                    result = self.s3.delete_objects(Bucket=self.bucket_name,
+                                                    Delete={'Objects': [{'Key': key} for key in sizes]})
+                except Exception as e:
+                    with lock:
+                        errors.append(f"{batch[0][0]} .. {batch[-1][0]}: batch of {len(batch)} failed: {e}")
+                    continue
+                with lock:
+                    for deleted in result.get('Deleted', []):
+                        status['deleted'] += 1
+                        status['deleted_size'] += sizes.get(deleted['Key'], 0)
+                    for error in result.get('Errors', []):
+                        errors.append(f"{error.get('Key')}: {error.get('Code')} {error.get('Message')}")
+                    report()
+
+        logging.info("Deleting objects with prefix '{}' using {} workers".format(prefix, num_workers))
+        with ThreadPoolExecutor(max_workers=num_workers + 1, thread_name_prefix='delete_bucket_data') as executor:
+            executor.submit(lister)
+            for _ in range(num_workers):
+                executor.submit(deleter)
+        report(force=True)
+
+        for error in errors:
+            logging.warning(f"Failed to delete: {error}")
+        if len(errors) == 0:
+            logging.info(f"All objects with prefix '{prefix}' deleted from bucket, took {datetime.now() - start_time}.")
+        self.listing_cache.invalidate(prefix)
+        self.bucket_ledger.record_change(-status['deleted_size'], -status['deleted'])
+        return status['deleted'], errors
 
 
 if __name__ == "__main__":
@@ -1,13 +1,27 @@
 """Datatransfer class"""
 import logging
+import shutil
+from concurrent.futures import Future, ThreadPoolExecutor, wait
 from datetime import datetime, timedelta
-from os import getenv, path
+from os import getenv, path, stat
 from pathlib import Path
+from tempfile import mkdtemp
 from PySide6.QtCore import QObject, Signal
 
 from data_operation import DataOperation
 from s5cmd_runner import S5CmdRunner
+from s3_client import stats_summary
+from transfer_progress import TransferProgress
+from transfer_journal import TransferJournal
+from sync_plan import plan_sync
+from transfer_tuning import TransferSettings, describe, split_threshold, tune
+from local_scan import ScanResult, list_files
 from path import ScalityPath
+from transfer_verify import VerifyResult, etag_matches, verify_transfer
+from source_reclaimer import SourceReclaimer
+from shard_pack import PACK_DIR, extract_members, fetch_members, fetch_whole_shard, find_index, pack_folder, \
+    resized_members, select_members
+from utils import get_cachefolder
 
 
 class DataTransfer(QObject):
@@ -16,22 +30,30 @@ class DataTransfer(QObject):
     process = None
     finished = Signal(bool)
     progress = Signal(str)
+    # TransferProgress snapshots for the progress bar
+    transfer_progress = Signal(object)
 
-    def __init__(self, stop_worker):
+    def __init__(self, stop_worker, data_operations: DataOperation = None):
         super().__init__()
         self.stop_worker = stop_worker
-        self.data_operations = DataOperation()
+        self.data_operations = data_operations if data_operations is not None else DataOperation()
         self.s5cmd = S5CmdRunner()
+        self.numworkers = None
+        self.sync = False
+        self.dry_run = False
+        self.pack = False
+        self.verify = getenv('VERIFY_TRANSFERS', 'N').upper() == 'Y'
+        # Part sizes in MB of the copies of the current transfer, to verify the multipart ETags
+        self.part_sizes = []
 
     def _error(self, msg: str):
-        """ Emit signals and take actions in case of an error
+        """ Report an error, finished is emitted once by run when the transfer stopped
             Args:
                 msg : str
                     Error message
         """
         self.progress.emit(msg)
         logging.info(msg)
-        self.finished.emit(False)
 
     def progress_and_logg(self, msg: str):
         """ Emit message as progress update to the UI and log it
@@ -42,7 +64,8 @@ class DataTransfer(QObject):
         self.progress.emit(msg)
         logging.info(msg)
 
-    def set_params(self, updown: str, local_path: Path, scality_path: ScalityPath, delete_source: bool = False):
+    def set_params(self, updown: str, local_path: Path, scality_path: ScalityPath, delete_source: bool = False,
+                   numworkers: int = None, sync: bool = False, dry_run: bool = False, pack: bool = False):
         """ Set the parameters for the transfer
             Args:
                 updown : str
@@ -53,24 +76,52 @@ class DataTransfer(QObject):
                     scality path to the file or folder
                 delete_source : bool
                     delete the source after transfer
+                numworkers : int
+                    s5cmd --numworkers of this transfer, defaults to AWS_WORKERS
+                sync : bool
+                    only copy the files that are new or changed, see sync_plan
+                dry_run : bool
+                    only report what would be copied
+                pack : bool
+                    upload the small files in tar shards, see shard_pack
         """
+        self.numworkers = numworkers
+        self.sync = sync
+        self.dry_run = dry_run
+        self.pack = pack
         self.updown = updown
-        if updown == 'upload':
-            self.source_path = local_path
-            self.destination_path = scality_path
-        else:
-            self.source_path = scality_path
-            self.destination_path = local_path
+        self.items = []
+        self.add_item(local_path, scality_path)
         self.delete_source = delete_source
 
+    def add_item(self, local_path: Path, scality_path: ScalityPath):
+        """ Add another file or folder to the transfer, all items are copied by one s5cmd process
+            Args:
+                local_path : Path
+                    local path to the file or folder
+                scality_path : ScalityPath
+                    scality path to the file or folder
+        """
+        if self.updown == 'upload':
+            self.items.append((local_path, scality_path))
+        else:
+            self.items.append((scality_path, local_path))
+
     def run(self):
-        """ Main function of the background thread """
-        self.transfer(self.updown, self.source_path, self.destination_path, self.delete_source)
+        """ Main function of the background thread, finished is emitted once, also when the transfer fails """
+        success = False
+        try:
+            success = self.transfer_batch(self.updown, self.items, self.delete_source)
+        except Exception as e:
+            logging.exception("Transfer failed")
+            self._error(f'Transfer failed: {e}')
+        finally:
+            self.finished.emit(success)
 
     def transfer(self, updown: str, source_path: Path | ScalityPath,
                  destination_path: Path | ScalityPath,
                  delete_source: bool = False):
-        """ Main function of the background thread
+        """ Transfer a single file or folder
             Args:
                 updown : str
                     upload or download
@@ -80,49 +131,612 @@ class DataTransfer(QObject):
                     local path or scality path to the file or folder
                 delete_source : bool
                     delete the source after transfer
+            Return:
+                True if the transfer succeeded
+        """
+        return self.transfer_batch(updown, [(source_path, destination_path)], delete_source)
+
+    def transfer_batch(self, updown: str, items: list, delete_source: bool = False) -> bool:
+        """ Main function of the background thread, the checks run once for all items
+            Args:
+                updown : str
+                    upload or download
+                items : list
+                    (source_path, destination_path) of the files or folders, see transfer
+                delete_source : bool
+                    delete the sources after transfer
+            Return:
+                True if the transfer succeeded, the errors are reported with progress
         """
         self.progress_and_logg('connecting')
         # self.progress.emit('connecting')
+        self.part_sizes = []
         if not self.data_operations.check_bucket(getenv('BUCKETNAME')):
             self._error('specified bucket not found')
-            return
+            return False
+
+        plan = None
+        packed_upload = updown == 'upload' and self.pack
+        if self.sync and packed_upload:
+            self.progress_and_logg('Packed uploads copy all files, sync is not used')
+        if (self.sync and not packed_upload) or self.dry_run:
+            self.progress_and_logg('Comparing with the destination')
+            try:
+                plan = plan_sync(self.data_operations, updown, items)
+            except Exception as e:
+                self._error(f'Could not compare with the destination: {e}')
+                return False
+            for line in plan.report():
+                self.progress_and_logg(line)
+            if self.dry_run:
+                self.progress_and_logg('Dry run, nothing copied')
+                return True
+
+        if updown not in ('upload', 'download'):
+            self._error(f'Unknown transfer direction {updown}')
+            return False
 
         self.progress_and_logg('Checking free space')
+        # The checks run concurrently, the copy starts before the scan finished when the space surely suffices
+        progress = TransferProgress()
+        executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='precheck')
+        try:
+            if plan is not None:
+                scan_future = Future()
+                scan_future.set_result(plan.scan)
+                required = plan.bytes_per_destination
+                progress.grow_totals(plan.files_to_copy, plan.bytes_to_copy, final=True)
+            else:
+                # Bytes required per local destination folder of a download
+                required = {}
+                scan_future = executor.submit(self.scan_sources, updown, items, progress, required)
+            if updown == 'upload':
+                space_future = executor.submit(self.data_operations.get_bucket_freespace)
+            else:
+                space_future = executor.submit(lambda: dict(
+                    (destination_path, self.data_operations.get_local_freespace(destination_path))
+                    for _, destination_path in items))
+            # Only a warning, overwriting the changed files is the point of a sync
+            collisions_future = None
+            if updown == 'upload' and plan is None and not packed_upload:
+                collisions_future = executor.submit(self.warn_all_collisions, items)
+
+            # Start with the exact totals, and tuned, when the scan is quick, e.g. from the scan cache
+            wait([scan_future], timeout=float(getenv('PRECHECK_WAIT', 2)))
+            try:
+                if not scan_future.done() and not packed_upload and \
+                        self.space_bound_fits(updown, items, space_future):
+                    self.progress_and_logg('Free space suffices for any size, starting while the scan continues')
+                    scan = None
+                    self.check_space_after_scan(updown, scan_future, required, space_future)
+                else:
+                    scan = scan_future.result()
+                    if not self.space_fits(updown, scan, required, space_future):
+                        return False
+            except Exception as e:
+                self._error(f'Could not check the free space: {e}')
+                return False
+
+            if scan is not None:
+                self.predict_duration(updown, scan)
+            self.progress_and_logg('Passed free space check, creating copy paths')
+            journal = TransferJournal(updown, items, self.sync, packed_upload)
+            if plan is not None:
+                # The plan left out the files copied before
+                copies = plan.copies
+                skipped_files = skipped_bytes = 0
+            elif journal.has_completed():
+                copies, skipped_files, skipped_bytes = self.resume_copies(updown, items, journal)
+            else:
+                copies = [self.prep_foldernames(updown, source_path, destination_path)
+                          for source_path, destination_path in items]
+                skipped_files = skipped_bytes = 0
+            progress.add_skipped(skipped_files, skipped_bytes)
+            resumed = skipped_files > 0
+            # A move deletes each source as soon as s5cmd copied it, the shards of a packed upload are no sources
+            reclaimer = None
+            if delete_source and not packed_upload and getenv('STREAMING_DELETE', 'Y').upper() == 'Y':
+                reclaimer = SourceReclaimer(self.data_operations, updown, part_sizes=self.part_sizes)
+            if collisions_future is not None:
+                # The overwrite warning comes before the copy, a slow check does not hold it up
+                wait([collisions_future], timeout=float(getenv('PRECHECK_WAIT', 2)))
+                if not collisions_future.done():
+                    self.progress_and_logg('Still checking for existing objects, starting the copy')
+            if packed_upload:
+                # The shards are removed after the upload, so they are verified right away
+                copy_status, files_to_copy, bytes_to_copy = self.packed_upload(items, self.verify or delete_source)
+            elif updown == 'upload':
+                copy_status = self.tuned_copy(updown, items, copies, scan, plan, journal, progress, resumed,
+                                              reclaimer)
+                # The scan finished long before a transfer of the same data
+                try:
+                    scan = scan_future.result()
+                    files_to_copy, bytes_to_copy = scan.num_files, scan.total_size
+                except Exception as e:
+                    # Only the bucket ledger misses the totals
+                    self.progress_and_logg(f'Could not scan the sources: {e}')
+                    files_to_copy = bytes_to_copy = None
+                self.transfer_progress.emit(progress.snapshot())
+            if updown == 'upload':
+                # Also partial uploads change the listings
+                for source_path, destination_path in items:
+                    self.data_operations.listing_cache.invalidate(destination_path.joinpath(source_path.name))
+                if copy_status and files_to_copy is not None:
+                    # Overwritten objects are counted twice until the next reconciliation
+                    self.data_operations.bucket_ledger.record_change(bytes_to_copy, files_to_copy)
+                else:
+                    self.data_operations.bucket_ledger.mark_stale()
+                if collisions_future is not None:
+                    collisions_future.result()
+            else:
+                for _, destination_path in items:
+                    destination_path.mkdir(parents=True, exist_ok=True)
+                packs = self.find_packs(items)
+                if len(packs) > 0:
+                    copy_status = self.packed_download(items, packs, progress, self.verify or delete_source)
+                else:
+                    copy_status = self.tuned_copy(updown, items, copies, scan, plan, journal, progress, resumed,
+                                                  reclaimer)
+            # The kept sources are verified below, the rest of the sources is not deleted
+            reclaimed = reclaimer is None or self.reclaim_sources(updown, items, reclaimer)
+            # The sources are only deleted after a successful verification
+            # Packed transfers verify their shards themselves
+            packed = packed_upload or (updown == 'download' and len(packs) > 0)
+            if copy_status and (self.verify or delete_source) and not packed:
+                copy_status = self.verify_copies(updown, items, journal)
+            if delete_source and packed and updown == 'download':
+                # Members of ranged reads have no ETag, only their size is checked
+                self.progress_and_logg('The objects of packed folders are kept, their files can not be verified')
+                delete_source = False
+            if copy_status:
+                journal.remove()
+            else:
+                # Keep the journal to resume the transfer
+                journal.flush()
+        finally:
+            executor.shutdown(wait=False)
+
+        if copy_status and delete_source and reclaimed:
+            for source_path, _ in items:
+                self.progress_and_logg(f"removing: {source_path}")
+                if updown == 'upload':
+                    self.data_operations.delete_local_data(source_path)
+                else:
+                    self.data_operations.delete_bucket_data(source_path)
+        self.progress_and_logg("Transfer complete" if copy_status else "Transfer failed")
+        logging.info(stats_summary())
+        return copy_status
+
+    def scan_sources(self, updown: str, items: list, progress: TransferProgress, required: dict) -> ScanResult:
+        """ Scan the local sources of an upload or list the sources of a download,
+            the totals of the progress grow while the scan runs.
+            Args:
+                updown : str
+                    upload or download
+                items : list
+                    (source_path, destination_path) of the files or folders, see transfer
+                progress : TransferProgress
+                    receives the running totals
+                required : dict
+                    filled with the bytes per local destination folder of a download
+            Return:
+                ScanResult of all sources
+        """
+        total = ScanResult()
+        for source_path, destination_path in items:
+            def grow(partial: ScanResult):
+                progress.grow_totals(total.num_files + partial.num_files, total.total_size + partial.total_size)
+
+            if updown == 'upload':
+                source_scan = self.data_operations.scan_local_data(source_path, callback=grow)
+            else:
+                source_scan = self.data_operations.scan_bucket_data(source_path.relative_path(), callback=grow)
+                self.progress_and_logg(f'source_path: {source_path}, bucket_files: {source_scan.num_files}, '
+                                       f'bucket_filesize: {source_scan.total_size}')
+                required[destination_path] = required.get(destination_path, 0) + source_scan.total_size
+            total.merge(source_scan)
+        progress.grow_totals(total.num_files, total.total_size, final=True)
+        return total
+
+    def space_bound_fits(self, updown: str, items: list, space_future: Future) -> bool:
+        """ True if the free space suffices for any size of the sources: for uploads the used space of
+            the filesystems that hold the sources, for downloads the used space of the bucket from a recently
+            reconciled bucket ledger
+        """
         if updown == 'upload':
-            (local_files, localsize) = self.data_operations.get_local_datasize(source_path)
-            (bucket_files, bucket_filesize, bucket_freespace) = self.data_operations.get_bucket_freespace()
-            if bucket_freespace < localsize:
-                self._error(f'Not enough free space, required: {self.data_operations.size_fmt(localsize)}, \
-                              freespace: {self.data_operations.size_fmt(bucket_freespace)}')
+            # One source per filesystem, e.g. a mount under /mnt is not counted in the used space of /
+            filesystems = {}
+            for source_path, _ in items:
+                filesystems.setdefault(stat(source_path).st_dev, source_path)
+            bound = sum(self.data_operations.get_local_usedspace(source_path)
+                        for source_path in filesystems.values())
+            return bound <= space_future.result()[2]
+        # The ledger misses the changes made by others since its reconciliation
+        usage = self.data_operations.bucket_ledger.usage()
+        if usage is None or usage[3] or usage[2] > float(getenv('LEDGER_BOUND_MAX_AGE', 3600)):
+            return False
+        return all(bound >= usage[1] for bound in space_future.result().values())
+
+    def check_space_after_scan(self, updown: str, scan_future: Future, required: dict, space_future: Future):
+        """ Check the free space when the scan of a transfer that started early finished, the copy is stopped
+            if it does not suffice
+        """
+        def check(future: Future):
+            try:
+                fits = self.space_fits(updown, future.result(), required, space_future)
+            except Exception as e:
+                # The bound was checked before the start
+                self.progress_and_logg(f'Could not check the free space after the scan: {e}')
                 return
-        elif updown == 'download':
-            local_freespace = self.data_operations.get_local_freespace(destination_path)
-            (bucket_files, bucket_filesize, bucket_freespace) = self.data_operations.get_bucket_freespace(source_path.relative_path())
-            self.progress_and_logg(f'source_path: {source_path}, bucket_files: {bucket_files}, bucket_filesize: {bucket_filesize}')
-            if local_freespace < bucket_filesize:
+            if not fits:
+                self.progress_and_logg('Stopping the transfer')
+                self.stop_worker.set()
+
+        scan_future.add_done_callback(check)
+
+    def space_fits(self, updown: str, scan: ScanResult, required: dict, space_future: Future) -> bool:
+        """ Check the free space for the scanned sources, an error is reported if it does not suffice """
+        if updown == 'upload':
+            bucket_freespace = space_future.result()[2]
+            self.progress_and_logg(self.data_operations.bucket_ledger.staleness())
+            if bucket_freespace < scan.total_size:
+                self._error(f'Not enough free space, required: {self.data_operations.size_fmt(scan.total_size)}, \
+                              freespace: {self.data_operations.size_fmt(bucket_freespace)}')
+                return False
+            return True
+        local_freespace = space_future.result()
+        for destination_path, bucket_filesize in required.items():
+            if local_freespace[destination_path] < bucket_filesize:
                 self._error(f'Not enough free space, required: {self.data_operations.size_fmt(bucket_filesize)}, \n\
-                              freespace: {self.data_operations.size_fmt(local_freespace)}')
-                return
-        else:
-            self.finished.emit(False)
+                              freespace: {self.data_operations.size_fmt(local_freespace[destination_path])}')
+                return False
+        return True
+
+    def warn_all_collisions(self, items: list):
+        for source_path, destination_path in items:
+            self.warn_collisions(source_path, destination_path)
+
+    def predict_duration(self, updown: str, scan: ScanResult):
+        """ Log the duration of the transfer predicted from earlier transfers, see TransferHistory """
+        try:
+            prediction = self.data_operations.transfer_history.predict(updown, scan)
+        except Exception as e:
+            logging.warning("Could not predict the duration: {}".format(e))
             return
+        if prediction is None:
+            self.progress_and_logg('Not enough earlier transfers to predict the duration')
+            return
+        seconds, runs = prediction
+        self.progress_and_logg(f"Expected duration: {timedelta(seconds=int(seconds))}, "
+                               f"based on {runs} earlier transfers with similar file sizes")
 
-        self.progress_and_logg('Passed free space check, creating copy paths')
-        source_str, destination_str = self.prep_foldernames(updown, source_path, destination_path)
-        if updown == 'upload':
-            copy_status = self.copy_command(source_str, destination_str, local_files)
-        else:
-            destination_path.mkdir(parents=True, exist_ok=True)
-            copy_status = self.copy_command(source_str, destination_str, bucket_files)
+    def reclaim_sources(self, updown: str, items: list, reclaimer: SourceReclaimer) -> bool:
+        """ Wait for the sources that are deleted while copying, see SourceReclaimer
+            Args:
+                updown : str
+                    upload or download
+                items : list
+                    (source_path, destination_path) of the files or folders, see transfer
+                reclaimer : SourceReclaimer
+                    the deletes of this transfer
+            Return:
+                True if no source was kept
+        """
+        deleted, kept = reclaimer.close()
+        if updown == 'download':
+            for source_path, _ in items:
+                self.data_operations.listing_cache.invalidate(source_path)
+        self.progress_and_logg(f"Deleted {deleted} sources while copying, "
+                               f"{self.data_operations.size_fmt(reclaimer.deleted_bytes)} reclaimed")
+        for error in kept[:10]:
+            self.progress_and_logg(f"Kept the source {error}")
+        if len(kept) > 10:
+            self.progress_and_logg(f"... and {len(kept) - 10} more sources kept, see the log")
+        return len(kept) == 0
 
-        if copy_status and delete_source:
-            self.progress_and_logg(f"removing: {source_path}")
+    def verify_copies(self, updown: str, items: list, journal: TransferJournal = None) -> bool:
+        """ Compare the copied files with the ETags of their objects, see transfer_verify.
+            The mismatches are written to a command file to copy them again with s5cmd run.
+            Args:
+                updown : str
+                    upload or download
+                items : list
+                    (source_path, destination_path) of the files or folders, see transfer
+                journal : TransferJournal
+                    the mismatches are removed from it, optional
+            Return:
+                True if all files match
+        """
+        self.progress_and_logg('Verifying the transferred files')
+        try:
+            result = verify_transfer(self.data_operations, updown, items, progress=self.progress_and_logg,
+                                     part_sizes=tuple(self.part_sizes))
+        except Exception as e:
+            self._error(f'Could not verify the transfer: {e}')
+            return False
+        self.progress_and_logg(result.summary())
+        if result.ok():
+            return True
+        bucket = self.data_operations.bucket_name
+        commands = []
+        for local_path, key, reason in result.mismatches:
+            logging.info("Verification failed for {}: {}".format(local_path, reason))
             if updown == 'upload':
-                self.data_operations.delete_local_data(source_path)
+                commands.append(('cp', '--raw', local_path, f"s3://{bucket}/{key}"))
             else:
-                self.data_operations.delete_bucket_data(source_path)
-        self.progress_and_logg("Transfer complete")
-        self.finished.emit(True)
+                commands.append(('cp', '--raw', f"s3://{bucket}/{key}", local_path))
+        for local_path, _, reason in result.mismatches[:10]:
+            self.progress_and_logg(f"  {local_path}: {reason}")
+        retransfer_file = self.s5cmd.write_command_file(commands)
+        self.progress_and_logg(f"The files to transfer again are listed in {retransfer_file}, "
+                               f"for: s5cmd run {retransfer_file}")
+        if journal is not None:
+            journal.forget([local_path for local_path, _, _ in result.mismatches])
+        self._error('Verification failed')
+        return False
+
+    def verify_objects(self, files: list) -> bool:
+        """ Compare local files with the ETags of their objects, e.g. the shards of packed folders
+            Args:
+                files : list
+                    (local path, key) of the files
+            Return:
+                True if all files match
+        """
+        self.progress_and_logg(f'Verifying {len(files)} files')
+        bucket = self.data_operations.bucket_name
+        part_sizes = tuple(self.part_sizes)
+        result = VerifyResult()
+
+        def check(file):
+            local_path, key = file
+            obj = self.data_operations.s3.head_object(Bucket=bucket, Key=key)
+            size = path.getsize(local_path)
+            if obj['ContentLength'] != size:
+                return local_path, key, size, f"size {size} != {obj['ContentLength']}"
+            etag = obj.get('ETag', '').strip('"')
+            # Not an md5, e.g. encrypted with SSE-KMS
+            if len(etag.split('-')[0]) != 32:
+                return local_path, key, size, 'unverifiable'
+            return local_path, key, size, None if etag_matches(local_path, etag, part_sizes) else 'ETag mismatch'
+
+        try:
+            with ThreadPoolExecutor(max_workers=int(getenv('VERIFY_WORKERS', 8))) as pool:
+                for local_path, key, size, reason in pool.map(check, files):
+                    if reason == 'unverifiable':
+                        result.unverifiable += 1
+                    elif reason is not None:
+                        result.mismatches.append((local_path, key, reason))
+                    else:
+                        result.verified += 1
+                        result.verified_bytes += size
+        except Exception as e:
+            self._error(f'Could not verify the transfer: {e}')
+            return False
+        self.progress_and_logg(result.summary())
+        for local_path, _, reason in result.mismatches[:10]:
+            self.progress_and_logg(f"  {local_path}: {reason}")
+        if not result.ok():
+            self._error('Verification failed')
+            return False
+        return True
+
+    def packed_upload(self, items: list, verify: bool = False):
+        """ Upload the small files of the folders in tar shards with an index, the other files as objects
+            Args:
+                items : list
+                    (source_path, destination_path) of the files or folders, see transfer
+                verify : bool
+                    compare the uploaded objects, including the shards, with the ETags of their objects
+            Return:
+                copy_status : bool
+                    True if all objects were uploaded, and verified when asked
+                objects : int
+                    number of uploaded objects
+                size : int
+                    their size in bytes
+        """
+        bucket = self.data_operations.bucket_name
+        staging = Path(mkdtemp(prefix='pack_', dir=get_cachefolder()))
+        try:
+            # (cp arguments, size)
+            uploads = []
+            for i, (source_path, destination_path) in enumerate(items):
+                key = str(destination_path.joinpath(source_path.name))
+                if not source_path.is_dir():
+                    uploads.append((('--raw', str(source_path), f"s3://{bucket}/{key}"), source_path.stat().st_size))
+                    continue
+                self.progress_and_logg(f"Packing the small files of {source_path}")
+                pack = pack_folder(source_path, staging.joinpath(str(i)))
+                self.progress_and_logg(f"{pack.members} files ({self.data_operations.size_fmt(pack.member_bytes)}) "
+                                       f"packed in {len(pack.shards)} shards, "
+                                       f"{len(pack.large_files)} files are uploaded as objects")
+                for local_file in pack.upload_files():
+                    uploads.append((('--raw', str(local_file), f"s3://{bucket}/{key}/{PACK_DIR}/{local_file.name}"),
+                                    local_file.stat().st_size))
+                for file in pack.large_files:
+                    local_file = source_path.joinpath(file)
+                    uploads.append((('--raw', str(local_file), f"s3://{bucket}/{key}/{file}"),
+                                    local_file.stat().st_size))
+            size = sum(upload_size for _, upload_size in uploads)
+            copy_status = self.copy_command([copy for copy, _ in uploads], len(uploads), size)
+            if copy_status and verify:
+                copy_status = self.verify_objects([(local_file, url.split('/', 3)[3])
+                                                   for (_, local_file, url), _ in uploads])
+            return copy_status, len(uploads), size
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+
+    def find_packs(self, items: list) -> dict:
+        """ Find the packed folders the folders of a download are in
+            Return:
+                dict of item number to (prefix of the packed folder, index)
+        """
+        packs = {}
+        # The folders of a download mostly share their parents
+        lookups = {}
+        for i, (source_path, _) in enumerate(items):
+            # Packed files are not shown as objects, only folders can hold them
+            if source_path.suffix:
+                continue
+            try:
+                prefix, index = find_index(self.data_operations.s3, self.data_operations.bucket_name,
+                                           source_path.relative_path(), lookups)
+            except Exception as e:
+                self.progress_and_logg(f"Could not check for packed files in {source_path}: {e}")
+                continue
+            if index is not None:
+                packs[i] = (prefix, index)
+        return packs
+
+    def packed_download(self, items: list, packs: dict, progress: TransferProgress, verify: bool = False):
+        """ Download the objects with s5cmd and restore the packed files from their shards.
+            Shards of which most bytes are needed are downloaded whole, the other members are fetched
+            with a ranged GET each.
+            Args:
+                items : list
+                    (source_path, destination_path) of the files or folders, see transfer
+                packs : dict
+                    the packed folders, see find_packs
+                progress : TransferProgress
+                    progress of the transfer
+                verify : bool
+                    compare the whole shards with the ETags of their objects and the restored files with the
+                    sizes in the index
+            Return:
+                True if all files were copied, and verified when asked
+        """
+        bucket = self.data_operations.bucket_name
+        staging = Path(mkdtemp(prefix='pack_', dir=get_cachefolder()))
+        try:
+            plan = plan_sync(self.data_operations, 'download', items, compare_files=False)
+            # The shards are not restored as files
+            copies = [copy for copy in plan.copies if f"/{PACK_DIR}/" not in copy[1]]
+            # (local shard, members, local folder, subpath) and (shard key, members, local folder, subpath)
+            extractions = []
+            ranged = []
+            # (local shard, shard key) to verify
+            whole_shards = []
+            for i, (prefix, index) in packs.items():
+                source_path, destination_path = items[i]
+                subpath = source_path.relative_path()[len(prefix):]
+                local_root = destination_path.joinpath(source_path.name)
+                for shard, members in select_members(index, subpath).items():
+                    shard_key = f"{prefix}{PACK_DIR}/{shard}"
+                    if fetch_whole_shard(index, shard, members):
+                        local_shard = staging.joinpath(str(i), shard)
+                        copies.append(('--raw', f"s3://{bucket}/{shard_key}", str(local_shard)))
+                        extractions.append((local_shard, members, local_root, subpath))
+                        whole_shards.append((str(local_shard), shard_key))
+                    else:
+                        ranged.append((shard_key, members, local_root, subpath))
+            self.progress_and_logg(f"Packed files: {len(extractions)} whole shards and "
+                                   f"{sum(len(members) for _, members, _, _ in ranged)} ranged reads")
+            copy_status = self.copy_command(copies, progress.files_total, progress.bytes_total, progress=progress)
+            if copy_status and verify:
+                copy_status = self.verify_objects(whole_shards)
+            for local_shard, members, local_root, subpath in extractions:
+                if local_shard.exists():
+                    extract_members(local_shard, members, local_root, subpath)
+                    self.progress_and_logg(f"Restored {len(members)} files from {local_shard.name}")
+            for shard_key, members, local_root, subpath in ranged:
+                fetched = fetch_members(self.data_operations.s3, bucket, shard_key, members, local_root, subpath)
+                self.progress_and_logg(f"Restored {len(members)} files ({self.data_operations.size_fmt(fetched)}) "
+                                       f"from {shard_key} with ranged reads")
+            if copy_status and verify:
+                wrong = [target for _, members, local_root, subpath in extractions + ranged
+                         for target in resized_members(members, local_root, subpath)]
+                self.progress_and_logg(f"{len(wrong)} restored files differ in size from the index")
+                if len(wrong) > 0:
+                    for target in wrong[:10]:
+                        self.progress_and_logg(f"  {target}")
+                    self._error('Verification failed')
+                    return False
+            return copy_status
+        except Exception as e:
+            self._error(f"Could not restore the packed files: {e}")
+            return False
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+
+    def warn_collisions(self, source_path: Path, destination_path: ScalityPath):
+        """ Warn about the existing objects the upload will overwrite
+            Args:
+                source_path : Path
+                    local file or folder to upload
+                destination_path : ScalityPath
+                    scality folder the source is uploaded into
+        """
+        self.progress_and_logg('Checking for existing objects')
+        try:
+            collisions = self.data_operations.find_upload_collisions(source_path, destination_path)
+        except Exception as e:
+            self.progress_and_logg(f"Could not check for existing objects: {e}")
+            return
+        if len(collisions) == 0:
+            return
+        self.progress_and_logg(f"Warning: {len(collisions)} existing objects will be overwritten:")
+        for key in collisions[:10]:
+            self.progress_and_logg(f"  {key}")
+        if len(collisions) > 10:
+            self.progress_and_logg(f"  ... and {len(collisions) - 10} more, see the log")
+            logging.info("Overwritten objects: {}".format(collisions))
+
+    def resume_copies(self, updown: str, items: list, journal: TransferJournal):
+        """ Copy every file that is not completed in the journal of an earlier attempt separately
+            Args:
+                updown : str
+                    upload or download
+                items : list
+                    (source_path, destination_path) of the files or folders, see transfer
+                journal : TransferJournal
+                    journal of the earlier attempt
+            Return:
+                copies : list
+                    arguments of the remaining cp commands
+                skipped_files : int
+                    number of files that are not copied again
+                skipped_bytes : int
+                    their size in bytes
+        """
+        copies = []
+        skipped_files = skipped_bytes = 0
+        for source_path, destination_path in items:
+            source_str, destination_str = self.prep_foldernames(updown, source_path, destination_path)
+            # (local path, source, destination, size) of every file of the item
+            files = []
+            if updown == 'upload':
+                if source_path.is_dir():
+                    # full_path adds a slash to names without a suffix, keys of files do not end with one
+                    files = [(str(source_path.joinpath(file)), str(source_path.joinpath(file)),
+                              destination_path.joinpath(source_path.name, file).full_path().rstrip('/'), None)
+                             for file in list_files(source_path)]
+                else:
+                    files = [(str(source_path), source_str, destination_str, None)]
+            else:
+                prefix = source_path.relative_path()
+                bucket = self.data_operations.bucket_name
+                paginator = self.data_operations.s3.get_paginator('list_objects_v2')
+                for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+                    for obj in page.get('Contents', []):
+                        if source_path.suffix:
+                            if obj['Key'] != prefix:
+                                continue
+                            local_path = destination_str
+                        else:
+                            local_path = path.join(destination_str, *obj['Key'][len(prefix):].split('/'))
+                        files.append((local_path, f"s3://{bucket}/{obj['Key']}", local_path, obj['Size']))
+            for local_path, source, destination, size in files:
+                if journal.is_completed(local_path, size):
+                    skipped_files += 1
+                    skipped_bytes += journal.completed_size(local_path)
+                else:
+                    # The names are not wildcards
+                    copies.append(('--raw', source, destination))
+        self.progress_and_logg(f"Resuming transfer: {skipped_files} files "
+                               f"({self.data_operations.size_fmt(skipped_bytes)}) were copied before, "
+                               f"{len(copies)} files remaining")
+        return copies, skipped_files, skipped_bytes
 
     def prep_foldernames(self, updown: str,
                          source_path: Path | ScalityPath,
@@ -160,31 +774,175 @@ class DataTransfer(QObject):
         self.progress_and_logg(f"source_path: {source_path}, destination_path: {destination_path}")
         return str(source_path), str(destination_path)
 
-    def copy_command(self, source_path: str, destination_path: str, files_to_copy: int):
-        """Copy command, using the s5cmd instead of boto3 as its up to 40 times faster"""
-        # Copy data with status monitoring
-        process = self.s5cmd.cp(source_path, destination_path)
-        copied_files = 0
+    def tuned_copy(self, updown: str, items: list, copies: list, scan: ScanResult, plan=None,
+                   journal: TransferJournal = None, progress: TransferProgress = None, resumed: bool = False,
+                   reclaimer: SourceReclaimer = None):
+        """ Copy with the s5cmd settings chosen from the size histogram, see transfer_tuning
+            A bimodal histogram is copied in a run for the small and a run for the large files.
+            TRANSFER_TUNING = 'N' copies with AWS_WORKERS and the s5cmd defaults.
+            Args:
+                updown : str
+                    upload or download
+                items : list
+                    (source_path, destination_path) of the files or folders, see transfer
+                copies : list
+                    arguments of the cp commands, see copy_command
+                scan : ScanResult
+                    size histogram of the files to copy, None if the scan did not finish
+                plan : SyncPlan
+                    the files to copy with their sizes, optional
+                journal : TransferJournal
+                    the copied files are journaled, optional
+                progress : TransferProgress
+                    progress of the whole transfer
+                resumed : bool
+                    the copies are what an earlier attempt left, they are not split
+                reclaimer : SourceReclaimer
+                    deletes the sources of the copied files, optional
+            Return:
+                True if all files were copied
+        """
+        # Without the scan the copy started before the sizes were known
+        if getenv('TRANSFER_TUNING', 'Y').upper() != 'Y' or scan is None or scan.num_files == 0:
+            return self.copy_command(copies, progress.files_total, progress.bytes_total, journal, progress=progress,
+                                     reclaimer=reclaimer)
+        max_workers = self.numworkers if self.numworkers is not None else int(getenv('AWS_WORKERS', 256))
+        threshold = split_threshold(scan)
+        runs = [('all files', copies, scan)]
+        if threshold is not None and not resumed:
+            self.progress_and_logg(f"Bimodal file sizes, copying the files below and above "
+                                   f"{self.data_operations.size_fmt(threshold)} separately")
+            try:
+                if plan is None:
+                    plan = plan_sync(self.data_operations, updown, items, compare_files=False)
+                runs = plan.split(threshold)
+            except Exception as e:
+                self.progress_and_logg(f"Could not split the files, copying them in one run: {e}")
+        for name, run_copies, run_scan in runs:
+            if len(run_copies) == 0:
+                continue
+            settings = tune(run_scan, max_workers)
+            self.progress_and_logg(f"Copying {name}: {describe(run_scan)}, with {settings}")
+            if not self.copy_command(run_copies, progress.files_total, progress.bytes_total, journal,
+                                     settings=settings, progress=progress, reclaimer=reclaimer):
+                # The journal keeps the copied files, a resume copies the rest
+                return False
+        return True
+
+    def copy_command(self, copies: list, files_to_copy: int, bytes_to_copy: int = 0, journal: TransferJournal = None,
+                     skipped_files: int = 0, skipped_bytes: int = 0, settings: TransferSettings = None,
+                     progress: TransferProgress = None, reclaimer: SourceReclaimer = None):
+        """Copy command, using the s5cmd instead of boto3 as its up to 40 times faster
+            Several copies are written to a command file for s5cmd run, so one process shares its workers.
+            Args:
+                copies : list
+                    (source, destination) strings, see prep_foldernames, optionally preceded by cp flags
+                files_to_copy : int
+                    number of files, for the progress
+                bytes_to_copy : int
+                    number of bytes, for the progress
+                journal : TransferJournal
+                    the copied files are journaled, optional
+                skipped_files : int
+                    files copied by an earlier attempt, for the progress
+                skipped_bytes : int
+                    their size in bytes
+                settings : TransferSettings
+                    s5cmd settings of this copy, defaults to the numworkers of the transfer
+                progress : TransferProgress
+                    progress shared by several copies of a transfer, optional
+                reclaimer : SourceReclaimer
+                    deletes the sources of the copied files, optional
+            Return:
+                True if all files were copied
+        """
+        if len(copies) == 0:
+            self.progress_and_logg('Nothing left to copy')
+            return True
+        if progress is None:
+            progress = TransferProgress(files_to_copy, bytes_to_copy)
+            progress.add_skipped(skipped_files, skipped_bytes)
+        numworkers = settings.numworkers if settings is not None else self.numworkers
+        options = settings.cp_options() if settings is not None else []
+        if settings is not None and settings.part_size not in self.part_sizes:
+            self.part_sizes.append(settings.part_size)
+        # The jobs share one event loop and stop s5cmd when the worker is stopped
+        use_jobs = getenv('ASYNC_S5CMD', 'Y').upper() == 'Y'
+        if len(copies) == 1 and len(copies[0]) == 2:
+            command_file = None
+            if use_jobs:
+                process = self.s5cmd.cp_job(*copies[0], numworkers=numworkers, options=options,
+                                            stop_event=self.stop_worker)
+            else:
+                process = self.s5cmd.cp(*copies[0], numworkers=numworkers, options=options)
+        else:
+            command_file = self.s5cmd.write_command_file([('cp', *options) + tuple(copy) for copy in copies])
+            if use_jobs:
+                process = self.s5cmd.run_job(command_file, numworkers=numworkers, stop_event=self.stop_worker)
+            else:
+                process = self.s5cmd.run(command_file, numworkers=numworkers)
+        start_time = datetime.now()
+        start_bytes = progress.bytes_done
+        start_files = progress.files_done
+        start_errors = progress.errors
+        try:
+            return self._monitor_copy(process, progress, journal, reclaimer)
+        finally:
+            if command_file is not None:
+                command_file.unlink(missing_ok=True)
+            seconds = max((datetime.now() - start_time).total_seconds(), 1e-3)
+            if settings is not None:
+                # To check the tuning
+                logging.info("Copied {} with {} at {}/s".format(
+                    self.data_operations.size_fmt(progress.bytes_done - start_bytes), settings,
+                    self.data_operations.size_fmt((progress.bytes_done - start_bytes) / seconds)))
+            self.data_operations.transfer_history.record(
+                'download' if copies[0][-2].startswith('s3://') else 'upload',
+                progress.files_done - start_files, progress.bytes_done - start_bytes, seconds,
+                numworkers if numworkers is not None else int(getenv('AWS_WORKERS', 256)),
+                settings.concurrency if settings is not None else None,
+                settings.part_size if settings is not None else None,
+                progress.errors - start_errors)
+
+    def _monitor_copy(self, process, progress: TransferProgress, journal: TransferJournal = None,
+                      reclaimer: SourceReclaimer = None):
+        """ Follow the s5cmd output until the process ends, see copy_command
+            The json records of s5cmd are counted in the TransferProgress, snapshots are emitted
+            4 times per second for the progress bar and a summary is logged every 5 seconds.
+        """
         error_list = []
-        start_time = last_report_time = datetime.now()
+        start_time = last_report_time = last_log_time = datetime.now()
         self.progress_and_logg(f'starting transfer: {start_time}')
-        while process is not None and process.poll() is None:
-            for line in process.stdout:
-                copied_files += 1
+        self.transfer_progress.emit(progress.snapshot())
+        if process is not None:
+            for record in self.s5cmd.records(process):
+                if record.error is not None:
+                    progress.add_error()
+                    self.progress_and_logg('Error during transfer: {}'.format(record.error))
+                    error_list.append(record.error)
+                else:
+                    progress.add_file(record.size)
+                    if journal is not None:
+                        journal.record(record.source if journal.updown == 'upload' else record.destination,
+                                       record.size)
+                    if reclaimer is not None:
+                        reclaimer.add(record.source, record.destination, record.size)
                 current_time = datetime.now()
-                # Update progress bar if report_interval has passed or process completes
-                if current_time - last_report_time >= timedelta(seconds=1) or process.poll() is not None:
-                    self.progress_and_logg(f'copied {copied_files}/{files_to_copy}')
+                # Checking the clock per record is cheap compared to emitting a signal per file
+                if current_time - last_report_time >= timedelta(seconds=0.25):
+                    progress.sample()
+                    self.transfer_progress.emit(progress.snapshot())
                     last_report_time = current_time
-                if 'ERROR' in line:
-                    self._error('Error during upload: {}'.format(line))
-                    error_list.append(line)
-        if not process:
+                    if current_time - last_log_time >= timedelta(seconds=5):
+                        self.progress_and_logg(progress.summary())
+                        last_log_time = current_time
+            exit_code = process.wait()
+        else:
             self._error("Process is None might be an issue or could be a fast transfer")
             exit_code = 0
-        else:
-            exit_code = process.poll()
-        self.progress_and_logg(f'copied {copied_files}/{files_to_copy}')
+        progress.sample()
+        self.transfer_progress.emit(progress.snapshot())
+        self.progress_and_logg(progress.summary())
         self.progress_and_logg(f'finished transfer: {datetime.now()}, it took: {datetime.now() - start_time}')
         if exit_code != 0 or len(error_list) > 0:
             self._error('Error occured during transfer!')
@@ -0,0 +1,100 @@
+"""Batched check which destination keys already exist in the bucket.
+Answers for thousands of keys with few requests: the keys are grouped by folder, a folder that does not
+exist costs one MaxKeys=1 probe, a folder with many candidates is listed once and the few leftovers
+are checked with concurrent head_object requests.
+"""
+import logging
+import posixpath
+from concurrent.futures import ThreadPoolExecutor
+from os import getenv
+from threading import Lock
+
+from botocore.exceptions import ClientError
+
+# Folders with fewer candidates are checked with head_object instead of a listing
+HEAD_THRESHOLD = 20
+
+
+class ExistenceChecker:
+    """ Find the keys of an upload that would overwrite existing objects """
+
+    def __init__(self, s3, bucket_name: str, max_workers: int = None):
+        """
+        Args:
+            s3 : boto3 S3 client
+                the client is thread-safe and shared by the workers
+            bucket_name : str
+                name of the bucket
+            max_workers : int
+                number of concurrent requests, defaults to EXISTENCE_WORKERS or 16
+        """
+        if max_workers is None:
+            max_workers = int(getenv('EXISTENCE_WORKERS', 16))
+        self.s3 = s3
+        self.bucket_name = bucket_name
+        self.max_workers = max_workers
+        self.lock = Lock()
+        self.requests = 0
+
+    def _count_request(self):
+        with self.lock:
+            self.requests += 1
+
+    def prefix_exists(self, prefix: str) -> bool:
+        """ Return True if any object starts with the prefix, a single MaxKeys=1 request """
+        self._count_request()
+        response = self.s3.list_objects_v2(Bucket=self.bucket_name, Prefix=prefix, MaxKeys=1)
+        return response.get('KeyCount', len(response.get('Contents', []))) > 0
+
+    def key_exists(self, key: str) -> bool:
+        self._count_request()
+        try:
+            self.s3.head_object(Bucket=self.bucket_name, Key=key)
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+        return True
+
+    def list_folder(self, folder: str) -> set:
+        """ Keys directly in a folder, one listing paginated by 1000 keys """
+        keys = set()
+        paginator = self.s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=folder, Delimiter='/'):
+            self._count_request()
+            keys.update(obj['Key'] for obj in page.get('Contents', []))
+        return keys
+
+    def _check_group(self, folder: str, keys: list) -> list:
+        """ Existing keys of one folder """
+        if not self.prefix_exists(folder):
+            return []
+        if len(keys) < HEAD_THRESHOLD:
+            return [key for key in keys if self.key_exists(key)]
+        listed = self.list_folder(folder)
+        return [key for key in keys if key in listed]
+
+    def existing_keys(self, keys: list, common_prefix: str = '') -> list:
+        """ Return the keys that already exist
+            Args:
+                keys: list
+                    candidate destination keys
+                common_prefix: str
+                    prefix shared by all keys, e.g. the destination folder, checked first
+            Return:
+                list of existing keys, sorted
+        """
+        self.requests = 0
+        if len(keys) == 0 or (common_prefix != '' and not self.prefix_exists(common_prefix)):
+            return []
+        groups = {}
+        for key in keys:
+            folder = posixpath.dirname(key)
+            groups.setdefault(folder + '/' if folder else '', []).append(key)
+        existing = []
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='existence_check') as executor:
+            for result in executor.map(lambda group: self._check_group(*group), groups.items()):
+                existing.extend(result)
+        logging.info("Checked {} keys in {} folders for overwrites with {} requests, {} exist".format(
+            len(keys), len(groups), self.requests, len(existing)))
+        return sorted(existing)
@@ -15,10 +15,10 @@ from PySide6.QtGui import (QBrush, QColor, QConicalGradient, QCursor,
     QFont, QFontDatabase, QGradient, QIcon,
     QImage, QKeySequence, QLinearGradient, QPainter,
     QPalette, QPixmap, QRadialGradient, QTransform)
-from PySide6.QtWidgets import (QAbstractItemView, QAbstractScrollArea, QApplication, QGridLayout,
-    QHeaderView, QLabel, QMainWindow, QPushButton,
-    QSizePolicy, QStatusBar, QTextBrowser, QTreeView,
-    QWidget)
+from PySide6.QtWidgets import (QAbstractItemView, QAbstractScrollArea, QApplication, QCheckBox,
+    QGridLayout, QHeaderView, QLabel, QMainWindow,
+    QProgressBar, QPushButton, QSizePolicy, QStatusBar,
+    QTextBrowser, QTreeView, QWidget)
 
 class Ui_MainWindow(object):
     def setupUi(self, MainWindow):
@@ -101,6 +101,12 @@ class Ui_MainWindow(object):
 
         self.gridLayout.addWidget(self.PB_fs_delete, 2, 1, 1, 1)
 
+        self.progressBar = QProgressBar(self.centralwidget)
+        self.progressBar.setObjectName(u"progressBar")
+        self.progressBar.setValue(0)
+
+        self.gridLayout.addWidget(self.progressBar, 9, 0, 1, 6)
+
         self.TB_status = QTextBrowser(self.centralwidget)
         self.TB_status.setObjectName(u"TB_status")
         palette = QPalette()
@@ -138,6 +144,21 @@ class Ui_MainWindow(object):
 
         self.gridLayout.addWidget(self.PB_upload, 5, 2, 1, 2)
 
+        self.CB_pack = QCheckBox(self.centralwidget)
+        self.CB_pack.setObjectName(u"CB_pack")
+
+        self.gridLayout.addWidget(self.CB_pack, 4, 2, 1, 2)
+
+        self.CB_sync = QCheckBox(self.centralwidget)
+        self.CB_sync.setObjectName(u"CB_sync")
+
+        self.gridLayout.addWidget(self.CB_sync, 7, 2, 1, 2)
+
+        self.CB_dry_run = QCheckBox(self.centralwidget)
+        self.CB_dry_run.setObjectName(u"CB_dry_run")
+
+        self.gridLayout.addWidget(self.CB_dry_run, 8, 2, 1, 2)
+
         MainWindow.setCentralWidget(self.centralwidget)
         self.statusbar = QStatusBar(MainWindow)
         self.statusbar.setObjectName(u"statusbar")
@@ -158,5 +179,17 @@ class Ui_MainWindow(object):
         self.PB_fs_delete.setText(QCoreApplication.translate("MainWindow", u"Delete Folder", None))
         self.PB_download.setText(QCoreApplication.translate("MainWindow", u"<", None))
         self.PB_upload.setText(QCoreApplication.translate("MainWindow", u">", None))
+#if QT_CONFIG(tooltip)
+        self.CB_pack.setToolTip(QCoreApplication.translate("MainWindow", u"Upload the small files in tar shards with an index, downloads restore them", None))
+#endif // QT_CONFIG(tooltip)
+        self.CB_pack.setText(QCoreApplication.translate("MainWindow", u"Pack small files", None))
+#if QT_CONFIG(tooltip)
+        self.CB_sync.setToolTip(QCoreApplication.translate("MainWindow", u"Only copy the files that are new or changed at the destination", None))
+#endif // QT_CONFIG(tooltip)
+        self.CB_sync.setText(QCoreApplication.translate("MainWindow", u"Sync", None))
+#if QT_CONFIG(tooltip)
+        self.CB_dry_run.setToolTip(QCoreApplication.translate("MainWindow", u"Only report how many files and bytes would be copied", None))
+#endif // QT_CONFIG(tooltip)
+        self.CB_dry_run.setText(QCoreApplication.translate("MainWindow", u"Dry run", None))
     # retranslateUi
 
@@ -0,0 +1,171 @@
+"""Persistent cache of Scality listing pages and folder totals.
+The pages are stored in SQLite, keyed by endpoint, bucket, prefix and page number.
+"""
+import json
+import logging
+import sqlite3
+import time
+from os import getenv
+from pathlib import Path
+from threading import Lock
+
+from utils import get_cachefolder
+
+# Pages younger than the TTL are used without asking Scality
+DEFAULT_TTL = 3600
+# Increase when the format of the cached rows changes
+SCHEMA_VERSION = 2
+
+
+def affected_prefixes(scality_path: str):
+    """ Listings that change when data is added to or removed from a path.
+        Args:
+            scality_path: str
+                path to the file or folder in the bucket, without bucketname
+        Return:
+            ancestors: list
+                prefixes of the parent folders, these may gain or lose a row
+            descendant_prefix: str
+                every prefix starting with this is (partly) changed
+    """
+    path = str(scality_path).strip('/')
+    if path in ('', '.', '*'):
+        return [], ''
+    parts = path.split('/')
+    ancestors = [''] + ['/'.join(parts[:i]) + '/' for i in range(1, len(parts))]
+    return ancestors, path + '/'
+
+
+class ListingCache:
+    """ Cache of list_objects_v2 pages (Delimiter='/') as tree rows and of the totals per prefix """
+
+    def __init__(self, db_path: Path = None, ttl: int = None):
+        """
+        Args:
+            db_path: Path
+                SQLite database, defaults to listing_cache.sqlite in the cache folder
+            ttl: int
+                seconds a page is considered fresh, defaults to LISTING_CACHE_TTL or 3600
+        """
+        self.endpoint_url = getenv('ENDPOINT') or ''
+        self.bucket_name = getenv('BUCKETNAME') or ''
+        self.ttl = int(ttl if ttl is not None else getenv('LISTING_CACHE_TTL', DEFAULT_TTL))
+        if db_path is None:
+            db_path = get_cachefolder().joinpath('listing_cache.sqlite')
+        self.lock = Lock()
+        # The connection is shared by the lister threads, access is serialised by the lock
+        self.db = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            if self.db.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+                self.db.execute("DROP TABLE IF EXISTS pages")
+                self.db.execute("DROP TABLE IF EXISTS prefix_stats")
+                self.db.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+            self.db.execute("""CREATE TABLE IF NOT EXISTS prefix_stats (
+                endpoint TEXT, bucket TEXT, prefix TEXT, size INTEGER, objects INTEGER, computed_at REAL,
+                PRIMARY KEY (endpoint, bucket, prefix))""")
+            self.db.execute("""CREATE TABLE IF NOT EXISTS pages (
+                endpoint TEXT, bucket TEXT, prefix TEXT, page INTEGER,
+                token TEXT, rows TEXT, next_token TEXT, truncated INTEGER, listed_at REAL,
+                PRIMARY KEY (endpoint, bucket, prefix, page))""")
+
+    def get(self, prefix: str, page: int):
+        """ Retrieve a cached page
+            Args:
+                prefix: str
+                    listed prefix
+                page: int
+                    page number, starting at 0
+            Return:
+                None if not cached, otherwise:
+                (rows, token, next_token, truncated, age)
+                token is the continuation token the page was listed with, age is in seconds
+        """
+        with self.lock:
+            result = self.db.execute(
+                "SELECT rows, token, next_token, truncated, listed_at FROM pages "
+                "WHERE endpoint=? AND bucket=? AND prefix=? AND page=?",
+                (self.endpoint_url, self.bucket_name, prefix, page)).fetchone()
+        if result is None:
+            return None
+        rows, token, next_token, truncated, listed_at = result
+        return json.loads(rows), token, next_token, bool(truncated), time.time() - listed_at
+
+    def is_fresh(self, age: float) -> bool:
+        return age < self.ttl
+
+    def put(self, prefix: str, page: int, token: str, rows: list, next_token: str, truncated: bool):
+        """ Store a listed page, the pages after a last page are removed
+            Args:
+                prefix: str
+                    listed prefix
+                page: int
+                    page number, starting at 0
+                token: str
+                    continuation token the page was listed with
+                rows: list
+                    tree rows [display_name, level, 'F/f', absolute Path, size]
+                next_token: str
+                    continuation token of the next page
+                truncated: bool
+                    True if there are more pages
+        """
+        try:
+            with self.lock, self.db:
+                self.db.execute("INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                (self.endpoint_url, self.bucket_name, prefix, page, token,
+                                 json.dumps(rows), next_token, int(truncated), time.time()))
+                if not truncated:
+                    self.db.execute("DELETE FROM pages WHERE endpoint=? AND bucket=? AND prefix=? AND page>?",
+                                    (self.endpoint_url, self.bucket_name, prefix, page))
+        except sqlite3.Error as e:
+            logging.warning("Failed to cache listing of {}: {}".format(prefix, e))
+
+    def get_stats(self, prefix: str):
+        """ Retrieve the cached totals of a prefix
+            Args:
+                prefix: str
+                    folder in the bucket
+            Return:
+                None if not cached, otherwise:
+                (size, objects, age)
+        """
+        with self.lock:
+            result = self.db.execute(
+                "SELECT size, objects, computed_at FROM prefix_stats WHERE endpoint=? AND bucket=? AND prefix=?",
+                (self.endpoint_url, self.bucket_name, prefix)).fetchone()
+        if result is None:
+            return None
+        size, objects, computed_at = result
+        return size, objects, time.time() - computed_at
+
+    def put_stats(self, prefix: str, size: int, objects: int):
+        """ Store the complete totals of a prefix """
+        try:
+            with self.lock, self.db:
+                self.db.execute("INSERT OR REPLACE INTO prefix_stats VALUES (?, ?, ?, ?, ?, ?)",
+                                (self.endpoint_url, self.bucket_name, prefix, size, objects, time.time()))
+        except sqlite3.Error as e:
+            logging.warning("Failed to cache totals of {}: {}".format(prefix, e))
+
+    def invalidate(self, scality_path: str):
+        """ Remove the pages and totals which are changed by adding or removing data at the path
+            Args:
+                scality_path: str
+                    path to the file or folder in the bucket, without bucketname
+        """
+        ancestors, descendant_prefix = affected_prefixes(scality_path)
+        condition = "endpoint=? AND bucket=?"
+        params = (self.endpoint_url, self.bucket_name)
+        if descendant_prefix != '':
+            condition += " AND (prefix IN ({}) OR substr(prefix, 1, ?)=?)".format(','.join('?' * len(ancestors)))
+            params += (*ancestors, len(descendant_prefix), descendant_prefix)
+        # Without a path the whole bucket changed
+        try:
+            with self.lock, self.db:
+                # The totals of the parent folders change as well
+                self.db.execute("DELETE FROM pages WHERE " + condition, params)
+                self.db.execute("DELETE FROM prefix_stats WHERE " + condition, params)
+        except sqlite3.Error as e:
+            logging.warning("Failed to invalidate listing cache of {}: {}".format(scality_path, e))
+        logging.info("Invalidated cached listings of: {}".format(scality_path))
@@ -0,0 +1,308 @@
+"""Parallel scanner for local folders.
+Counts the files, their total size and a size histogram in a single os.scandir traversal,
+the directories are read by a thread pool. Works on Windows and Linux.
+The totals per directory can be cached by directory mtime, a rescan only reads the changed directories.
+"""
+import json
+import logging
+import os
+import sqlite3
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+from threading import Lock
+
+from utils import get_cachefolder, size_fmt
+
+# Histogram bins are powers of two: bin i holds the files with size.bit_length() == i
+NUM_BINS = 65
+
+
+class ScanResult:
+    """ Number of files, total size and size histogram of a scanned folder """
+
+    def __init__(self):
+        self.num_files = 0
+        self.total_size = 0
+        self.histogram = [0] * NUM_BINS
+        self.histogram_bytes = [0] * NUM_BINS
+        # Directories read from disk and taken from the scan cache
+        self.dirs_scanned = 0
+        self.dirs_cached = 0
+
+    def add_file(self, size: int):
+        size_bin = size.bit_length()
+        self.num_files += 1
+        self.total_size += size
+        self.histogram[size_bin] += 1
+        self.histogram_bytes[size_bin] += size
+
+    def merge(self, other):
+        """ Add the totals of another scan result """
+        self.num_files += other.num_files
+        self.total_size += other.total_size
+        self.dirs_scanned += other.dirs_scanned
+        self.dirs_cached += other.dirs_cached
+        for i in range(NUM_BINS):
+            self.histogram[i] += other.histogram[i]
+            self.histogram_bytes[i] += other.histogram_bytes[i]
+
+    @staticmethod
+    def bin_upper_bound(size_bin: int) -> int:
+        """ Files in the bin are smaller than this number of bytes """
+        return 2 ** size_bin
+
+    def histogram_summary(self) -> str:
+        """ The non empty bins as 'upper bound: count' for the logs """
+        parts = []
+        for i, count in enumerate(self.histogram):
+            if count > 0:
+                parts.append(f"<{size_fmt(self.bin_upper_bound(i))}: {count}")
+        return ", ".join(parts)
+
+    def to_json(self) -> str:
+        """ Totals and the non empty histogram bins, for the scan cache """
+        bins = dict((i, [self.histogram[i], self.histogram_bytes[i]]) for i in range(NUM_BINS) if self.histogram[i])
+        return json.dumps([self.num_files, self.total_size, bins])
+
+    @classmethod
+    def from_json(cls, data: str):
+        result = cls()
+        result.num_files, result.total_size, bins = json.loads(data)
+        for i, (count, size) in bins.items():
+            result.histogram[int(i)] = count
+            result.histogram_bytes[int(i)] = size
+        return result
+
+
+class ScanCache:
+    """ Persistent totals of the files directly in a directory, valid as long as the directory mtime is unchanged.
+    Adding, removing or renaming entries changes the mtime of a directory, files that are rewritten in place
+    with another size do not. """
+
+    def __init__(self, db_path: Path = None):
+        """
+        Args:
+            db_path: Path
+                SQLite database, defaults to local_scan_cache.sqlite in the cache folder
+        """
+        if db_path is None:
+            db_path = get_cachefolder().joinpath('local_scan_cache.sqlite')
+        self.lock = Lock()
+        self.db = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("""CREATE TABLE IF NOT EXISTS dirs (
+                path TEXT PRIMARY KEY, mtime_ns INTEGER, totals TEXT, subdirectories TEXT)""")
+
+    def load(self, root: str) -> dict:
+        """ Return the cached directories of a tree as {path: (mtime_ns, totals, subdirectories)} """
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT path, mtime_ns, totals, subdirectories FROM dirs WHERE path=? OR substr(path, 1, ?)=?",
+                (root, len(root) + 1, root + os.sep)).fetchall()
+        return dict((path, (mtime_ns, totals, subdirectories)) for path, mtime_ns, totals, subdirectories in rows)
+
+    def store(self, root: str, entries: list, visited: set, cached: dict):
+        """ Store the rescanned directories and forget the directories of the tree that are gone
+            Args:
+                root: str
+                    scanned folder
+                entries: list
+                    (path, mtime_ns, totals, subdirectories) of the directories read from disk
+                visited: set
+                    all directories of the tree
+                cached: dict
+                    the cached directories of the tree before the scan
+        """
+        gone = [(path,) for path in cached if path not in visited]
+        try:
+            with self.lock, self.db:
+                self.db.executemany("INSERT OR REPLACE INTO dirs VALUES (?, ?, ?, ?)", entries)
+                self.db.executemany("DELETE FROM dirs WHERE path=?", gone)
+        except sqlite3.Error as e:
+            logging.warning("Failed to update the scan cache of {}: {}".format(root, e))
+
+
+def _scan_one_directory(directory: str, cached: dict = None):
+    """ Read one directory, or take it from the cache when its mtime is unchanged
+        Args:
+            directory: str
+                path of the directory
+            cached: dict
+                cached directories, see ScanCache.load
+        Return:
+            result : ScanResult
+                files directly in the directory
+            subdirectories : list
+                paths of the subdirectories
+            entry : tuple
+                (path, mtime_ns, totals, subdirectories) for the scan cache, None when taken from the cache
+    """
+    result = ScanResult()
+    subdirectories = []
+    mtime_ns = None
+    if cached is not None:
+        try:
+            mtime_ns = os.stat(directory).st_mtime_ns
+        except OSError as e:
+            logging.warning("Could not read directory {}: {}".format(directory, e))
+            return result, subdirectories, None
+        if directory in cached and cached[directory][0] == mtime_ns:
+            result = ScanResult.from_json(cached[directory][1])
+            result.dirs_cached = 1
+            return result, json.loads(cached[directory][2]), None
+    result.dirs_scanned = 1
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                try:
+                    # Directory symlinks are not followed to avoid loops
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirectories.append(entry.path)
+                    elif entry.is_file():
+                        # On Windows the size comes with the directory listing, no extra system call
+                        result.add_file(entry.stat().st_size)
+                except OSError as e:
+                    logging.warning("Could not read {}: {}".format(entry.path, e))
+    except OSError as e:
+        logging.warning("Could not read directory {}: {}".format(directory, e))
+        # Do not cache a directory that could not be read
+        mtime_ns = None
+    entry = None
+    if mtime_ns is not None:
+        entry = (directory, mtime_ns, result.to_json(), json.dumps(subdirectories))
+    return result, subdirectories, entry
+
+
+def scan_directory(local_path: Path, max_workers: int = None, scan_cache: ScanCache = None,
+                   callback=None) -> ScanResult:
+    """ Scan a folder recursively with a thread pool
+        Args:
+            local_path: Path
+                folder to scan
+            max_workers: int
+                number of directories read concurrently, defaults to SCAN_WORKERS or 16
+            scan_cache: ScanCache
+                only directories with a changed mtime are read when given
+            callback: callable
+                called with the running totals while the scan runs, optional
+        Return:
+            ScanResult
+    """
+    if max_workers is None:
+        max_workers = int(os.getenv('SCAN_WORKERS', 16))
+    root = os.path.abspath(local_path)
+    cached = scan_cache.load(root) if scan_cache is not None else None
+    entries = []
+    visited = set()
+    total = ScanResult()
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='local_scan') as executor:
+        pending = {executor.submit(_scan_one_directory, root, cached)}
+        visited.add(root)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                result, subdirectories, entry = future.result()
+                total.merge(result)
+                if entry is not None:
+                    entries.append(entry)
+                visited.update(subdirectories)
+                pending.update(executor.submit(_scan_one_directory, subdirectory, cached)
+                               for subdirectory in subdirectories)
+            if callback is not None:
+                callback(total)
+    if scan_cache is not None:
+        scan_cache.store(root, entries, visited, cached)
+    return total
+
+
+def _list_one_directory(directory: str, with_stats: bool = False):
+    """ Return the paths of the files and subdirectories in one directory,
+        with_stats returns (path, size, mtime_ns) per file """
+    files = []
+    subdirectories = []
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirectories.append(entry.path)
+                    elif entry.is_file():
+                        if with_stats:
+                            # Cached by scandir on Windows, one stat call otherwise
+                            stat = entry.stat()
+                            files.append((entry.path, stat.st_size, stat.st_mtime_ns))
+                        else:
+                            files.append(entry.path)
+                except OSError as e:
+                    logging.warning("Could not read {}: {}".format(entry.path, e))
+    except OSError as e:
+        logging.warning("Could not read directory {}: {}".format(directory, e))
+    return files, subdirectories
+
+
+def list_files(local_path: Path, max_workers: int = None) -> list:
+    """ List the files in a folder recursively with a thread pool, e.g. to predict the destination keys
+        Args:
+            local_path: Path
+                folder to list
+            max_workers: int
+                number of directories read concurrently, defaults to SCAN_WORKERS or 16
+        Return:
+            list of the file paths relative to the folder, with / as separator
+    """
+    if max_workers is None:
+        max_workers = int(os.getenv('SCAN_WORKERS', 16))
+    root = os.path.abspath(local_path)
+    files = []
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='local_scan') as executor:
+        pending = {executor.submit(_list_one_directory, root)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                directory_files, subdirectories = future.result()
+                files.extend(Path(os.path.relpath(file, root)).as_posix() for file in directory_files)
+                pending.update(executor.submit(_list_one_directory, subdirectory) for subdirectory in subdirectories)
+    return files
+
+
+def list_file_stats(local_path: Path, max_workers: int = None) -> dict:
+    """ List the files in a folder recursively with their size and modification time, see list_files
+        Return:
+            dict of the file paths relative to the folder, with / as separator, to (size, mtime_ns)
+    """
+    if max_workers is None:
+        max_workers = int(os.getenv('SCAN_WORKERS', 16))
+    root = os.path.abspath(local_path)
+    files = {}
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='local_scan') as executor:
+        pending = {executor.submit(_list_one_directory, root, True)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                directory_files, subdirectories = future.result()
+                for file, size, mtime_ns in directory_files:
+                    files[Path(os.path.relpath(file, root)).as_posix()] = (size, mtime_ns)
+                pending.update(executor.submit(_list_one_directory, subdirectory, True)
+                               for subdirectory in subdirectories)
+    return files
+
+
+def scan_path(local_path: Path, max_workers: int = None, scan_cache: ScanCache = None,
+              callback=None) -> ScanResult:
+    """ Scan a file or folder, see scan_directory """
+    if local_path.is_file():
+        result = ScanResult()
+        result.add_file(local_path.stat().st_size)
+        return result
+    return scan_directory(local_path, max_workers, scan_cache, callback)
+
+
+if __name__ == "__main__":
+    import sys
+    from datetime import datetime
+    start_time = datetime.now()
+    scan = scan_path(Path(sys.argv[1]), scan_cache=ScanCache())
+    print(f"{scan.num_files} files, {scan.total_size} bytes, took {datetime.now() - start_time}")
+    print(f"{scan.dirs_scanned} directories read, {scan.dirs_cached} from the scan cache")
+    print(scan.histogram_summary())
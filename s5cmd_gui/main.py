@@ -1,19 +1,24 @@
 from dotenv import load_dotenv
 from datetime import datetime
 from PySide6.QtUiTools import QUiLoader
-from PySide6.QtCore import QStandardPaths, QDir, QThread
+from PySide6.QtCore import QStandardPaths, QDir, QPersistentModelIndex, QThread, QTimer
 import PySide6.QtWidgets as QtWidgets
 from threading import Event
 from pathlib import Path
-# from os import path
+from os import getenv
 import sys
+from multiprocessing import freeze_support
+import time
 
 import gui
-from utils import setup_logger, load_ui, make_folder
+from utils import setup_logger, load_ui
 from path import ScalityPath
-from data_transfer import DataTransfer
+from data_delete import DataDelete
 from data_operation import DataOperation
 from scality_tree import scalityTreeModel
+from transfer_scheduler import TransferScheduler
+from transfer_journal import TransferJournal
+from s5cmd_runner import TERMINATE_GRACE
 
 
 class mainmenu(QtWidgets.QMainWindow, gui.MainWindow.Ui_MainWindow):
@@ -38,16 +43,33 @@ class mainmenu(QtWidgets.QMainWindow, gui.MainWindow.Ui_MainWindow):
 
         self.sc_new_foldername = ""
         self.data_operations = DataOperation()
-        self.threads = []
+        # Reconcile the bucket ledger in the background when it is stale, check every hour
+        self.data_operations.bucket_ledger.reconcile_in_background()
+        self.ledger_timer = QTimer(self)
+        self.ledger_timer.timeout.connect(self.data_operations.bucket_ledger.reconcile_in_background)
+        self.ledger_timer.start(3600 * 1000)
+        self.transfer_scheduler = TransferScheduler(self.data_operations)
+        self.transfer_scheduler.job_message.connect(self.update_job_status)
+        self.transfer_scheduler.job_progress.connect(self.update_progress_bar)
+        self.transfer_scheduler.job_finished.connect(self.finish_data_transfer)
+        self.transfer_scheduler.all_finished.connect(self.finish_all_transfers)
+        self.delete_thread = None
         self.refresh_scality_index = None
+        # Set when the window is closed while transfers run, it closes once they stopped or at this time
+        self.close_deadline = None
+        # Offer to resume interrupted transfers once the window is shown
+        QTimer.singleShot(0, self.resume_transfers)
 
-    def _enable_buttons(self, enable: bool):
+    def _enable_buttons(self, enable: bool, transfers: bool = None):
+        """ Enable or disable the buttons, the transfer buttons can differ to queue transfers while others run """
+        if transfers is None:
+            transfers = enable
         self.PB_fs_create.setEnabled(enable)
         self.PB_fs_delete.setEnabled(enable)
         self.PB_sc_create.setEnabled(enable)
         self.PB_sc_delete.setEnabled(enable)
-        self.PB_upload.setEnabled(enable)
-        self.PB_download.setEnabled(enable)
+        self.PB_upload.setEnabled(transfers)
+        self.PB_download.setEnabled(transfers)
 
     def pop_up(self, message):
         """ Pop up a message box with the given message
@@ -83,15 +105,24 @@ class mainmenu(QtWidgets.QMainWindow, gui.MainWindow.Ui_MainWindow):
     def _init_scality_tree(self):
         self.scality_model = scalityTreeModel(self.scality_fs_tree)
         self.scality_fs_tree.setModel(self.scality_model)
-        self.scality_fs_tree.expanded.connect(self.scality_model.refresh_subtree)
+        # Folders are listed in the background when the view expands or scrolls them
+        self.scality_model.listing_failed.connect(self.update_transfer_status)
         self.scality_model.init_tree()
+        # Show how much expansion latency the prefetcher saves
+        self.prefetch_timer = QTimer(self)
+        self.prefetch_timer.timeout.connect(
+            lambda: self.statusbar.showMessage(self.scality_model.prefetcher.summary()))
+        self.prefetch_timer.start(5000)
 
-        # Hide unnecessary information
+        # Hide unnecessary information, show the name, size and number of objects
         self.scality_fs_tree.setColumnHidden(1, True)
         self.scality_fs_tree.setColumnHidden(2, True)
         self.scality_fs_tree.setColumnHidden(3, True)
-        self.scality_fs_tree.setColumnHidden(4, True)
-        self.scality_fs_tree.setColumnHidden(5, True)
+        header = self.scality_fs_tree.header()
+        header.setStretchLastSection(False)
+        header.setSectionResizeMode(0, QtWidgets.QHeaderView.ResizeMode.Stretch)
+        header.setSectionResizeMode(4, QtWidgets.QHeaderView.ResizeMode.ResizeToContents)
+        header.setSectionResizeMode(5, QtWidgets.QHeaderView.ResizeMode.ResizeToContents)
 
     def create_fs_dir(self):
         """Create a directory/folder on the local filesystem """
@@ -121,10 +152,7 @@ class mainmenu(QtWidgets.QMainWindow, gui.MainWindow.Ui_MainWindow):
         fs_index = fs_selection[0]
         local_path = Path(self.local_fs_model.filePath(fs_index))
         if self.pop_up(f"Are you sure you want to delete {local_path}?"):
-            self.TB_status.append(f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}:\
-                                   starting deletion of {local_path}. Ui might hang, please wait..")
-            self.data_operations.delete_local_data(local_path)
-            self.TB_status.append(f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}: {local_path} deleted.")
+            self.start_data_delete(local_path, None)
 
     def create_sc_dir(self):
         """Create a directory/folder on the local filesystem."""
@@ -141,7 +169,8 @@ class mainmenu(QtWidgets.QMainWindow, gui.MainWindow.Ui_MainWindow):
     def delete_sc_dir(self):
         """Delete a folder/file on the scality filesystem."""
         self.TB_status.clear()
-        scality_selection = self.scality_fs_tree.selectedIndexes()
+        # One index per row, the size and object count columns are selected as well
+        scality_selection = self.scality_fs_tree.selectionModel().selectedRows()
         if len(scality_selection) == 0:
             self.TB_status.append("Please select a collection.")
             return None
@@ -150,66 +179,163 @@ class mainmenu(QtWidgets.QMainWindow, gui.MainWindow.Ui_MainWindow):
         _, _, _, scality_folder = self.scality_model.path_from_tree_index(scality_index)
 
         if self.pop_up(f"Are you sure you want to delete {scality_folder}?"):
-            self.TB_status.append(f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}:\
-                                   starting deletion of {scality_folder}. Ui might hang, please wait..")
-            self.data_operations.delete_bucket_data(ScalityPath(self.data_operations, scality_folder))
-            self.TB_status.append(f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}: {scality_folder} deleted.")
-            self.scality_model.refresh_subtree(scality_index.parent())
+            self.start_data_delete(ScalityPath(self.data_operations, scality_folder), scality_index.parent())
+
+    def start_data_delete(self, target, refresh_index):
+        """ Delete the target in a background thread, the tree is refreshed afterwards
+        Args:
+            target : Path | ScalityPath
+                local or scality folder to delete
+            refresh_index : QModelIndex
+                folder in the scality tree to refresh when finished, None for local folders
+        """
+        thread = QThread()
+        self.delete_worker = DataDelete(Event(), self.data_operations)
+        self.delete_worker.set_params(target)
+        self.delete_worker.moveToThread(thread)
+        self.delete_worker.progress.connect(self.update_transfer_status)
+        thread.started.connect(self.delete_worker.run)
+        self.delete_worker.finished.connect(lambda _: self.finish_data_delete(refresh_index))
+        self.delete_worker.finished.connect(thread.quit)
+        self.delete_worker.finished.connect(self.delete_worker.deleteLater)
+        thread.finished.connect(thread.deleteLater)
+        self._enable_buttons(False)
+        thread.start()
+        self.delete_thread = thread
+
+    def finish_data_delete(self, refresh_index):
+        """ Finish a deletion """
+        self._enable_buttons(True)
+        if refresh_index is not None:
+            self.scality_model.refresh_subtree(refresh_index)
 
     def update_transfer_status(self, status):
         """Helper function to update the data transfer thread"""
         self.TB_status.append(f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}: {status}")
 
+    def update_job_status(self, job, status):
+        """ Status message of a transfer job """
+        self.update_transfer_status(f"[{job.job_id} {job.name}] {status}")
+
+    def update_progress_bar(self, job=None):
+        """ Show the combined progress of the running transfer jobs in the progress bar """
+        fraction = self.transfer_scheduler.fraction()
+        self.progressBar.setMaximum(1000)
+        self.progressBar.setValue(int(fraction * 1000))
+        self.progressBar.setFormat(f"{fraction:.0%}: {self.transfer_scheduler.summary()}")
+
     def upload_data(self):
         local_paths, scality_paths = self._gather_info_for_transfer()
+        if local_paths is None:
+            return
         if len(scality_paths) != 1 or scality_paths[0].Ff == 'f':
             self.TB_status.append("Can only upload to one scality folder.")
             return
-        self.to_up_download = []
-        for local_folder in local_paths:
-            if self.sc_new_foldername == '':
-                self.to_up_download.append(('upload', local_folder, scality_paths[0]))
-            else:
-                self.to_up_download.append(('upload', local_folder, f'{scality_paths[0]}{self.sc_new_foldername}'))
-        self.start_data_transfer(self.to_up_download.pop(0))
-
-    def finish_data_transfer(self):
-        """ Finish an up/download"""
-        if len(self.to_up_download) > 0:
-            self.start_data_transfer(self.to_up_download.pop(0))
-            return
-        self._enable_buttons(True)
-        if self.refresh_scality_index is not None:
-            self.scality_model.refresh_subtree(self.refresh_scality_index)
+        destination = scality_paths[0]
+        if self.sc_new_foldername != '':
+            destination = destination.joinpath(self.sc_new_foldername)
+        refresh_index = QPersistentModelIndex(self.refresh_scality_index)
+        self.start_data_transfer('upload', [(local_folder, destination) for local_folder in local_paths],
+                                 refresh_index, sync=self.CB_sync.isChecked(), dry_run=self.CB_dry_run.isChecked(),
+                                 pack=self.CB_pack.isChecked())
 
     def download_data(self):
         local_paths, scality_paths = self._gather_info_for_transfer()
         self.refresh_scality_index = None
+        if local_paths is None:
+            return
         if len(local_paths) != 1 or not local_paths[0].is_dir():
             self.TB_status.append("Can only download to one local folder.")
             return
-        self.to_up_download = []
-        for Scalitypath in scality_paths:
-            self.to_up_download.append(('download', local_paths[0], Scalitypath))
-        self.start_data_transfer(self.to_up_download.pop(0))
-
-    def start_data_transfer(self, item):
-        """ Item is a tuple containing: ('upload', 'C:/Users/daale010', '.')"""
-        updown, local_path, scality_path = item
-        thread = QThread()
-        self.stop_worker = Event()
-        self.worker = DataTransfer(self.stop_worker)
-        self.worker.set_params(updown, local_path, scality_path, False)
-        self.worker.moveToThread(thread)
-        self.worker.progress.connect(self.update_transfer_status)
-        thread.started.connect(self.worker.run)
-        self.worker.finished.connect(self.finish_data_transfer)
-        self.worker.finished.connect(thread.quit)
-        self.worker.finished.connect(self.worker.deleteLater)
-        thread.finished.connect(thread.deleteLater)
-        self._enable_buttons(False)
-        thread.start()
-        self.threads.append(thread)
+        self.start_data_transfer('download', [(local_paths[0], Scalitypath) for Scalitypath in scality_paths],
+                                 sync=self.CB_sync.isChecked(), dry_run=self.CB_dry_run.isChecked())
+
+    def start_data_transfer(self, updown, items, refresh_index=None, priority=0, sync=False, dry_run=False,
+                            pack=False):
+        """ Queue a transfer in the scheduler, it starts when there is room
+            With TRANSFER_BATCH = 'Y' the selected items are copied by one s5cmd run command,
+            otherwise every item is a separate job.
+        Args:
+            updown : str
+                upload or download
+            items : list
+                (local_path, scality_path) of the selected files or folders
+            refresh_index : QPersistentModelIndex
+                folder in the scality tree to refresh when finished, optional
+            priority : int
+                jobs with a higher priority start first
+            sync : bool
+                only copy the files that are new or changed at the destination
+            dry_run : bool
+                only report what would be copied
+            pack : bool
+                upload the small files in tar shards with an index, downloads restore them automatically
+        """
+        if getenv('TRANSFER_BATCH', 'Y').upper() == 'Y':
+            self.transfer_scheduler.submit(updown, items, priority, refresh_index, sync, dry_run, pack)
+        else:
+            for item in items:
+                self.transfer_scheduler.submit(updown, [item], priority, refresh_index, sync, dry_run, pack)
+        # Transfers can be queued while others run, the other actions wait
+        self._enable_buttons(False, transfers=True)
+        # Do not compete with s5cmd for bandwidth
+        self.scality_model.pause_background()
+
+    def resume_transfers(self):
+        """ Resume the transfers that were interrupted, their journals skip the files copied before """
+        unfinished = TransferJournal.unfinished()
+        if len(unfinished) == 0:
+            return
+        names = "\n".join(f"{updown} {items[0][0]}: {completed} files done" for updown, items, _, _, completed
+                          in unfinished[:10])
+        if not self.pop_up(f"{len(unfinished)} transfers were interrupted, resume them?\n{names}"):
+            for updown, items, _, _, _ in unfinished:
+                TransferJournal(updown, items).remove()
+            return
+        for updown, items, sync, packed, _ in unfinished:
+            # The journal holds (source, destination), the scheduler (local_path, scality_path)
+            if updown == 'upload':
+                job_items = [(Path(source), ScalityPath(self.data_operations, destination))
+                             for source, destination in items]
+            else:
+                job_items = [(Path(destination), ScalityPath(self.data_operations, source))
+                             for source, destination in items]
+            # One job as before, so it finds its journal, and before the new transfers
+            self.transfer_scheduler.submit(updown, job_items, priority=1, sync=sync, pack=packed)
+        self._enable_buttons(False, transfers=True)
+        self.scality_model.pause_background()
+
+    def finish_data_transfer(self, job, success):
+        """ Finish an up/download, uploads refresh their folder in the scality tree """
+        self.update_progress_bar()
+        index = job.refresh_index
+        if index is not None and index.isValid():
+            self.scality_model.refresh_subtree(self.scality_model.index(index.row(), index.column(), index.parent()))
+
+    def finish_all_transfers(self):
+        """ All queued transfers finished """
+        self._enable_buttons(True)
+        self.scality_model.resume_background()
+        if self.close_deadline is not None:
+            self.close()
+
+    def closeEvent(self, event):
+        """ Stop the transfers before closing, otherwise their s5cmd processes keep running """
+        if not self.transfer_scheduler.is_busy() or \
+                (self.close_deadline is not None and time.monotonic() >= self.close_deadline):
+            event.accept()
+            return
+        event.ignore()
+        if self.close_deadline is not None:
+            return
+        if not self.pop_up("Transfers are still running, stop them and close?"):
+            return
+        self.TB_status.append("Stopping the transfers, the window closes when they stopped")
+        self.transfer_scheduler.stop_all()
+        # s5cmd is killed after TERMINATE_GRACE seconds, a job that is e.g. still scanning is not waited for
+        grace = TERMINATE_GRACE + 5
+        self.close_deadline = time.monotonic() + grace
+        QTimer.singleShot(grace * 1000, self.close)
 
     def _gather_info_for_transfer(self):
         """ Retrieve the paths for the transfer
@@ -219,7 +345,9 @@ class mainmenu(QtWidgets.QMainWindow, gui.MainWindow.Ui_MainWindow):
             scality_paths : list
                 list of Scality paths
         """
-        self.TB_status.clear()
+        # Keep the messages of running transfers
+        if not self.transfer_scheduler.is_busy():
+            self.TB_status.clear()
         # Retrieve local fs path
         local_paths = []
         for fs_index in self.local_fs_tree.selectedIndexes():
@@ -231,7 +359,8 @@ class mainmenu(QtWidgets.QMainWindow, gui.MainWindow.Ui_MainWindow):
 
         # Retrieve scality path
         scality_paths = []
-        for scality_index in self.scality_fs_tree.selectedIndexes():
+        # One index per row, the size and object count columns are selected as well
+        for scality_index in self.scality_fs_tree.selectionModel().selectedRows():
             tree_item_data = self.scality_model.path_from_tree_index(scality_index)
 
             scality_paths.append(ScalityPath.from_tree_item(self.data_operations, tree_item_data))
@@ -243,6 +372,8 @@ class mainmenu(QtWidgets.QMainWindow, gui.MainWindow.Ui_MainWindow):
 
 
 if __name__ == "__main__":
+    # The transfer verification hashes in a process pool, also from the executable
+    freeze_support()
     # Load env file
     load_dotenv()
     # Setup logger
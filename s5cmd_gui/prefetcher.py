@@ -0,0 +1,96 @@
+"""Speculative prefetching of Scality folders.
+The first page of folders that appear in the tree is listed in the background,
+so expanding them is served from memory instead of waiting for Scality.
+"""
+import time
+from collections import OrderedDict
+from os import getenv
+from threading import Event
+
+from background_queue import BackgroundQueue
+
+
+class ScalityPrefetcher(BackgroundQueue):
+    """ Bounded, cancellable queue of folders whose first page is listed ahead of time """
+
+    def __init__(self, lister, listing_cache, max_workers: int = None, max_queue: int = 200, max_pages: int = 500):
+        """
+        Args:
+            lister : ScalityLister
+                used to list the pages
+            listing_cache : ListingCache
+                prefetched pages are stored in the cache, fresh cached folders are skipped
+            max_workers : int
+                number of concurrent listings, defaults to PREFETCH_WORKERS or 2
+            max_queue : int
+                number of queued folders, the oldest are dropped first
+            max_pages : int
+                number of prefetched pages kept in memory
+        """
+        if max_workers is None:
+            max_workers = int(getenv('PREFETCH_WORKERS', 2))
+        super().__init__(max_workers, max_queue, 'scality_prefetcher')
+        self.enabled = getenv('PREFETCH', 'Y').upper() == 'Y'
+        self.lister = lister
+        self.listing_cache = listing_cache
+        self.max_pages = max_pages
+        # prefix: (rows, next_token, truncated, listed_at)
+        self.pages = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def enqueue(self, folders: list):
+        """ Queue folders to prefetch
+            Args:
+                folders: list
+                    (prefix, level) of each folder
+        """
+        if self.enabled:
+            super().enqueue(folders)
+
+    def skip(self, prefix: str) -> bool:
+        return prefix in self.pages
+
+    def discard(self, prefix: str):
+        """ Forget the prefetched pages below a prefix, e.g. when it is changed by a transfer """
+        with self.lock:
+            for key in [key for key in self.pages if key.startswith(prefix)]:
+                del self.pages[key]
+
+    def take(self, prefix: str):
+        """ Return the prefetched first page of a folder and count the hit
+            Return:
+                None if not prefetched, otherwise:
+                (rows, next_token, truncated)
+        """
+        with self.lock:
+            page = self.pages.pop(prefix, None)
+            if page is not None and self.listing_cache.is_fresh(time.time() - page[3]):
+                self.hits += 1
+                return page[:3]
+        return None
+
+    def record_miss(self):
+        """ Count a first page that had to be listed while the user waited """
+        with self.lock:
+            self.misses += 1
+
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups > 0 else 0.0
+
+    def summary(self) -> str:
+        return f"Prefetch hit rate: {self.hit_rate():.0%} ({self.hits}/{self.hits + self.misses})"
+
+    def process(self, item: tuple, cancelled: Event):
+        """ List the first page, fresh cached folders are served by the listing cache """
+        prefix, level = item
+        cached = self.listing_cache.get(prefix, 0)
+        if cached is not None and self.listing_cache.is_fresh(cached[4]):
+            return
+        rows, next_token, truncated = self.lister.list_page(prefix, level)
+        self.listing_cache.put(prefix, 0, None, rows, next_token, truncated)
+        with self.lock:
+            self.pages[prefix] = (rows, next_token, truncated, time.time())
+            while len(self.pages) > self.max_pages:
+                self.pages.popitem(last=False)
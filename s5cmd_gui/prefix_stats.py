@@ -0,0 +1,80 @@
+"""Background size and object count of Scality folders.
+A folder is listed recursively page by page, the partial totals are emitted after every page.
+"""
+from os import getenv
+from threading import Event
+from PySide6.QtCore import QObject, Signal
+
+from background_queue import BackgroundQueue
+
+
+class PrefixStatsSignals(QObject):
+    """ Signals of the aggregator, emitted from the worker threads """
+    # node, size in bytes, number of objects, True when the totals are complete
+    stats_updated = Signal(object, object, object, bool)
+
+
+class PrefixStatsAggregator(BackgroundQueue):
+    """ Computes the total size and number of objects below prefixes, the results are cached per prefix """
+
+    def __init__(self, s3, bucket_name: str, listing_cache, max_workers: int = None, max_queue: int = 200):
+        """
+        Args:
+            s3 : boto3 S3 client
+                the client is thread-safe and shared by the workers
+            bucket_name : str
+                name of the bucket
+            listing_cache : ListingCache
+                the complete totals are stored in the cache
+            max_workers : int
+                number of folders counted concurrently, defaults to STATS_WORKERS or 2
+            max_queue : int
+                number of queued folders, the oldest are dropped first
+        """
+        if max_workers is None:
+            max_workers = int(getenv('STATS_WORKERS', 2))
+        super().__init__(max_workers, max_queue, 'prefix_stats')
+        self.signals = PrefixStatsSignals()
+        self.enabled = getenv('FOLDER_STATS', 'Y').upper() == 'Y'
+        self.s3 = s3
+        self.bucket_name = bucket_name
+        self.listing_cache = listing_cache
+
+    def request(self, nodes: list):
+        """ Emit the totals of folders, cached totals are emitted immediately and recomputed when stale
+            Args:
+                nodes: list
+                    folder nodes of the tree, their path is the prefix
+        """
+        if not self.enabled:
+            return
+        to_compute = []
+        for node in nodes:
+            # The bucket is too large to list for a total
+            if node.path == '':
+                continue
+            cached = self.listing_cache.get_stats(node.path)
+            if cached is not None:
+                size, objects, age = cached
+                self.signals.stats_updated.emit(node, size, objects, True)
+                if self.listing_cache.is_fresh(age):
+                    continue
+            to_compute.append((node.path, node))
+        self.enqueue(to_compute)
+
+    def process(self, item: tuple, cancelled: Event):
+        """ List all objects below the prefix and emit the running totals """
+        prefix, node = item
+        size = 0
+        objects = 0
+        paginator = self.s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=prefix):
+            if cancelled.is_set():
+                return
+            contents = page.get('Contents', [])
+            size += sum(obj['Size'] for obj in contents)
+            objects += len(contents)
+            if page.get('IsTruncated', False):
+                self.signals.stats_updated.emit(node, size, objects, False)
+        self.listing_cache.put_stats(prefix, size, objects)
+        self.signals.stats_updated.emit(node, size, objects, True)
@@ -0,0 +1,121 @@
+"""Process-wide factory of pooled S3 clients.
+One client is created per profile and endpoint and shared by all components, boto3 clients are thread-safe.
+Back-to-back transfers reuse the session, credentials and open connections of the pool.
+"""
+import logging
+from os import getenv
+from threading import Lock
+
+import boto3
+from botocore.config import Config
+
+_lock = Lock()
+# (profile, endpoint): client
+_clients = {}
+# (profile, endpoint, bucket) of the buckets that were found
+_known_buckets = set()
+_counters = {'clients_created': 0, 'clients_reused': 0, 'requests_sent': 0}
+
+
+def _count_request(**kwargs):
+    """ Event handler, called by botocore before every HTTP request """
+    with _lock:
+        _counters['requests_sent'] += 1
+
+
+def client_config() -> Config:
+    """ Connection pool, keep-alive and retry settings of the clients """
+    return Config(max_pool_connections=int(getenv('S3_MAX_POOL_CONNECTIONS', 50)),
+                  tcp_keepalive=True,
+                  retries={'max_attempts': int(getenv('S3_MAX_ATTEMPTS', 5)), 'mode': 'adaptive'})
+
+
+def _client_key(profile: str, endpoint_url: str) -> tuple:
+    if profile is None:
+        profile = getenv('AWS_PROFILE')
+    if endpoint_url is None:
+        endpoint_url = getenv('ENDPOINT')
+    return profile, endpoint_url
+
+
+def get_s3_client(profile: str = None, endpoint_url: str = None):
+    """ Borrow the shared client of a profile and endpoint, it is created on first use
+        Args:
+            profile: str
+                AWS profile, defaults to AWS_PROFILE
+            endpoint_url: str
+                S3 endpoint, defaults to ENDPOINT
+        Return:
+            boto3 S3 client
+    """
+    key = _client_key(profile, endpoint_url)
+    profile, endpoint_url = key
+    with _lock:
+        client = _clients.get(key)
+        if client is not None:
+            _counters['clients_reused'] += 1
+            return client
+        session = boto3.Session(profile_name=profile)
+        client = session.client('s3', endpoint_url=endpoint_url, config=client_config())
+        client.meta.events.register('before-send.s3', _count_request)
+        _clients[key] = client
+        _counters['clients_created'] += 1
+        logging.info("Created S3 client for profile {} and endpoint {}".format(profile, endpoint_url))
+        return client
+
+
+def bucket_exists(bucket_name: str, profile: str = None, endpoint_url: str = None) -> bool:
+    """ Check if a bucket exists, found buckets are remembered for the lifetime of the process
+        Args:
+            bucket_name: str
+                name of the bucket
+            profile: str
+                AWS profile, defaults to AWS_PROFILE
+            endpoint_url: str
+                S3 endpoint, defaults to ENDPOINT
+    """
+    key = _client_key(profile, endpoint_url) + (bucket_name,)
+    if key in _known_buckets:
+        return True
+    response = get_s3_client(profile, endpoint_url).list_buckets()
+    for bucket in response['Buckets']:
+        if bucket['Name'] == bucket_name:
+            _known_buckets.add(key)
+            return True
+    return False
+
+
+def _pool_stats(client) -> tuple:
+    """ (connections opened, requests sent) of the connection pools of a client, pools evicted by the pool
+        manager are not counted
+    """
+    manager = getattr(getattr(client._endpoint, 'http_session', None), '_manager', None)
+    if manager is None:
+        return 0, 0
+    opened = sent = 0
+    for pool_key in manager.pools.keys():
+        pool = manager.pools.get(pool_key)
+        if pool is not None:
+            opened += pool.num_connections
+            sent += pool.num_requests
+    return opened, sent
+
+
+def client_stats() -> dict:
+    """ Counters to confirm the clients and their connections are reused """
+    with _lock:
+        stats = dict(_counters, clients=len(_clients))
+        clients = list(_clients.values())
+    pools = [_pool_stats(client) for client in clients]
+    stats['connections_created'] = sum(opened for opened, _ in pools)
+    # Each request without a new connection took an idle one from the pool
+    stats['connections_reused'] = sum(max(sent - opened, 0) for opened, sent in pools)
+    return stats
+
+
+def stats_summary() -> str:
+    """ The counters for the logs """
+    stats = client_stats()
+    return "S3 clients: {} created, {} reused, {} requests sent over {} new and {} reused connections".format(
+        stats['clients_created'], stats['clients_reused'], stats['requests_sent'], stats['connections_created'],
+        stats['connections_reused'])
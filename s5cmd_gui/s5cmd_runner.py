@@ -1,12 +1,230 @@
 """Custom version of https://pypi.org/project/s5cmdpy/
 Unfortunately their implementation does not accept additional parameters
+The output of all s5cmd processes is read on one shared asyncio event loop, the transfer thread of a job
+consumes its parsed records.
 """
+import asyncio
+import json
 import logging
 import requests
+import shlex
 import subprocess
+import time
 from os import access, getenv, X_OK
 from platform import machine, system
 from pathlib import Path
+from queue import Full, Queue
+from tempfile import NamedTemporaryFile
+from threading import Event, Lock, Thread
+
+from utils import get_cachefolder
+
+READ_SIZE = 2 ** 16
+# Lines buffered per process, a full buffer makes s5cmd wait for the reader
+LINE_BUFFER = 10000
+# Seconds between the checks of the stop event while the process is silent
+STOP_POLL = 0.25
+# Seconds a terminated process gets to exit before it is killed
+TERMINATE_GRACE = 10
+
+_loop = None
+_loop_lock = Lock()
+
+
+class S5CmdRecord:
+    """ Result of one operation, parsed from the --json output of s5cmd """
+    __slots__ = ('operation', 'source', 'destination', 'size', 'error')
+
+    def __init__(self, operation: str, source: str, destination: str, size: int, error: str = None):
+        self.operation = operation
+        self.source = source
+        self.destination = destination
+        self.size = size
+        self.error = error
+
+    @classmethod
+    def from_line(cls, line: str):
+        """ Parse a line of output, other lines than json records (e.g. warnings) are returned as error
+            when they contain ERROR and None otherwise """
+        line = line.strip()
+        if not line.startswith('{'):
+            if 'ERROR' in line:
+                return cls('', '', '', 0, line)
+            return None
+        try:
+            record = json.loads(line)
+        except ValueError:
+            return cls('', '', '', 0, line)
+        return cls._from_json(record, line)
+
+    @classmethod
+    def from_bytes(cls, line: bytes):
+        """ Parse a line of output as bytes, see from_line, only the lines that are no json record are decoded """
+        line = line.strip()
+        if not line.startswith(b'{'):
+            return cls.from_line(line.decode('utf-8', errors='replace'))
+        try:
+            record = json.loads(line)
+        except ValueError:
+            return cls('', '', '', 0, line.decode('utf-8', errors='replace'))
+        return cls._from_json(record, line)
+
+    @classmethod
+    def _from_json(cls, record: dict, line: str | bytes):
+        error = record.get('error')
+        if error is None and not record.get('success', True):
+            error = line if isinstance(line, str) else line.decode('utf-8', errors='replace')
+        size = (record.get('object') or {}).get('size') or 0
+        return cls(record.get('operation', ''), record.get('source', ''), record.get('destination', ''),
+                   size, error)
+
+
+def get_loop() -> asyncio.AbstractEventLoop:
+    """ The event loop of all s5cmd processes, started in a daemon thread on first use """
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            Thread(target=_loop.run_forever, name='s5cmd_loop', daemon=True).start()
+    return _loop
+
+
+async def _read_lines(stream: asyncio.StreamReader, lines: asyncio.Queue):
+    """ Split a stream in lines, the end of the stream is marked with None """
+    pending = b''
+    try:
+        while chunk := await stream.read(READ_SIZE):
+            *complete, pending = (pending + chunk).split(b'\n')
+            for line in complete:
+                await lines.put(line)
+    except (OSError, ValueError) as e:
+        logging.warning("Could not read the s5cmd output: {}".format(e))
+    if pending:
+        await lines.put(pending)
+    await lines.put(None)
+
+
+class S5CmdProcess:
+    """ An s5cmd process of which the records are read asynchronously """
+
+    def __init__(self, command: list, stop_event: Event = None, idle_timeout: float = None):
+        """
+        Args:
+            command : list
+                s5cmd with its arguments, see S5CmdRunner._generate_cmd
+            stop_event : Event
+                terminates the process when set, optional
+            idle_timeout : float
+                seconds without output after which the process is terminated,
+                defaults to S5CMD_IDLE_TIMEOUT or 0 for no timeout
+        """
+        self.command = command
+        self.stop_event = stop_event
+        if idle_timeout is None:
+            idle_timeout = float(getenv('S5CMD_IDLE_TIMEOUT', 0))
+        self.idle_timeout = idle_timeout
+        self.process = None
+        self.returncode = None
+
+    def _stop_reason(self, last_output: float):
+        if self.stop_event is not None and self.stop_event.is_set():
+            return 'stopped'
+        if self.idle_timeout > 0 and time.monotonic() - last_output > self.idle_timeout:
+            return f'no output for {self.idle_timeout:.0f} seconds'
+        return None
+
+    async def records(self):
+        """ Start the process and yield an S5CmdRecord per result line of stdout and stderr """
+        self.process = await asyncio.create_subprocess_exec(*self.command, stdout=subprocess.PIPE,
+                                                            stderr=subprocess.PIPE)
+        lines = asyncio.Queue(maxsize=LINE_BUFFER)
+        readers = [asyncio.create_task(_read_lines(stream, lines))
+                   for stream in (self.process.stdout, self.process.stderr)]
+        open_streams = len(readers)
+        last_output = time.monotonic()
+        try:
+            while open_streams > 0:
+                try:
+                    # A timeout per line is expensive, it is only needed when the process is silent
+                    line = lines.get_nowait() if not lines.empty() else \
+                        await asyncio.wait_for(lines.get(), timeout=STOP_POLL)
+                except asyncio.TimeoutError:
+                    line = b''
+                else:
+                    if line is None:
+                        open_streams -= 1
+                        continue
+                    last_output = time.monotonic()
+                reason = self._stop_reason(last_output)
+                if reason is not None:
+                    yield S5CmdRecord('', '', '', 0, f'ERROR s5cmd {reason}')
+                    await self.terminate()
+                    break
+                record = S5CmdRecord.from_bytes(line) if line else None
+                if record is not None:
+                    yield record
+            # The output ends just before the process exits
+            await self.process.wait()
+        finally:
+            for reader in readers:
+                reader.cancel()
+            if self.process.returncode is None:
+                await self.terminate()
+            self.returncode = self.process.returncode
+
+    async def terminate(self):
+        """ Ask the process to stop, it is killed when it does not exit within TERMINATE_GRACE seconds """
+        if self.process is None or self.process.returncode is not None:
+            return
+        try:
+            self.process.terminate()
+            await asyncio.wait_for(self.process.wait(), timeout=TERMINATE_GRACE)
+        except asyncio.TimeoutError:
+            logging.warning("s5cmd did not stop, killing it")
+            self.process.kill()
+            await self.process.wait()
+        except ProcessLookupError:
+            # It exited in the meantime
+            await self.process.wait()
+
+
+class S5CmdJob:
+    """ Runs an S5CmdProcess on the shared event loop for a thread that consumes its records,
+        iterate over the job for the records and wait for the exit code like for a Popen """
+
+    def __init__(self, process: S5CmdProcess):
+        self.process = process
+        # Bounded, a slow consumer stops the reading of the process and s5cmd waits for it
+        self.queue = Queue(maxsize=LINE_BUFFER)
+        self.future = asyncio.run_coroutine_threadsafe(self._pump(), get_loop())
+
+    async def _put(self, record):
+        """ Hand a record to the consumer, a full queue is waited for off the loop so other jobs keep running """
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            await asyncio.to_thread(self.queue.put, record)
+
+    async def _pump(self):
+        try:
+            async for record in self.process.records():
+                await self._put(record)
+        except Exception as e:
+            await self._put(S5CmdRecord('', '', '', 0, f'ERROR could not run s5cmd: {e}'))
+        finally:
+            await self._put(None)
+
+    def __iter__(self):
+        while (record := self.queue.get()) is not None:
+            yield record
+
+    def wait(self) -> int:
+        """ Wait for the process to end
+            Return:
+                the exit code, -1 if it could not be started
+        """
+        self.future.result()
+        return self.process.returncode if self.process.returncode is not None else -1
 
 
 class S5CmdRunner:
@@ -63,6 +281,23 @@ class S5CmdRunner:
             logging.error("Failed to download s5cmd: {},\
                            download it manually from: https://github.com/peak/s5cmd/releases".format(e))
 
+    @staticmethod
+    def records(process):
+        """ Parse the output of a process started with capture_output
+            Args:
+                process: subprocess.Popen | S5CmdJob
+                    the s5cmd process
+            Yields:
+                S5CmdRecord per result line
+        """
+        if isinstance(process, S5CmdJob):
+            yield from process
+            return
+        for line in process.stdout:
+            record = S5CmdRecord.from_line(line)
+            if record is not None:
+                yield record
+
     def _call_function(self, command: list, capture_output: bool =False):
         """ Call the s5cmds
         Args:
@@ -86,7 +321,8 @@ class S5CmdRunner:
             result = subprocess.run(command)
             return result
 
-    def _generate_cmd(self, command: str, source: str, destination: str):
+    def _generate_cmd(self, command: str, source: str, destination: str = None, numworkers: int = None,
+                      options: list = None):
         """ Generate the s5cmd with arguments
         
             Args:
@@ -95,7 +331,11 @@ class S5CmdRunner:
                 source: str
                     source path
                 destination: str
-                    destination path
+                    destination path, omitted when None (e.g. for run)
+                numworkers: int
+                    size of the s5cmd worker pool, defaults to AWS_WORKERS
+                options: list
+                    arguments of the command, e.g. --concurrency of cp
             Returns:
                 s5cmd_with_params: list
                     command with arguments
@@ -107,6 +347,8 @@ class S5CmdRunner:
             logging.error(f"Incomplete environment: ENDPOINT = \
                           {endpoint}, AWS_PROFILE = {profile}, AWS_WORKERS = {workers}")
             exit(1)
+        if numworkers is not None:
+            workers = str(numworkers)
 
         s5cmd_with_params = [
             self.s5cmd_path,
@@ -116,13 +358,18 @@ class S5CmdRunner:
             profile,
             '--numworkers',
             workers,
+            # One json record per copied file, see S5CmdRecord
+            '--json',
             command,
-            source,
-            destination
+            *(options or []),
+            source
         ]
+        if destination is not None:
+            s5cmd_with_params.append(destination)
         return s5cmd_with_params
 
-    def cp(self, source: str, destination: str, simplified_print: bool = True):
+    def cp(self, source: str, destination: str, simplified_print: bool = True, numworkers: int = None,
+           options: list = None):
         """ Copy a file or folder from/to S3
         Args:
             source: str
@@ -131,10 +378,14 @@ class S5CmdRunner:
                 destination path, can be a file or folder
             simplified_print:
                 return the status or not
+            numworkers: int
+                size of the s5cmd worker pool, defaults to AWS_WORKERS
+            options: list
+                cp arguments, e.g. ['--concurrency', '10']
         Returns:
             the process to monitor the status
         """
-        command = self._generate_cmd('cp', source, destination)
+        command = self._generate_cmd('cp', source, destination, numworkers, options)
         process = self._call_function(command, capture_output=simplified_print)
         if simplified_print and process and process.stdout:
             # Assuming we don't parse txt_uri to count commands, we leave total=None for an indeterminate progress bar
@@ -142,6 +393,75 @@ class S5CmdRunner:
         else:
             return None
 
+    def cp_job(self, source: str, destination: str, numworkers: int = None, options: list = None,
+               stop_event: Event = None) -> S5CmdJob:
+        """ Copy like cp, in a job on the shared event loop
+        Args:
+            source: str
+                source path, can be a file or folder
+            destination: str
+                destination path, can be a file or folder
+            numworkers: int
+                size of the s5cmd worker pool, defaults to AWS_WORKERS
+            options: list
+                cp arguments, e.g. ['--concurrency', '10']
+            stop_event: Event
+                terminates s5cmd when set, optional
+        Returns:
+            the job to monitor the status
+        """
+        command = self._generate_cmd('cp', source, destination, numworkers, options)
+        return S5CmdJob(S5CmdProcess(command, stop_event))
+
+    def run_job(self, command_file: Path, numworkers: int = None, stop_event: Event = None) -> S5CmdJob:
+        """ Run a command file like run, in a job on the shared event loop
+        Args:
+            command_file: Path
+                file with one command per line, see write_command_file
+            numworkers: int
+                size of the s5cmd worker pool, defaults to AWS_WORKERS
+            stop_event: Event
+                terminates s5cmd when set, optional
+        Returns:
+            the job to monitor the status
+        """
+        command = self._generate_cmd('run', str(command_file), numworkers=numworkers)
+        return S5CmdJob(S5CmdProcess(command, stop_event))
+
+    @staticmethod
+    def write_command_file(commands: list) -> Path:
+        """ Write commands for s5cmd run, the arguments are quoted
+        Args:
+            commands: list
+                tuples of the command and its arguments, e.g. ('cp', source, destination)
+        Returns:
+            path of the command file in the cache folder, removed by the caller
+        """
+        with NamedTemporaryFile('w', suffix='.txt', prefix='s5cmd_run_', dir=get_cachefolder(),
+                                delete=False, encoding='utf-8') as command_file:
+            for command in commands:
+                command_file.write(' '.join(shlex.quote(str(argument)) for argument in command) + '\n')
+        return Path(command_file.name)
+
+    def run(self, command_file: Path, simplified_print: bool = True, numworkers: int = None):
+        """ Run the commands of a command file in one s5cmd process, the workers are shared by all commands
+        Args:
+            command_file: Path
+                file with one command per line, see write_command_file
+            simplified_print:
+                return the status or not
+            numworkers: int
+                size of the s5cmd worker pool, defaults to AWS_WORKERS
+        Returns:
+            the process to monitor the status
+        """
+        command = self._generate_cmd('run', str(command_file), numworkers=numworkers)
+        process = self._call_function(command, capture_output=simplified_print)
+        if simplified_print and process and process.stdout:
+            return process
+        else:
+            return None
+
     def sync(self,  source: str, destination: str, simplified_print: bool = True):
         """ Sync a file or folder from/to S3
         Args:
@@ -177,18 +497,21 @@ if __name__ == "__main__":
     start_time = last_report_time = datetime.now()
     logging.info(f'starting transfer: {start_time}')
     processed_files = 0
+    processed_bytes = 0
     error_list = []
-    while process is not None and process.poll() is None:
-        for line in process.stdout:
+    if process is not None:
+        for record in runner.records(process):
+            if record.error is not None:
+                logging.error('Error during upload: {}'.format(record.error))
+                error_list.append(record.error)
+                continue
             processed_files += 1
+            processed_bytes += record.size
             current_time = datetime.now()
-            # Update progress bar if report_interval has passed or process completes
-            if current_time - last_report_time >= timedelta(seconds=1) or process.poll() is not None:
-                logging.info(processed_files)
+            if current_time - last_report_time >= timedelta(seconds=1):
+                logging.info(f'{processed_files} files, {processed_bytes} bytes')
                 last_report_time = current_time
-            if 'ERROR' in line:
-                logging.error('Error during upload: {}'.format(line))
-                error_list.append(line)
+        process.wait()
     exit_code = process.poll()
     logging.info(f'finished transfer: {datetime.now()}, it took: {datetime.now() - start_time}')
     if exit_code != 0 or len(error_list) > 0:
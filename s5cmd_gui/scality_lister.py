@@ -0,0 +1,170 @@
+"""Background listing of Scality prefixes for the tree model.
+The pages are listed in worker threads and handed back to the UI thread through queued signals.
+"""
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from os import getenv
+from threading import Event
+from PySide6.QtCore import QObject, Signal
+
+# Number of keys requested per list_objects_v2 call
+PAGE_SIZE = 1000
+
+
+class ListingRequest:
+    """ Request to list one page of a prefix, the node is only used by the receiver of the result. """
+
+    def __init__(self, node, prefix: str, level: int, continuation_token: str = None, page: int = 0,
+                 cached_rows: list = None, refresh: bool = False, until_path: str = None):
+        """
+        Args:
+            node : object
+                tree node the page belongs to
+            prefix : str
+                prefix (folder) to list
+            level : int
+                level of the prefix in the tree
+            continuation_token : str
+                token of the page, None for the first page
+            page : int
+                page number, starting at 0
+            cached_rows : list
+                rows shown from the listing cache, the request revalidates them
+            refresh : bool
+                list all pages from the first page until the page containing until_path
+            until_path : str
+                last path shown in the tree, None to list all pages
+        """
+        self.node = node
+        self.prefix = prefix
+        self.level = level
+        self.continuation_token = continuation_token
+        self.page = page
+        self.cached_rows = cached_rows
+        self.refresh = refresh
+        self.until_path = until_path
+        # Number of pages listed by a refresh
+        self.pages_listed = 0
+        self._cancelled = Event()
+
+    def cancel(self):
+        """ Cancel the request, a cancelled request is not listed and its result is not emitted. """
+        self._cancelled.set()
+
+    def is_cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+
+class ScalityLister(QObject):
+    """ Lists pages of Scality prefixes in a thread pool, results are emitted as signals.
+    Signals emitted from the worker threads are queued to the thread of the receiving model. """
+    # request, rows, next continuation token, truncated
+    page_listed = Signal(object, list, object, bool)
+    # request, error message
+    listing_failed = Signal(object, str)
+
+    def __init__(self, s3, bucket_name: str, listing_cache=None, max_workers: int = None):
+        """
+        Args:
+            s3 : boto3 S3 client
+                the client is thread-safe and shared by the workers
+            bucket_name : str
+                name of the bucket
+            listing_cache : ListingCache
+                listed pages are stored in the cache, optional
+            max_workers : int
+                number of concurrent listings, defaults to LISTING_WORKERS or 4
+        """
+        super().__init__()
+        self.s3 = s3
+        self.bucket_name = bucket_name
+        self.listing_cache = listing_cache
+        if max_workers is None:
+            max_workers = int(getenv('LISTING_WORKERS', 4))
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='scality_lister')
+
+    def submit(self, request: ListingRequest):
+        """ List the page in the background, the result is emitted by page_listed or listing_failed. """
+        self.executor.submit(self._run, request)
+
+    def _run(self, request: ListingRequest):
+        """ Worker thread """
+        if request.is_cancelled():
+            return
+        try:
+            if request.refresh:
+                rows, next_token, truncated = self._list_range(request)
+            else:
+                rows, next_token, truncated = self.list_page(request.prefix, request.level, request.continuation_token)
+                if self.listing_cache is not None:
+                    self.listing_cache.put(request.prefix, request.page, request.continuation_token,
+                                           rows, next_token, truncated)
+        except Exception as e:
+            logging.warning("Failed to list {} in bucket {}: {}".format(request.prefix, self.bucket_name, e))
+            if not request.is_cancelled():
+                self.listing_failed.emit(request, str(e))
+            return
+        if not request.is_cancelled():
+            self.page_listed.emit(request, rows, next_token, truncated)
+
+    def _list_range(self, request: ListingRequest):
+        """ List the pages of a refresh, see list_page for the return values """
+        rows = []
+        next_token = None
+        truncated = True
+        while truncated and not request.is_cancelled():
+            token = next_token
+            page_rows, next_token, truncated = self.list_page(request.prefix, request.level, token)
+            if self.listing_cache is not None:
+                self.listing_cache.put(request.prefix, request.pages_listed, token, page_rows, next_token, truncated)
+            request.pages_listed += 1
+            rows.extend(page_rows)
+            if request.until_path is not None and len(page_rows) > 0 and page_rows[-1][3] >= request.until_path:
+                break
+        return rows, next_token, truncated
+
+    def list_page(self, prefix: str, level: int, continuation_token: str = None):
+        """ List one page of a folder.
+
+        Args:
+            prefix : str
+                folder to list
+            level : int
+                level of the folder in the tree
+            continuation_token : str
+                token of the page, None for the first page
+        Return:
+            rows : list
+                children as [display_name, level, 'F/f', absolute Path, size], sorted on path
+            continuation_token : str
+                token of the next page
+            truncated : bool
+                True if there are more pages
+        """
+        kwargs = {'Bucket': self.bucket_name, 'Prefix': prefix, 'Delimiter': '/', 'MaxKeys': PAGE_SIZE}
+        if continuation_token:
+            kwargs['ContinuationToken'] = continuation_token
+        response = self.s3.list_objects_v2(**kwargs)
+        rows = self.rows_from_response(response, prefix, level)
+        return rows, response.get('NextContinuationToken'), response.get('IsTruncated', False)
+
+    @staticmethod
+    def rows_from_response(response: dict, prefix: str, level: int) -> list:
+        """ Convert a list_objects_v2 response to tree rows.
+            Folders and objects are merged on path, the order in which S3 returns the keys.
+        """
+        rows = []
+        for common_prefix in response.get('CommonPrefixes', []):
+            folder = common_prefix['Prefix']
+            rows.append([folder.removeprefix(prefix).rstrip('/'), level + 1, 'F', folder, None])
+        for obj in response.get('Contents', []):
+            # Skip the folder marker object of the prefix itself
+            if obj['Key'] == prefix:
+                continue
+            rows.append([obj['Key'].removeprefix(prefix), level + 1, 'f', obj['Key'], obj['Size']])
+        rows.sort(key=lambda row: row[3])
+        return rows
+
+    def shutdown(self):
+        """ Stop the workers, pending requests are dropped. """
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -1,17 +1,89 @@
 """Tree model for Scality collections.
+The folders are listed lazily, one page (MaxKeys) at a time, through canFetchMore/fetchMore.
+The listing runs in the background, see scality_lister, and is cached on disk, see listing_cache.
+The size and number of objects of the folders are counted in the background, see prefix_stats.
 """
-import concurrent.futures
-from PySide6.QtGui import QStandardItemModel, QStandardItem
+import logging
+from bisect import bisect_left
+from PySide6.QtCore import QAbstractItemModel, QModelIndex, Qt, Signal
 from PySide6.QtWidgets import QFileIconProvider
-from boto3 import Session
 from os import getenv
 
+from listing_cache import ListingCache
+from prefetcher import ScalityPrefetcher
+from prefix_stats import PrefixStatsAggregator
+from scality_lister import ListingRequest, ScalityLister
+from s3_client import get_s3_client
+from utils import size_fmt
 
-class scalityTreeModel(QStandardItemModel):
+LOADING_TEXT = 'loading\u2026'
+# Fetch the next page when the view is this close to the last loaded row
+FETCH_MARGIN = 50
+COLUMNS = ['Name', 'Level', 'Ff', 'Path', 'Size', 'Objects']
+SIZE_COLUMN = 4
+OBJECTS_COLUMN = 5
+
+
+class ScalityNode:
+    """ File or folder in the Scality tree, the children of a folder are fetched page by page."""
+
+    def __init__(self, name: str, level: int, file_folder: str, path: str, parent=None, size: int = None):
+        """
+        Args:
+            name : str
+                display name
+            level : int
+                level in the tree
+            file_folder : str
+                'F' for folder, 'f' for file
+            path : str
+                full path to the file or folder
+            parent : ScalityNode
+                parent node, None for the invisible root
+            size : int
+                size of a file, folders are counted in the background
+        """
+        self.name = name
+        self.level = level
+        self.file_folder = file_folder
+        self.path = path
+        self.parent = parent
+        self.row = 0
+        self.size = size
+        # Number of objects and whether size and objects are complete, for folders
+        self.objects = None
+        self.stats_complete = file_folder == 'f'
+        self.children = []
+        # Continuation token of the next page, None when no page is fetched yet
+        self.continuation_token = None
+        self.pages_loaded = 0
+        # Files have no children to fetch
+        self.fetched_all = file_folder != 'F'
+        # Listing request in flight, its placeholder is the last child
+        self.request = None
+        self.expanded_before = False
+
+    def is_folder(self) -> bool:
+        return self.file_folder == 'F'
+
+    def is_placeholder(self) -> bool:
+        return self.file_folder == ''
+
+    def item_data(self) -> list:
+        """ Return:
+                [display_name, level, 'F/f', absolute Path]
+        """
+        return [self.name, str(self.level), self.file_folder, self.path]
+
+
+class scalityTreeModel(QAbstractItemModel):
     """ Model for an scality tree view."""
+    _icons = None
+    # Error message of a failed listing
+    listing_failed = Signal(str)
 
     def __init__(self, tree_view):
-        """ Initialise the tree view with the root node and first level.
+        """ Initialise the tree model, the tree is drawn by init_tree.
 
         Args:
             tree_view : PySide6.QtWidgets
@@ -19,111 +91,370 @@ class scalityTreeModel(QStandardItemModel):
         """
         super().__init__()
         self.tree_view = tree_view
-        session = Session(profile_name=getenv('AWS_PROFILE'))
-        self.s3 = session.client('s3', endpoint_url=getenv('ENDPOINT'))
-        # Empty tree
-        self.clear()
-
-    def _tree_row_from_item(self, item: str, prefix: str, level: int, file_folder: str='f'):
-        """ Item is the full path to the file/folder:
-            - test/1/1-20240319-103924-001/20240319-AmbientLightSensor.txt
-            - test/1/1-20240319-103924-001/INS
-
-            Args:
-                item : str
-                    Full path to the file or folder
-                prefix : str
-                    Prefix of the path
-                level : int
-                    Level in the tree
-                file_folder : str
-                    'F' for folder, 'f' for file
+        self.bucket_name = getenv('BUCKETNAME')
+        self.s3 = get_s3_client()
+        self.listing_cache = ListingCache()
+        self.lister = ScalityLister(self.s3, self.bucket_name, self.listing_cache)
+        self.lister.page_listed.connect(self._page_listed)
+        self.lister.listing_failed.connect(self._listing_failed)
+        self.prefetcher = ScalityPrefetcher(self.lister, self.listing_cache)
+        self.stats = PrefixStatsAggregator(self.s3, self.bucket_name, self.listing_cache)
+        self.stats.signals.stats_updated.connect(self._stats_updated)
+        self.root = ScalityNode('', 0, 'F', '')
+        self.root.fetched_all = True
+        # QTreeView only fetches more for top level items while scrolling, handle the nested folders here.
+        self.tree_view.verticalScrollBar().valueChanged.connect(self._fetch_visible)
+        self.tree_view.expanded.connect(self.expand_subtree)
+        self.tree_view.collapsed.connect(self.collapse_subtree)
+
+    @classmethod
+    def _icon(cls, file_folder: str):
+        """ The icon provider is created once instead of per row. """
+        if cls._icons is None:
+            icon_provider = QFileIconProvider()
+            cls._icons = {'f': icon_provider.icon(QFileIconProvider.IconType.File),
+                          'F': icon_provider.icon(QFileIconProvider.IconType.Folder)}
+        return cls._icons[file_folder]
+
+    def node_from_index(self, model_index: QModelIndex) -> ScalityNode:
+        """ Return the node of an index, the invisible root for an invalid index. """
+        if model_index.isValid():
+            return model_index.internalPointer()
+        return self.root
+
+    def index_from_node(self, node: ScalityNode, column: int = 0) -> QModelIndex:
+        if node is self.root:
+            return QModelIndex()
+        return self.createIndex(node.row, column, node)
+
+    # Qt model interface
+    def index(self, row: int, column: int, parent: QModelIndex = QModelIndex()) -> QModelIndex:
+        parent_node = self.node_from_index(parent)
+        if 0 <= row < len(parent_node.children) and 0 <= column < len(COLUMNS):
+            return self.createIndex(row, column, parent_node.children[row])
+        return QModelIndex()
+
+    def parent(self, model_index: QModelIndex = QModelIndex()) -> QModelIndex:
+        if not model_index.isValid():
+            return QModelIndex()
+        return self.index_from_node(model_index.internalPointer().parent)
+
+    def rowCount(self, parent: QModelIndex = QModelIndex()) -> int:
+        if parent.column() > 0:
+            return 0
+        return len(self.node_from_index(parent).children)
+
+    def columnCount(self, parent: QModelIndex = QModelIndex()) -> int:
+        return len(COLUMNS)
+
+    def hasChildren(self, parent: QModelIndex = QModelIndex()) -> bool:
+        node = self.node_from_index(parent)
+        return len(node.children) > 0 or not node.fetched_all
+
+    def data(self, model_index: QModelIndex, role: int = Qt.ItemDataRole.DisplayRole):
+        if not model_index.isValid():
+            return None
+        node = model_index.internalPointer()
+        column = model_index.column()
+        if role == Qt.ItemDataRole.DisplayRole:
+            if column == SIZE_COLUMN:
+                return self._stats_text(node, None if node.size is None else size_fmt(node.size))
+            if column == OBJECTS_COLUMN:
+                return self._stats_text(node, None if node.objects is None else str(node.objects))
+            return node.item_data()[column]
+        if role == Qt.ItemDataRole.TextAlignmentRole and column in (SIZE_COLUMN, OBJECTS_COLUMN):
+            return Qt.AlignmentFlag.AlignRight | Qt.AlignmentFlag.AlignVCenter
+        if role == Qt.ItemDataRole.DecorationRole and model_index.column() == 0 and not node.is_placeholder():
+            return self._icon(node.file_folder)
+        return None
+
+    @staticmethod
+    def _stats_text(node: ScalityNode, text: str):
+        """ Partial totals of a folder are marked as incomplete """
+        if text is None or node.stats_complete:
+            return text
+        return text + '\u2026'
+
+    def flags(self, model_index: QModelIndex):
+        if model_index.isValid() and model_index.internalPointer().is_placeholder():
+            return Qt.ItemFlag.NoItemFlags
+        return super().flags(model_index)
+
+    def headerData(self, section: int, orientation, role: int = Qt.ItemDataRole.DisplayRole):
+        if orientation == Qt.Orientation.Horizontal and role == Qt.ItemDataRole.DisplayRole:
+            return COLUMNS[section]
+        return None
+
+    def canFetchMore(self, parent: QModelIndex) -> bool:
+        node = self.node_from_index(parent)
+        return not node.fetched_all and node.request is None
+
+    def fetchMore(self, parent: QModelIndex):
+        """ Show the next page of the folder from the cache or request it,
+            a placeholder is shown until a requested page arrives. """
+        node = self.node_from_index(parent)
+        if node.fetched_all or node.request is not None:
+            return
+        if self._fetch_prefetched(node) or self._fetch_cached(node):
+            return
+        if node.pages_loaded == 0:
+            self.prefetcher.record_miss()
+        self._request_page(node)
+
+    def _request_page(self, node: ScalityNode):
+        """ List the next page of the folder, a placeholder is shown until it arrives """
+        node.request = ListingRequest(node, node.path, node.level, node.continuation_token, node.pages_loaded)
+        self._append_rows(node, [[LOADING_TEXT, node.level + 1, '', '', None]])
+        self.lister.submit(node.request)
+
+    def _fetch_prefetched(self, node: ScalityNode) -> bool:
+        """ Append the first page if it was prefetched
+            Return:
+                True if the page was prefetched
         """
-        if item == '.':
-            item = ''
-        icon_provider = QFileIconProvider()
-        display = QStandardItem(item.removeprefix(prefix).rstrip('/'))
-        if file_folder == 'f':
-            display.setIcon(icon_provider.icon(QFileIconProvider.IconType.File))
-        else:
-            display.setIcon(icon_provider.icon(QFileIconProvider.IconType.Folder))
-        row = [
-            display,  # display name
-            QStandardItem(str(level + 1)),  # item level in the tree
-            QStandardItem(file_folder),  # F (Folder) or f (file)
-            QStandardItem(item),  # full path to the file or folder
-        ]
-        return row
+        if node.pages_loaded > 0:
+            return False
+        page = self.prefetcher.take(node.path)
+        if page is None:
+            return False
+        rows, node.continuation_token, truncated = page
+        node.pages_loaded = 1
+        node.fetched_all = not truncated
+        self._append_rows(node, rows)
+        return True
 
-    def init_tree(self):
-        """ Draw the first levels of an Scality filesystem as a tree.
+    def _fetch_cached(self, node: ScalityNode) -> bool:
+        """ Append the next page from the listing cache, pages older than the TTL are revalidated in the
+            background. Fresh pages cost no request, refreshing the folder lists it again.
+            Return:
+                True if the page was cached
         """
-        self.setRowCount(0)
-        root = self.invisibleRootItem()
+        cached = self.listing_cache.get(node.path, node.pages_loaded)
+        if cached is None:
+            return False
+        rows, token, next_token, truncated, age = cached
+        # Only continue a chain of pages listed together
+        if node.pages_loaded > 0 and token != node.continuation_token:
+            return False
+        if not self.listing_cache.is_fresh(age):
+            self.lister.submit(ListingRequest(node, node.path, node.level, token, node.pages_loaded, rows))
+        node.pages_loaded += 1
+        node.continuation_token = next_token
+        node.fetched_all = not truncated
+        self._append_rows(node, rows)
+        return True
 
-        root_row = self._tree_row_from_item(".", "", 1, 'F')
-        root.appendRow(root_row)
-        new_node = root.child(root.rowCount() - 1)
+    # Listing results, queued from the lister threads
+    def _page_listed(self, request: ListingRequest, rows: list, continuation_token: str, truncated: bool):
+        """ Replace the placeholder of the request by the listed rows """
+        node = request.node
+        if request.cached_rows is not None:
+            self._page_revalidated(request, rows)
+            return
+        if request.is_cancelled() or node.request is not request:
+            return
+        self._end_request(node)
+        if request.refresh:
+            self._update_rows(node, rows)
+            node.pages_loaded = request.pages_listed
+            node.continuation_token = continuation_token
+            node.fetched_all = not truncated
+            return
+        node.pages_loaded += 1
+        node.continuation_token = continuation_token
+        node.fetched_all = not truncated
+        self._append_rows(node, rows)
 
-        # Check if there is something in the bucket
-        response = self.s3.list_objects_v2(Bucket=getenv('BUCKETNAME'), Prefix='')
-        if response['KeyCount'] > 0:
-            # insert a dummy child to get the link to open the collection
-            new_node.appendRow(None)
+    def _page_revalidated(self, request: ListingRequest, rows: list):
+        """ Refresh the folder if the listing changed since it was cached """
+        node = request.node
+        if rows == request.cached_rows or not self._is_attached(node) or node.pages_loaded <= request.page:
+            return
+        logging.info("Cached listing of {} changed, refreshing".format(node.path))
+        self.refresh_subtree(self.index_from_node(node))
 
-    def delete_subtree(self, tree_item):
-        """ Delete subtree.
+    def _is_attached(self, node: ScalityNode) -> bool:
+        """ Check if the node is still part of the tree, removed subtrees are not updated """
+        while node is not self.root:
+            parent = node.parent
+            if parent is None or node.row >= len(parent.children) or parent.children[node.row] is not node:
+                return False
+            node = parent
+        return True
+
+    def _listing_failed(self, request: ListingRequest, msg: str):
+        node = request.node
+        if request.cached_rows is not None:
+            return
+        if request.is_cancelled() or node.request is not request:
+            return
+        self._end_request(node)
+        # Do not retry endlessly, a refresh lists the folder again
+        node.fetched_all = True
+        self.listing_failed.emit(f"Failed to list {node.path or self.bucket_name}: {msg}")
+
+    def _end_request(self, node: ScalityNode):
+        """ Remove the placeholder of the request in flight """
+        node.request = None
+        last = len(node.children) - 1
+        if last >= 0 and node.children[last].is_placeholder():
+            self.beginRemoveRows(self.index_from_node(node), last, last)
+            node.children.pop()
+            self.endRemoveRows()
+
+    def _cancel_requests(self, node: ScalityNode):
+        """ Cancel the requests in flight of the node and its descendants """
+        if node.request is not None:
+            node.request.cancel()
+            self._end_request(node)
+        for child in node.children:
+            if child.is_folder() and (child.children or child.request is not None):
+                self._cancel_requests(child)
+
+    def _append_rows(self, node: ScalityNode, rows: list):
+        """ Append rows as children of the node """
+        if len(rows) == 0:
+            return
+        first = len(node.children)
+        self.beginInsertRows(self.index_from_node(node), first, first + len(rows) - 1)
+        for i, (name, level, file_folder, path, size) in enumerate(rows):
+            child = ScalityNode(name, level, file_folder, path, node, size)
+            child.row = first + i
+            node.children.append(child)
+        self.endInsertRows()
+        self._rows_shown(node.children[first:])
+
+    def _rows_shown(self, nodes: list):
+        """ Queue the new folder rows for prefetching and counting """
+        folders = [child for child in nodes if child.is_folder()]
+        self.prefetcher.enqueue([(child.path, child.level) for child in folders if child.pages_loaded == 0])
+        self.stats.request(folders)
+
+    def _stats_updated(self, node: ScalityNode, size: int, objects: int, complete: bool):
+        """ Show the (partial) totals of a folder, queued from the stats threads """
+        if not self._is_attached(node):
+            return
+        node.size = size
+        node.objects = objects
+        node.stats_complete = complete
+        self.dataChanged.emit(self.index_from_node(node, SIZE_COLUMN), self.index_from_node(node, OBJECTS_COLUMN))
+
+    def pause_background(self):
+        """ Pause prefetching and counting, e.g. during a transfer """
+        self.prefetcher.pause()
+        self.stats.pause()
+
+    def resume_background(self):
+        self.prefetcher.resume()
+        self.stats.resume()
+
+    def _renumber(self, node: ScalityNode, first: int):
+        for row in range(first, len(node.children)):
+            node.children[row].row = row
+
+    def _update_rows(self, node: ScalityNode, rows: list):
+        """ Update the children of the node to the listed rows with the minimal row removals and insertions,
+            the remaining children keep their subtree, expansion and selection.
 
         Args:
-            tree_item : QStandardItem
-                Item in the QTreeView
-        Return:
-            -
+            node : ScalityNode
+                Folder in the tree
+            rows : list
+                children as [display_name, level, 'F/f', absolute Path], sorted on path
         """
-        # Remove all children from tree_item
-        tree_item.removeRows(0, tree_item.rowCount())
+        parent = self.index_from_node(node)
+        new_paths = set(row[3] for row in rows)
+        self._update_sizes(node, rows)
+        # Remove contiguous ranges of children that are gone, from the end to keep the row numbers valid
+        last = len(node.children) - 1
+        removed = False
+        while last >= 0:
+            if node.children[last].path in new_paths:
+                last -= 1
+                continue
+            first = last
+            while first > 0 and node.children[first - 1].path not in new_paths:
+                first -= 1
+            self._cancel_requests_range(node, first, last)
+            self.beginRemoveRows(parent, first, last)
+            del node.children[first:last + 1]
+            self.endRemoveRows()
+            removed = True
+            last = first - 1
+        if removed:
+            self._renumber(node, 0)
+        # Insert contiguous ranges of new rows at their sorted position
+        old_paths = set(child.path for child in node.children)
+        i = 0
+        while i < len(rows):
+            if rows[i][3] in old_paths:
+                i += 1
+                continue
+            start = i
+            while i < len(rows) and rows[i][3] not in old_paths:
+                i += 1
+            first = bisect_left(node.children, rows[start][3], key=lambda child: child.path)
+            self.beginInsertRows(parent, first, first + i - start - 1)
+            node.children[first:first] = [ScalityNode(name, level, file_folder, path, node, size)
+                                          for name, level, file_folder, path, size in rows[start:i]]
+            self._renumber(node, first)
+            self.endInsertRows()
+            self._rows_shown(node.children[first:first + i - start])
+
+    def _update_sizes(self, node: ScalityNode, rows: list):
+        """ Update the size of files that were overwritten """
+        sizes = dict((row[3], row[4]) for row in rows if row[2] == 'f')
+        for child in node.children:
+            if child.file_folder == 'f' and child.path in sizes and sizes[child.path] != child.size:
+                child.size = sizes[child.path]
+                size_index = self.index_from_node(child, SIZE_COLUMN)
+                self.dataChanged.emit(size_index, size_index)
+
+    def _cancel_requests_range(self, node: ScalityNode, first: int, last: int):
+        for child in node.children[first:last + 1]:
+            if child.is_folder():
+                self._cancel_requests(child)
 
-    def add_subtree(self, tree_item, tree_item_data: list):
-        """ Grow tree_view from tree_item.
+    def _fetch_visible(self, *args):
+        """ Fetch the next page of the folder shown at the bottom of the view. """
+        viewport = self.tree_view.viewport()
+        model_index = self.tree_view.indexAt(viewport.rect().bottomLeft())
+        if not model_index.isValid():
+            return
+        parent = model_index.parent()
+        node = self.node_from_index(parent)
+        if not node.fetched_all and model_index.row() >= len(node.children) - FETCH_MARGIN:
+            self.fetchMore(parent)
+
+    def init_tree(self):
+        """ Draw the root of the Scality filesystem, its children are fetched when it is expanded.
+        """
+        self.beginResetModel()
+        self._cancel_requests(self.root)
+        self.root.children = [ScalityNode('', 2, 'F', '', self.root)]
+        self.endResetModel()
+
+    def delete_subtree(self, node: ScalityNode):
+        """ Delete subtree.
 
         Args:
-            tree_item : PyQt6.QtGui.QStandardItem
-                The root of the subtree in the tree view
-            tree_item_data : list
-                [display_name, level, 'F/f', absolute Path]
+            node : ScalityNode
+                Folder in the tree
         Return:
             -
         """
-        _, level, _, abs_path = tree_item_data
-
-        # Assume that tree_item has no children yet.
-        paginator = self.s3.get_paginator('list_objects')
-        result = paginator.paginate(Bucket=getenv('BUCKETNAME'), Prefix=abs_path, Delimiter='/')
-        # Folders
-        for prefix in result.search('CommonPrefixes'):
-            if prefix is None:
-                break
-            else:
-                row = self._tree_row_from_item(prefix.get('Prefix'), abs_path, int(level), 'F')
-                tree_item.appendRow(row)
-                # Insert a dummy child to get the link to open the collection
-                tree_item.child(tree_item.rowCount() - 1).appendRow(None)
-        # Objects
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            futures = []
-            for page in result:
-                if page is not None and 'Contents' in page:
-                    for obj in page['Contents']:
-                        futures.append(executor.submit(self.process_object, obj, abs_path, level, tree_item))
-        # Wait for all operations to complete
-        concurrent.futures.wait(futures)
-
-    def process_object(self, obj, abs_path, level, tree_item):
-        row = self._tree_row_from_item(obj['Key'], abs_path, int(level))
-        tree_item.appendRow(row)
+        self._cancel_requests(node)
+        if len(node.children) > 0:
+            self.beginRemoveRows(self.index_from_node(node), 0, len(node.children) - 1)
+            node.children = []
+            self.endRemoveRows()
+        node.continuation_token = None
+        node.pages_loaded = 0
+        node.fetched_all = not node.is_folder()
 
     def refresh_subtree(self, position):
-        """ Refresh the tree view.
+        """ Refresh a folder in the tree view, the loaded pages are listed again, bypassing the listing cache,
+            and only the rows that changed are inserted or removed.
 
         Args:
             position : PyQt6.QtCore.QModelIndex
@@ -131,20 +462,46 @@ class scalityTreeModel(QStandardItemModel):
         Return:
             -
         """
-        model_index = position
-        # clicked item
-        tree_item = self.itemFromIndex(model_index)
-        parent = tree_item.parent()
-        if parent is None:
-            parent = self.invisibleRootItem()
-        row = tree_item.row()
-        # retrieve information of clicked item, the information is stored in its parent
-        tree_item_data = [parent.child(row, col).data(0) for col in range(parent.columnCount())]
-        # check if folder
-        if tree_item_data[2] == 'F':
-            # Delete subtree in irodsFsdata and the tree_view.
-            self.delete_subtree(tree_item)
-            self.add_subtree(tree_item, tree_item_data)
+        node = self.node_from_index(position)
+        if not node.is_folder() or node is self.root:
+            return
+        self.prefetcher.discard(node.path)
+        # The totals may have changed as well, unchanged totals are taken from the cache
+        self.stats.request([node] + [child for child in node.children if child.is_folder()])
+        # Cancel the listing of a next page, the refresh lists it as well
+        if node.request is not None:
+            node.request.cancel()
+            self._end_request(node)
+        if node.pages_loaded == 0:
+            # Listed again instead of taken from the cache or the prefetcher
+            node.fetched_all = False
+            self._request_page(node)
+            return
+        until_path = None
+        if not node.fetched_all and len(node.children) > 0:
+            until_path = node.children[-1].path
+        node.request = ListingRequest(node, node.path, node.level, refresh=True, until_path=until_path)
+        self.lister.submit(node.request)
+
+    def expand_subtree(self, position):
+        """ The first expansion is fetched by the view, expanding it again refreshes the folder.
+            A listing of the folder that is still in flight is cancelled by the refresh.
+
+        Args:
+            position : PyQt6.QtCore.QModelIndex
+                Location in tree
+        """
+        node = self.node_from_index(position)
+        if not node.expanded_before:
+            node.expanded_before = True
+            return
+        self.refresh_subtree(position)
+
+    def collapse_subtree(self, position):
+        """ Stop prefetching and counting the folders of a collapsed subtree """
+        node = self.node_from_index(position)
+        self.prefetcher.cancel(node.path)
+        self.stats.cancel(node.path)
 
     def path_from_tree_index(self, model_index):
         """ Returns the absolute path to the tree index
@@ -156,11 +513,4 @@ class scalityTreeModel(QStandardItemModel):
             tree_item_data : list
                 [display_name, level, 'F/f', absolute Path]
         """
-        # clicked item
-        tree_item = self.itemFromIndex(model_index)
-        row = tree_item.row()
-
-        parent = tree_item.parent()  # contains the data of tree_item
-        if parent is None:
-            parent = self.invisibleRootItem()
-        return [parent.child(row, col).data(0) for col in range(parent.columnCount())]
+        return self.node_from_index(model_index).item_data()
@@ -0,0 +1,234 @@
+"""Small-file packing: the small files of an upload are packed in uncompressed tar shards of a bounded size.
+A packed folder holds its large files as objects and a _pack folder with the shards and an index:
+    <folder>/_pack/index.json    {"version": 1, "shards": {shard name: size},
+                                  "members": {relative path: [shard name, data offset, size, mtime]}}
+    <folder>/_pack/shard-00000.tar
+A download fetches the members with ranged GETs, or downloads whole shards when most of a shard is needed.
+"""
+import json
+import logging
+import os
+import tarfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from local_scan import list_file_stats
+
+PACK_DIR = '_pack'
+INDEX_NAME = 'index.json'
+# Download the whole shard when at least this fraction of its bytes is needed
+WHOLE_SHARD_FRACTION = 0.5
+
+
+class PackResult:
+    """ The shards, index and remaining large files of a packed folder """
+
+    def __init__(self):
+        self.shards = []
+        self.index_path = None
+        # Relative paths of the files that are uploaded as objects
+        self.large_files = []
+        self.members = 0
+        self.member_bytes = 0
+
+    def upload_files(self) -> list:
+        """ The local shard and index files """
+        return self.shards + [self.index_path]
+
+
+def pack_folder(local_path: Path, staging: Path, file_limit: int = None, shard_size: int = None) -> PackResult:
+    """ Pack the small files of a folder in tar shards
+        Args:
+            local_path : Path
+                folder to upload
+            staging : Path
+                folder for the shards and the index, removed by the caller
+            file_limit : int
+                files smaller than this number of bytes are packed, defaults to PACK_FILE_LIMIT or 1 MB
+            shard_size : int
+                shards are closed when they reach this number of bytes, defaults to PACK_SHARD_SIZE or 1 GB
+        Return:
+            PackResult
+    """
+    if file_limit is None:
+        file_limit = int(os.getenv('PACK_FILE_LIMIT', 2 ** 20))
+    if shard_size is None:
+        shard_size = int(os.getenv('PACK_SHARD_SIZE', 2 ** 30))
+    staging.mkdir(parents=True, exist_ok=True)
+    result = PackResult()
+    index = {'version': 1, 'shards': {}, 'members': {}}
+    tar = None
+    shard_path = None
+
+    def close_shard():
+        tar.close()
+        index['shards'][shard_path.name] = shard_path.stat().st_size
+        result.shards.append(shard_path)
+
+    # Sorted, so the members of a folder end up together in a shard
+    for file, (size, mtime_ns) in sorted(list_file_stats(local_path).items()):
+        if size >= file_limit:
+            result.large_files.append(file)
+            continue
+        if tar is not None and tar.offset + size > shard_size:
+            close_shard()
+            tar = None
+        if tar is None:
+            shard_path = staging.joinpath(f"shard-{len(result.shards):05d}.tar")
+            tar = tarfile.open(shard_path, 'w', format=tarfile.PAX_FORMAT)
+        local_file = local_path.joinpath(file)
+        try:
+            tarinfo = tar.gettarinfo(str(local_file), arcname=file)
+            with open(local_file, 'rb') as member_file:
+                tar.addfile(tarinfo, member_file)
+        except OSError as e:
+            logging.warning("Could not pack {}: {}".format(local_file, e))
+            continue
+        # The data is padded to blocks after its header
+        data_offset = tar.offset - -(-tarinfo.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+        index['members'][file] = [shard_path.name, data_offset, tarinfo.size, mtime_ns]
+        result.members += 1
+        result.member_bytes += tarinfo.size
+    if tar is not None:
+        close_shard()
+    result.index_path = staging.joinpath(INDEX_NAME)
+    with open(result.index_path, 'w', encoding='utf-8') as index_file:
+        json.dump(index, index_file)
+    logging.info("Packed {} files of {} in {} shards, {} large files".format(
+        result.members, local_path, len(result.shards), len(result.large_files)))
+    return result
+
+
+def find_index(s3, bucket_name: str, key: str, cache: dict = None):
+    """ Find the index of the packed folder that holds a key, the key itself or one of its parents.
+        Each folder costs one list_objects_v2 of at most one key, only an index that exists is downloaded.
+        Args:
+            s3 : boto3 client
+            bucket_name : str
+                name of the bucket
+            key : str
+                folder or file in the bucket
+            cache : dict
+                results of earlier lookups per folder, shared by the folders of one transfer so their
+                common parents are checked once, optional
+        Return:
+            (prefix of the packed folder, index), (None, None) if the key is not in a packed folder
+    """
+    if cache is None:
+        cache = {}
+    parts = key.strip('/').split('/')
+    for depth in range(len(parts), -1, -1):
+        prefix = '/'.join(parts[:depth]) + '/' if depth > 0 else ''
+        if prefix not in cache:
+            index_key = f"{prefix}{PACK_DIR}/{INDEX_NAME}"
+            response = s3.list_objects_v2(Bucket=bucket_name, Prefix=index_key, MaxKeys=1)
+            index = None
+            if any(obj['Key'] == index_key for obj in response.get('Contents', [])):
+                index = json.loads(s3.get_object(Bucket=bucket_name, Key=index_key)['Body'].read())
+            cache[prefix] = index
+        if cache[prefix] is not None:
+            return prefix, cache[prefix]
+    return None, None
+
+
+def select_members(index: dict, subpath: str = '') -> dict:
+    """ Group the members below a relative folder of the packed folder per shard
+        Return:
+            dict of shard name to list of (relative path, data offset, size, mtime_ns)
+    """
+    shards = {}
+    for member, (shard, offset, size, mtime_ns) in index['members'].items():
+        if member.startswith(subpath):
+            shards.setdefault(shard, []).append((member, offset, size, mtime_ns))
+    return shards
+
+
+def fetch_whole_shard(index: dict, shard: str, members: list) -> bool:
+    """ True if downloading the whole shard is cheaper than a ranged GET per member """
+    wanted = sum(size for _, _, size, _ in members)
+    return wanted >= WHOLE_SHARD_FRACTION * index['shards'][shard]
+
+
+def _target(local_root: Path, relative_path: str) -> Path:
+    """ Local path of a member, members can not be written outside local_root """
+    target = local_root.joinpath(*relative_path.split('/')).resolve()
+    if not target.is_relative_to(local_root.resolve()):
+        raise ValueError(f"Member outside the destination: {relative_path}")
+    return target
+
+
+def _write_member(target: Path, data, mtime_ns: int):
+    target.parent.mkdir(parents=True, exist_ok=True)
+    with open(target, 'wb') as target_file:
+        while chunk := data.read(8 * 2 ** 20):
+            target_file.write(chunk)
+    os.utime(target, ns=(mtime_ns, mtime_ns))
+
+
+def extract_members(shard_path: Path, members: list, local_root: Path, subpath: str = ''):
+    """ Write members of a downloaded shard
+        Args:
+            shard_path : Path
+                the local shard
+            members : list
+                (relative path, data offset, size, mtime_ns), see select_members
+            local_root : Path
+                local folder of subpath
+            subpath : str
+                relative folder in the packed folder that is downloaded, '' for all
+    """
+    with open(shard_path, 'rb') as shard_file:
+        for member, offset, size, mtime_ns in members:
+            shard_file.seek(offset)
+            _write_member(_target(local_root, member[len(subpath):]), _Limited(shard_file, size), mtime_ns)
+
+
+def resized_members(members: list, local_root: Path, subpath: str = '') -> list:
+    """ Restored members that are missing or differ in size from the index, see extract_members
+        Return:
+            list of their local paths
+    """
+    resized = []
+    for relative_path, _, size, _ in members:
+        target = _target(local_root, relative_path[len(subpath):])
+        if not target.is_file() or target.stat().st_size != size:
+            resized.append(target)
+    return resized
+
+
+def fetch_members(s3, bucket_name: str, shard_key: str, members: list, local_root: Path, subpath: str = '',
+                  max_workers: int = None) -> int:
+    """ Write members with a ranged GET each, see extract_members
+        Return:
+            number of bytes fetched
+    """
+    if max_workers is None:
+        max_workers = int(os.getenv('PACK_RANGE_WORKERS', 16))
+
+    def fetch(member):
+        relative_path, offset, size, mtime_ns = member
+        target = _target(local_root, relative_path[len(subpath):])
+        if size == 0:
+            _write_member(target, _Limited(None, 0), mtime_ns)
+            return 0
+        response = s3.get_object(Bucket=bucket_name, Key=shard_key, Range=f"bytes={offset}-{offset + size - 1}")
+        _write_member(target, response['Body'], mtime_ns)
+        return size
+
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='pack_fetch') as executor:
+        return sum(executor.map(fetch, members))
+
+
+class _Limited:
+    """ Read at most size bytes of a file """
+
+    def __init__(self, source, size: int):
+        self.source = source
+        self.remaining = size
+
+    def read(self, size: int) -> bytes:
+        if self.remaining <= 0:
+            return b''
+        data = self.source.read(min(size, self.remaining))
+        self.remaining -= len(data)
+        return data
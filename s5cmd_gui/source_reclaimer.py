@@ -0,0 +1,175 @@
+"""Delete the sources of a move while the transfer runs, so their space is reclaimed gradually.
+Each file s5cmd reports as copied is checked and then deleted: local sources by a pool of unlink threads,
+objects in batches of up to 1000 keys with delete_objects. Files that failed are never reported by s5cmd,
+so their sources stay.
+"""
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+from transfer_verify import etag_matches
+
+# Maximum number of keys of delete_objects
+DELETE_BATCH = 1000
+
+
+def _key(s3_url: str) -> str:
+    """ Key of an s3://bucket/key url """
+    return s3_url.split('/', 3)[3]
+
+
+class SourceReclaimer:
+    """ Streams the sources of copied files to deletion, see DataTransfer._monitor_copy """
+
+    def __init__(self, data_operations, updown: str, check: str = None, max_workers: int = None,
+                 part_sizes: list = None):
+        """
+        Args:
+            data_operations : DataOperation
+                connection to the bucket
+            updown : str
+                upload deletes local files, download deletes objects
+            check : str
+                'etag' compares the ETag of the object with the local file, 'size' only the size,
+                defaults to MOVE_CHECK or 'etag'
+            max_workers : int
+                number of threads that check and delete, defaults to LOCAL_DELETE_WORKERS or 16
+            part_sizes : list
+                part sizes in MB of the copies, filled by the caller while copying, see etag_matches
+        """
+        self.data_operations = data_operations
+        self.updown = updown
+        self.part_sizes = part_sizes if part_sizes is not None else []
+        self.check = (check if check is not None else os.getenv('MOVE_CHECK', 'etag')).lower()
+        if max_workers is None:
+            max_workers = int(os.getenv('LOCAL_DELETE_WORKERS', 16))
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='reclaim')
+        self.lock = Lock()
+        # (key, size) of the objects waiting for a delete_objects
+        self.batch = []
+        self.deleted = 0
+        self.deleted_bytes = 0
+        # "path: message" of the sources that were kept
+        self.errors = []
+
+    def add(self, source: str, destination: str, size: int):
+        """ Delete the source of a copied file, after the check
+            Args:
+                source : str
+                    source of the s5cmd record, a local path or an s3 url
+                destination : str
+                    destination of the s5cmd record
+                size : int
+                    size s5cmd copied
+        """
+        self.executor.submit(self._reclaim, source, destination, size)
+
+    def _reclaim(self, source: str, destination: str, size: int):
+        try:
+            reason = self._check(source, destination, size)
+        except Exception as e:
+            reason = f"check failed: {e}"
+        if reason is not None:
+            with self.lock:
+                self.errors.append(f"{source}: {reason}")
+            return
+        if self.updown == 'upload':
+            try:
+                os.unlink(source)
+            except OSError as e:
+                with self.lock:
+                    self.errors.append(f"{source}: {e}")
+                return
+            with self.lock:
+                self.deleted += 1
+                self.deleted_bytes += size
+            return
+        with self.lock:
+            self.batch.append((_key(source), size))
+            if len(self.batch) < DELETE_BATCH:
+                return
+            batch, self.batch = self.batch, []
+        self._delete_objects(batch)
+
+    def _check(self, source: str, destination: str, size: int):
+        """ Return None if the source may be deleted, the reason to keep it otherwise """
+        local_path, url = (source, destination) if self.updown == 'upload' else (destination, source)
+        local_size = os.path.getsize(local_path)
+        if local_size != size:
+            return f"size {local_size} != {size}"
+        if self.check != 'etag':
+            return None
+        obj = self.data_operations.s3.head_object(Bucket=self.data_operations.bucket_name, Key=_key(url))
+        if obj['ContentLength'] != size:
+            return f"object size {obj['ContentLength']} != {size}"
+        etag = obj.get('ETag', '').strip('"')
+        # Not an md5, e.g. encrypted with SSE-KMS
+        if len(etag.split('-')[0]) != 32:
+            return 'the ETag is not an md5'
+        if not etag_matches(local_path, etag, tuple(self.part_sizes)):
+            return 'ETag mismatch'
+        return None
+
+    def _delete_objects(self, batch: list):
+        sizes = dict(batch)
+        try:
+            result = self.data_operations.s3.delete_objects(
+                Bucket=self.data_operations.bucket_name, Delete={'Objects': [{'Key': key} for key in sizes]})
+        except Exception as e:
+            with self.lock:
+                self.errors.append(f"{batch[0][0]} .. {batch[-1][0]}: batch of {len(batch)} failed: {e}")
+            return
+        with self.lock:
+            for deleted in result.get('Deleted', []):
+                self.deleted += 1
+                self.deleted_bytes += sizes.get(deleted['Key'], 0)
+            for error in result.get('Errors', []):
+                self.errors.append(f"{error.get('Key')}: {error.get('Code')} {error.get('Message')}")
+
+    def close(self):
+        """ Wait for the pending deletes
+            Return:
+                deleted : int
+                    number of deleted sources
+                errors : list
+                    "path: message" of the sources that were kept
+        """
+        self.executor.shutdown(wait=True)
+        if len(self.batch) > 0:
+            batch, self.batch = self.batch, []
+            self._delete_objects(batch)
+        for error in self.errors:
+            logging.warning(f"Kept the source: {error}")
+        if self.updown == 'download':
+            self.data_operations.bucket_ledger.record_change(-self.deleted_bytes, -self.deleted)
+        logging.info("Deleted {} sources while copying, kept {}".format(self.deleted, len(self.errors)))
+        return self.deleted, self.errors
+
+
+if __name__ == "__main__":
+    # Self check: a multipart upload of 1010 MB in parts of 50 MB is deleted, a changed file is kept
+    import hashlib
+    from tempfile import TemporaryDirectory
+    from types import SimpleNamespace
+    MB = 2 ** 20
+    with TemporaryDirectory() as folder:
+        local_path = os.path.join(folder, 'large.bin')
+        with open(local_path, 'wb') as local_file:
+            local_file.write(os.urandom(MB))
+            local_file.truncate(1010 * MB)
+        with open(local_path, 'rb') as local_file:
+            digests = b''.join(hashlib.md5(part).digest() for part in iter(lambda: local_file.read(50 * MB), b''))
+        etag = f'"{hashlib.md5(digests).hexdigest()}-21"'
+        s3 = SimpleNamespace(head_object=lambda Bucket, Key: {'ContentLength': 1010 * MB, 'ETag': etag})
+        reclaimer = SourceReclaimer(SimpleNamespace(s3=s3, bucket_name='bucket'), 'upload', check='etag',
+                                    part_sizes=[50])
+        assert reclaimer._check(local_path, 's3://bucket/large.bin', 1010 * MB) is None
+        with open(local_path, 'r+b') as local_file:
+            local_file.seek(500 * MB)
+            local_file.write(b'changed')
+        assert reclaimer._check(local_path, 's3://bucket/large.bin', 1010 * MB) == 'ETag mismatch'
+        reclaimer.add(local_path, 's3://bucket/large.bin', 1010 * MB)
+        reclaimer.close()
+        assert os.path.exists(local_path) and len(reclaimer.errors) == 1
+        print("A changed multipart source is kept, an unchanged one may be deleted")
@@ -0,0 +1,234 @@
+"""Incremental sync, a replacement for s5cmd sync which is buggy.
+The local files are listed with local_scan and compared with one listing of the objects per item:
+files that are missing at the destination are new, files that differ in size or are newer than their
+copy are changed. Only the new and changed files are copied, with one s5cmd run command.
+"""
+import hashlib
+import logging
+import os
+from datetime import datetime, timezone
+from pathlib import Path
+
+from local_scan import ScanResult, list_file_stats
+from path import ScalityPath
+from utils import size_fmt
+
+# Seconds the clocks of the local disk and the object store may differ
+MTIME_TOLERANCE = 2
+STATUSES = ('new', 'changed', 'unchanged')
+
+
+def file_md5(local_path: str, chunk_size: int = 8 * 1024 * 1024) -> str:
+    """ Hex md5 of a local file, equal to the ETag of an object uploaded in one part """
+    md5 = hashlib.md5()
+    with open(local_path, 'rb') as local_file:
+        for chunk in iter(lambda: local_file.read(chunk_size), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+class SyncPlan:
+    """ The files of a transfer divided in new, changed and unchanged """
+
+    def __init__(self):
+        self.files = dict.fromkeys(STATUSES, 0)
+        self.bytes = dict.fromkeys(STATUSES, 0)
+        # cp arguments of the new and changed files and their sizes
+        self.copies = []
+        self.sizes = []
+        # Size histogram of the files to copy
+        self.scan = ScanResult()
+        # Bytes to copy per local destination folder of a download, for the free space check
+        self.bytes_per_destination = {}
+
+    def add(self, status: str, size: int, copy: tuple = None, destination: Path = None):
+        """ Add a file to the plan
+            Args:
+                status : str
+                    new, changed or unchanged
+                size : int
+                    size in bytes of the file to copy
+                copy : tuple
+                    arguments of the cp command, not used for unchanged files
+                destination : Path
+                    local destination folder of a download, optional
+        """
+        self.files[status] += 1
+        self.bytes[status] += size
+        if status != 'unchanged':
+            self.copies.append(copy)
+            self.sizes.append(size)
+            self.scan.add_file(size)
+            if destination is not None:
+                self.bytes_per_destination[destination] = self.bytes_per_destination.get(destination, 0) + size
+
+    @property
+    def files_to_copy(self) -> int:
+        return self.files['new'] + self.files['changed']
+
+    @property
+    def bytes_to_copy(self) -> int:
+        return self.bytes['new'] + self.bytes['changed']
+
+    def split(self, threshold: int) -> list:
+        """ Divide the files to copy by size, see transfer_tuning.split_threshold
+            Return:
+                (name, copies, ScanResult) of the small and the large files
+        """
+        runs = []
+        for name, is_small in (('small files', True), ('large files', False)):
+            copies = []
+            scan = ScanResult()
+            for copy, size in zip(self.copies, self.sizes):
+                if (size < threshold) == is_small:
+                    copies.append(copy)
+                    scan.add_file(size)
+            runs.append((name, copies, scan))
+        return runs
+
+    def report(self) -> list:
+        """ Return the lines of the dry-run report """
+        lines = [f"{status}: {self.files[status]} files, {size_fmt(self.bytes[status])}" for status in STATUSES]
+        lines.append(f"to copy: {self.files_to_copy} files, {size_fmt(self.bytes_to_copy)}")
+        return lines
+
+
+def compare(updown: str, local: tuple, remote: dict, local_path: str, checksum: bool = False) -> str:
+    """ Decide if a file has to be copied
+        Args:
+            updown : str
+                upload or download
+            local : tuple
+                (size, mtime_ns) of the local file, None if it does not exist
+            remote : dict
+                the object from list_objects_v2, None if it does not exist
+            local_path : str
+                path of the local file, read when checksum is True
+            checksum : bool
+                compare the md5 of the files with the same size and age with the ETag
+        Return:
+            new, changed or unchanged
+    """
+    if (remote if updown == 'upload' else local) is None:
+        return 'new'
+    if local is None:
+        return 'changed'
+    if local[0] != remote['Size']:
+        return 'changed'
+    local_time = local[1] / 1e9
+    remote_time = remote['LastModified'].timestamp()
+    if updown == 'upload' and local_time > remote_time + MTIME_TOLERANCE:
+        return 'changed'
+    if updown == 'download' and remote_time > local_time + MTIME_TOLERANCE:
+        return 'changed'
+    etag = remote.get('ETag', '').strip('"')
+    # The ETag of a multipart upload is not the md5 of the file
+    if checksum and etag and '-' not in etag and file_md5(local_path) != etag:
+        return 'changed'
+    return 'unchanged'
+
+
+def list_objects(data_operations, prefix: str) -> dict:
+    """ Return the objects under a prefix as key: object """
+    objects = {}
+    paginator = data_operations.s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=data_operations.bucket_name, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            objects[obj['Key']] = obj
+    return objects
+
+
+def _local_stat(local_path: str):
+    try:
+        stat = os.stat(local_path)
+    except OSError:
+        return None
+    return (stat.st_size, stat.st_mtime_ns)
+
+
+def pair_files(data_operations, updown: str, items: list, compare_files: bool = True):
+    """ Pair the local files of a transfer with their objects
+        Args:
+            data_operations : DataOperation
+                connection to the bucket
+            updown : str
+                upload or download
+            items : list
+                (source_path, destination_path) of the files or folders, see DataTransfer.transfer_batch
+            compare_files : bool
+                False lists the sources only, the destinations are returned as None
+        Yields:
+            (local path, (size, mtime_ns) or None, key, object from list_objects_v2 or None, destination_path)
+    """
+    for source_path, destination_path in items:
+        if updown == 'upload':
+            key = str(destination_path.joinpath(source_path.name))
+            if source_path.is_dir():
+                local_files = {str(source_path.joinpath(file)): (stats, f"{key}/{file}")
+                               for file, stats in list_file_stats(source_path).items()}
+                objects = list_objects(data_operations, key + '/') if compare_files else {}
+            else:
+                local_files = {str(source_path): (_local_stat(source_path), key)}
+                objects = list_objects(data_operations, key) if compare_files else {}
+            for local_path, (local, object_key) in local_files.items():
+                yield local_path, local, object_key, objects.get(object_key), destination_path
+        else:
+            prefix = source_path.relative_path()
+            local_root = destination_path.joinpath(source_path.name)
+            for key, obj in list_objects(data_operations, prefix).items():
+                # Folder markers
+                if key.endswith('/'):
+                    continue
+                if source_path.suffix:
+                    if key != prefix:
+                        continue
+                    local_path = str(local_root)
+                else:
+                    local_path = os.path.join(local_root, *key[len(prefix):].split('/'))
+                local = _local_stat(local_path) if compare_files else None
+                yield local_path, local, key, obj, destination_path
+
+
+def plan_sync(data_operations, updown: str, items: list, checksum: bool = None, compare_files: bool = True) -> SyncPlan:
+    """ Compare the files of a transfer with the destination
+        Args:
+            data_operations : DataOperation
+                connection to the bucket
+            updown : str
+                upload or download
+            items : list
+                (source_path, destination_path) of the files or folders, see DataTransfer.transfer_batch
+            checksum : bool
+                also compare the md5 with the ETag, defaults to SYNC_CHECKSUM
+            compare_files : bool
+                False lists the files of the sources only, every file is new
+        Return:
+            SyncPlan with the --raw cp arguments of the files to copy
+    """
+    if checksum is None:
+        checksum = os.getenv('SYNC_CHECKSUM', 'N').upper() == 'Y'
+    bucket = data_operations.bucket_name
+    plan = SyncPlan()
+    for local_path, local, key, obj, destination_path in pair_files(data_operations, updown, items, compare_files):
+        status = compare(updown, local, obj, local_path, checksum)
+        if updown == 'upload':
+            plan.add(status, local[0], ('--raw', local_path, f"s3://{bucket}/{key}"))
+        else:
+            plan.add(status, obj['Size'], ('--raw', f"s3://{bucket}/{key}", local_path), destination_path)
+    logging.info("Sync plan: {}".format(", ".join(plan.report())))
+    return plan
+
+
+if __name__ == "__main__":
+    # Dry run of an upload: python sync_plan.py <local folder> <scality folder>
+    import sys
+    from dotenv import load_dotenv
+    from data_operation import DataOperation
+    from utils import setup_logger
+    load_dotenv()
+    setup_logger()
+    start_time = datetime.now(timezone.utc)
+    data_operations = DataOperation()
+    plan = plan_sync(data_operations, 'upload', [(Path(sys.argv[1]), ScalityPath(data_operations, sys.argv[2]))])
+    print("\n".join(plan.report()))
+    print(f"took {datetime.now(timezone.utc) - start_time}")
@@ -0,0 +1,169 @@
+"""Persistent history of the transfer throughput.
+Every s5cmd copy run is stored with its size, duration and settings. The history predicts the duration of a
+new transfer from its scan, and the weekly summary shows throughput regressions of the endpoint.
+"""
+import csv
+import logging
+import math
+import sqlite3
+import statistics
+import time
+from datetime import datetime
+from os import getenv
+from pathlib import Path
+from threading import Lock
+
+from local_scan import ScanResult
+from utils import get_cachefolder
+
+MB = 2 ** 20
+# Runs shorter than this are dominated by the start of s5cmd
+MIN_SECONDS = 1
+# Number of earlier runs with the most similar file sizes a prediction is based on
+PREDICTION_RUNS = 20
+MIN_PREDICTION_RUNS = 3
+COLUMNS = ('started_at', 'endpoint', 'bucket', 'direction', 'files', 'bytes', 'seconds', 'mb_per_s', 'files_per_s',
+           'numworkers', 'concurrency', 'part_size', 'errors')
+
+
+class TransferHistory:
+    """ Metrics of the copy runs """
+
+    def __init__(self, db_path: Path = None):
+        """
+        Args:
+            db_path : Path
+                SQLite database, defaults to transfer_history.sqlite in the cache folder
+        """
+        self.endpoint_url = getenv('ENDPOINT') or ''
+        self.bucket_name = getenv('BUCKETNAME') or ''
+        if db_path is None:
+            db_path = get_cachefolder().joinpath('transfer_history.sqlite')
+        self.lock = Lock()
+        self.db = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("""CREATE TABLE IF NOT EXISTS transfers (
+                started_at REAL, endpoint TEXT, bucket TEXT, direction TEXT, files INTEGER, bytes INTEGER,
+                seconds REAL, mb_per_s REAL, files_per_s REAL, numworkers INTEGER, concurrency INTEGER,
+                part_size INTEGER, errors INTEGER)""")
+            self.db.execute("CREATE INDEX IF NOT EXISTS transfers_endpoint ON transfers (endpoint, direction)")
+
+    def record(self, direction: str, files: int, size: int, seconds: float, numworkers: int,
+               concurrency: int = None, part_size: int = None, errors: int = 0):
+        """ Store a copy run
+            Args:
+                direction : str
+                    upload or download
+                files : int
+                    number of copied files
+                size : int
+                    number of copied bytes
+                seconds : float
+                    wall time of the run
+                numworkers : int
+                    --numworkers of s5cmd
+                concurrency : int
+                    --concurrency of cp, None for the s5cmd default
+                part_size : int
+                    --part-size of cp in MB, None for the s5cmd default
+                errors : int
+                    number of failed files
+        """
+        seconds = max(seconds, 1e-3)
+        try:
+            with self.lock, self.db:
+                self.db.execute("INSERT INTO transfers VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                (time.time() - seconds, self.endpoint_url, self.bucket_name, direction, files, size,
+                                 seconds, size / MB / seconds, files / seconds, numworkers, concurrency, part_size,
+                                 errors))
+        except sqlite3.Error as e:
+            logging.warning("Failed to record the transfer metrics: {}".format(e))
+
+    def _similar_runs(self, direction: str, mean_size: float) -> list:
+        """ (files, bytes, seconds) of the error free runs with the most similar mean file size """
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT files, bytes, seconds FROM transfers WHERE endpoint=? AND direction=? AND errors=0 "
+                "AND files>0 AND seconds>=? ORDER BY started_at DESC LIMIT 1000",
+                (self.endpoint_url, direction, MIN_SECONDS)).fetchall()
+        # File sizes are compared on a log scale, ties go to the most recent run
+        rows.sort(key=lambda row: abs(math.log2(max(row[1] / row[0], 1)) - math.log2(max(mean_size, 1))))
+        return rows[:PREDICTION_RUNS]
+
+    def predict(self, direction: str, scan: ScanResult):
+        """ Predict the duration of a transfer from its scan
+            The runs are fitted as seconds = files * seconds per file + bytes / bandwidth,
+            with the median throughput as fallback when the fit is not meaningful.
+            Args:
+                direction : str
+                    upload or download
+                scan : ScanResult
+                    the files to copy
+            Return:
+                (seconds, number of runs it is based on), None without enough history
+        """
+        if scan.num_files == 0:
+            return None
+        runs = self._similar_runs(direction, scan.total_size / scan.num_files)
+        if len(runs) < MIN_PREDICTION_RUNS:
+            return None
+        # Least squares without an intercept, in MB to keep the sums small
+        sff = sum(files * files for files, _, _ in runs)
+        sfb = sum(files * size / MB for files, size, _ in runs)
+        sbb = sum((size / MB) ** 2 for _, size, _ in runs)
+        sfs = sum(files * seconds for files, _, seconds in runs)
+        sbs = sum(size / MB * seconds for _, size, seconds in runs)
+        determinant = sff * sbb - sfb * sfb
+        if determinant > 1e-9 * sff * sbb:
+            per_file = (sfs * sbb - sbs * sfb) / determinant
+            per_mb = (sbs * sff - sfs * sfb) / determinant
+            if per_file >= 0 and per_mb >= 0:
+                return scan.num_files * per_file + scan.total_size / MB * per_mb, len(runs)
+        if scan.total_size > 0:
+            return scan.total_size / statistics.median(size / seconds for _, size, seconds in runs), len(runs)
+        return scan.num_files / statistics.median(files / seconds for files, _, seconds in runs), len(runs)
+
+    def weekly_summary(self, weeks: int = 12) -> list:
+        """ Throughput per week and direction of the endpoint, the oldest week first
+            Return:
+                list of (week, direction, runs, files, bytes, MB/s, files/s, errors)
+        """
+        with self.lock:
+            return self.db.execute(
+                "SELECT strftime('%Y-%W', started_at, 'unixepoch') AS week, direction, count(*), sum(files), "
+                "sum(bytes), sum(bytes) / ? / sum(seconds), sum(files) / sum(seconds), sum(errors) "
+                "FROM transfers WHERE endpoint=? AND started_at>=? GROUP BY week, direction ORDER BY week, direction",
+                (MB, self.endpoint_url, time.time() - weeks * 7 * 24 * 3600)).fetchall()
+
+    def export_csv(self, csv_path: Path) -> int:
+        """ Write all runs to a csv file
+            Return:
+                number of runs
+        """
+        with self.lock:
+            rows = self.db.execute(f"SELECT {', '.join(COLUMNS)} FROM transfers ORDER BY started_at").fetchall()
+        with open(csv_path, 'w', newline='', encoding='utf-8') as csv_file:
+            writer = csv.writer(csv_file)
+            writer.writerow(COLUMNS)
+            for row in rows:
+                writer.writerow((datetime.fromtimestamp(row[0]).isoformat(timespec='seconds'),) + row[1:])
+        return len(rows)
+
+
+if __name__ == "__main__":
+    import sys
+    from dotenv import load_dotenv
+    from utils import size_fmt
+    load_dotenv()
+    history = TransferHistory()
+    print(f"Throughput per week of {history.endpoint_url}")
+    previous = {}
+    for week, direction, runs, files, size, mb_per_s, files_per_s, errors in history.weekly_summary():
+        # Flag weeks that are much slower than the week before
+        slower = direction in previous and mb_per_s < 0.7 * previous[direction]
+        previous[direction] = mb_per_s
+        print(f"{week} {direction:8} {runs:5} runs {files:9} files {size_fmt(size):>10} {mb_per_s:8.1f} MB/s "
+              f"{files_per_s:8.1f} files/s {errors:5} errors{'  slower' if slower else ''}")
+    if len(sys.argv) > 1:
+        print(f"{history.export_csv(Path(sys.argv[1]))} runs written to {sys.argv[1]}")
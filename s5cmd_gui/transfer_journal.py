@@ -0,0 +1,163 @@
+"""On-disk journal of the files a transfer completed, so an interrupted transfer can be resumed.
+One jsonl file per job in the journals folder of the cache: a header with the job, then a line
+[local path, size, mtime_ns] per copied file, taken from the s5cmd output. The journal is removed
+when the job succeeds, the remaining journals are offered for resume at the next launch.
+"""
+import hashlib
+import json
+import logging
+import os
+import time
+from pathlib import Path
+
+from utils import get_cachefolder
+
+# Buffered lines are written at least this often, in seconds
+FLUSH_INTERVAL = 1
+
+
+def _normalize(local_path: str) -> str:
+    """ s5cmd and the scanner may write the same path differently, e.g. the separators on Windows """
+    return os.path.normcase(os.path.abspath(local_path))
+
+
+def get_journalfolder() -> Path:
+    journal_folder = get_cachefolder().joinpath('journals')
+    journal_folder.mkdir(exist_ok=True)
+    return journal_folder
+
+
+class TransferJournal:
+    """ Completed files of one transfer job """
+
+    def __init__(self, updown: str, items: list, sync: bool = False, packed: bool = False):
+        """ Open the journal of a job, the completed files of an earlier attempt are loaded
+        Args:
+            updown : str
+                upload or download
+            items : list
+                (source_path, destination_path) of the job, as str or paths
+            sync : bool
+                the job only copies new and changed files, stored so a resume does the same
+            packed : bool
+                the job packs small files into shards, stored so a resume does the same
+        """
+        self.updown = updown
+        self.items = [(str(source), str(destination)) for source, destination in items]
+        self.sync = sync
+        self.packed = packed
+        key = json.dumps([updown, sorted(self.items)])
+        self.path = get_journalfolder().joinpath(hashlib.sha1(key.encode('utf-8')).hexdigest()[:20] + '.jsonl')
+        # local path: (size, mtime_ns)
+        self.completed = {}
+        self.buffer = []
+        self.last_flush = time.monotonic()
+        if self.path.exists():
+            self._load()
+        else:
+            self._write_lines([self._header()])
+
+    def _header(self) -> str:
+        return json.dumps({'updown': self.updown, 'items': self.items, 'sync': self.sync, 'packed': self.packed,
+                           'created': time.time()})
+
+    def _load(self):
+        with open(self.path, encoding='utf-8') as journal_file:
+            # The header is known
+            next(journal_file, None)
+            for line in journal_file:
+                try:
+                    local_path, size, mtime_ns = json.loads(line)
+                except ValueError:
+                    # A line cut off by a crash
+                    continue
+                self.completed[local_path] = (size, mtime_ns)
+        logging.info("Journal {} has {} completed files".format(self.path.name, len(self.completed)))
+
+    def _write_lines(self, lines: list):
+        with open(self.path, 'a', encoding='utf-8') as journal_file:
+            journal_file.write('\n'.join(lines) + '\n')
+
+    def record(self, local_path: str, size: int):
+        """ Journal a copied file, for downloads the local path is the destination
+        Args:
+            local_path : str
+                path of the local file
+            size : int
+                size of the file in bytes
+        """
+        local_path = _normalize(local_path)
+        try:
+            mtime_ns = os.stat(local_path).st_mtime_ns
+        except OSError:
+            return
+        self.completed[local_path] = (size, mtime_ns)
+        self.buffer.append(json.dumps([local_path, size, mtime_ns]))
+        if time.monotonic() - self.last_flush >= FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        if len(self.buffer) > 0:
+            self._write_lines(self.buffer)
+            self.buffer = []
+        self.last_flush = time.monotonic()
+
+    def is_completed(self, local_path: str, size: int = None) -> bool:
+        """ True if the file was copied before and the local file did not change since
+        Args:
+            local_path : str
+                path of the local file
+            size : int
+                expected size, e.g. of the object of a download, optional
+        """
+        local_path = _normalize(local_path)
+        journaled = self.completed.get(local_path)
+        if journaled is None or (size is not None and journaled[0] != size):
+            return False
+        try:
+            stat = os.stat(local_path)
+        except OSError:
+            return False
+        return (stat.st_size, stat.st_mtime_ns) == journaled
+
+    def has_completed(self) -> bool:
+        return len(self.completed) > 0
+
+    def completed_size(self, local_path: str) -> int:
+        """ Journaled size of a completed file """
+        return self.completed[_normalize(local_path)][0]
+
+    def forget(self, local_paths: list):
+        """ Drop files from the journal, e.g. when their verification failed, so a resume copies them again """
+        for local_path in local_paths:
+            self.completed.pop(_normalize(local_path), None)
+        self.buffer = []
+        self.path.unlink(missing_ok=True)
+        lines = [self._header()]
+        lines.extend(json.dumps([local_path, size, mtime_ns])
+                     for local_path, (size, mtime_ns) in self.completed.items())
+        self._write_lines(lines)
+
+    def remove(self):
+        """ The job finished, the journal is not needed anymore """
+        self.buffer = []
+        self.path.unlink(missing_ok=True)
+
+    @staticmethod
+    def unfinished() -> list:
+        """ Return the (updown, items, sync, packed, number of completed files) of the journals left by
+            interrupted jobs
+        """
+        jobs = []
+        for path in sorted(get_journalfolder().glob('*.jsonl')):
+            try:
+                with open(path, encoding='utf-8') as journal_file:
+                    header = json.loads(next(journal_file))
+                    completed = sum(1 for _ in journal_file)
+            except (OSError, ValueError, StopIteration) as e:
+                logging.warning("Skipping unreadable journal {}: {}".format(path, e))
+                continue
+            # Journals written before the flags were stored
+            jobs.append((header['updown'], header['items'], header.get('sync', False), header.get('packed', False),
+                         completed))
+        return jobs
@@ -0,0 +1,105 @@
+"""Progress of a transfer in bytes, with a rolling throughput and an ETA.
+Updated from the s5cmd result records, one record per copied file.
+"""
+import copy
+import time
+from collections import deque
+from datetime import timedelta
+
+from utils import size_fmt
+
+# Seconds of history used for the throughput
+ROLLING_WINDOW = 10
+
+
+class TransferProgress:
+    """ Files and bytes done of a transfer """
+
+    def __init__(self, files_total: int = 0, bytes_total: int = 0):
+        """
+        Args:
+            files_total : int
+                number of files to transfer, 0 if unknown
+            bytes_total : int
+                number of bytes to transfer, 0 if unknown
+        """
+        self.files_total = files_total
+        self.bytes_total = bytes_total
+        self.files_done = 0
+        self.bytes_done = 0
+        self.errors = 0
+        # False while the totals still grow, e.g. while the source is scanned during the transfer
+        self.totals_final = True
+        self.start_time = time.monotonic()
+        # (time, bytes_done) samples of the rolling window
+        self.samples = deque([(self.start_time, 0)])
+
+    def add_file(self, size: int):
+        self.files_done += 1
+        self.bytes_done += size
+
+    def add_error(self):
+        self.errors += 1
+
+    def grow_totals(self, files_total: int, bytes_total: int, final: bool = False):
+        """ Totals of a scan that is still running, final when the scan finished """
+        self.files_total = files_total
+        self.bytes_total = bytes_total
+        self.totals_final = final
+
+    def add_skipped(self, files: int, size: int):
+        """ Count files that were copied by an earlier attempt, they do not add to the throughput """
+        self.files_done += files
+        self.bytes_done += size
+        self.samples = deque([(time.monotonic(), self.bytes_done)])
+
+    def sample(self):
+        """ Record the bytes done for the throughput, called when the progress is reported """
+        now = time.monotonic()
+        self.samples.append((now, self.bytes_done))
+        # Keep one sample older than the window as its start
+        while len(self.samples) > 2 and self.samples[1][0] < now - ROLLING_WINDOW:
+            self.samples.popleft()
+
+    def throughput(self) -> float:
+        """ Bytes per second over the rolling window """
+        (start, start_bytes), (end, end_bytes) = self.samples[0], self.samples[-1]
+        if end <= start:
+            return 0.0
+        return (end_bytes - start_bytes) / (end - start)
+
+    def eta(self):
+        """ Return the estimated remaining time as timedelta, None if unknown """
+        rate = self.throughput()
+        if self.bytes_total <= 0 or rate <= 0 or not self.totals_final:
+            return None
+        return timedelta(seconds=int(max(self.bytes_total - self.bytes_done, 0) / rate))
+
+    def fraction(self) -> float:
+        """ Fraction of the bytes done, the files are used when the size is unknown """
+        if self.bytes_total > 0:
+            return min(self.bytes_done / self.bytes_total, 1.0)
+        if self.files_total > 0:
+            return min(self.files_done / self.files_total, 1.0)
+        return 0.0
+
+    def elapsed(self) -> timedelta:
+        return timedelta(seconds=int(time.monotonic() - self.start_time))
+
+    def summary(self) -> str:
+        """ One line for the progress bar and the logs """
+        eta = self.eta()
+        # The totals are a lower bound while they grow
+        more = '' if self.totals_final else '+'
+        text = (f"{size_fmt(self.bytes_done)} / {size_fmt(self.bytes_total)}{more}, "
+                f"{self.files_done}/{self.files_total}{more} files, {size_fmt(self.throughput())}/s, "
+                f"ETA {eta if eta is not None else '?'}")
+        if self.errors > 0:
+            text += f", {self.errors} errors"
+        return text
+
+    def snapshot(self):
+        """ Copy to emit to the UI thread while the transfer continues """
+        progress = copy.copy(self)
+        progress.samples = deque(self.samples)
+        return progress
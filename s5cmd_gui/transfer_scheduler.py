@@ -0,0 +1,225 @@
+"""Scheduler of the up- and downloads.
+Runs up to TRANSFER_JOBS transfers at once, every transfer in its own QThread, and divides the
+AWS_WORKERS budget of s5cmd --numworkers over the running jobs. Jobs can be queued while others run,
+jobs with a higher priority start first. A job can hold several items, they are copied by one s5cmd process.
+"""
+import heapq
+import itertools
+import logging
+from datetime import timedelta
+from os import getenv
+from threading import Event
+from PySide6.QtCore import QObject, QThread, QTimer, Signal
+
+from data_operation import DataOperation
+from data_transfer import DataTransfer
+from utils import size_fmt
+
+
+class TransferJob(QObject):
+    """ One up- or download and its state.
+    A QObject in the main thread, so the signals of its worker are received in the main thread. """
+
+    def __init__(self, scheduler, job_id: int, updown: str, items: list, priority: int = 0, refresh_index=None,
+                 sync: bool = False, dry_run: bool = False, pack: bool = False):
+        """
+        Args:
+            scheduler : TransferScheduler
+                receives the updates of the job
+            job_id : int
+                sequence number, also used to keep the queue order of equal priorities
+            updown : str
+                upload or download
+            items : list
+                (local_path, scality_path) of the files or folders to transfer
+            priority : int
+                jobs with a higher priority start first
+            refresh_index : QPersistentModelIndex
+                folder in the scality tree to refresh when the job finished, optional
+            sync : bool
+                only copy the new and changed files
+            dry_run : bool
+                only report what would be copied
+            pack : bool
+                upload the small files in tar shards
+        """
+        super().__init__()
+        self.scheduler = scheduler
+        self.job_id = job_id
+        self.updown = updown
+        self.items = items
+        self.priority = priority
+        self.refresh_index = refresh_index
+        self.sync = sync
+        self.dry_run = dry_run
+        self.pack = pack
+        self.status = 'queued'
+        self.numworkers = 0
+        # Last TransferProgress snapshot
+        self.progress = None
+        self.stop_worker = Event()
+        self.thread = None
+        self.worker = None
+
+    @property
+    def name(self) -> str:
+        local_path, scality_path = self.items[0]
+        source = local_path if self.updown == 'upload' else scality_path
+        if len(self.items) > 1:
+            return f"{self.updown} {source.name} and {len(self.items) - 1} more"
+        return f"{self.updown} {source.name}"
+
+    def __lt__(self, other):
+        return (-self.priority, self.job_id) < (-other.priority, other.job_id)
+
+    def _message(self, msg: str):
+        self.scheduler.job_message.emit(self, msg)
+
+    def _progress(self, progress):
+        self.progress = progress
+        self.scheduler.job_progress.emit(self)
+
+    def _finished(self, success: bool):
+        self.scheduler._finish(self, success)
+
+    def _thread_finished(self):
+        self.scheduler._release(self)
+
+
+class TransferScheduler(QObject):
+    """ Queue and run the transfer jobs, lives in the main thread """
+    # job, message
+    job_message = Signal(object, str)
+    # job, its progress is in job.progress
+    job_progress = Signal(object)
+    # job, success
+    job_finished = Signal(object, bool)
+    # No jobs running or queued anymore
+    all_finished = Signal()
+
+    def __init__(self, data_operations: DataOperation, max_jobs: int = None, total_workers: int = None):
+        """
+        Args:
+            data_operations : DataOperation
+                shared by the transfers
+            max_jobs : int
+                number of concurrent transfers, defaults to TRANSFER_JOBS or 4
+            total_workers : int
+                s5cmd --numworkers budget shared by the running transfers, defaults to AWS_WORKERS
+        """
+        super().__init__()
+        self.data_operations = data_operations
+        self.max_jobs = max_jobs if max_jobs is not None else int(getenv('TRANSFER_JOBS', 4))
+        self.total_workers = total_workers if total_workers is not None else int(getenv('AWS_WORKERS', 256))
+        self.queue = []
+        self.running = []
+        # Finished jobs whose thread is still stopping, the references keep the QThread alive
+        self.stopping = []
+        self.job_ids = itertools.count(1)
+        self.dispatch_pending = False
+
+    def submit(self, updown: str, items: list, priority: int = 0, refresh_index=None, sync: bool = False,
+               dry_run: bool = False, pack: bool = False) -> TransferJob:
+        """ Queue a transfer, jobs submitted together are started together and share the budget evenly
+            Args:
+                see TransferJob
+            Return:
+                the queued TransferJob
+        """
+        job = TransferJob(self, next(self.job_ids), updown, items, priority, refresh_index, sync, dry_run, pack)
+        heapq.heappush(self.queue, job)
+        logging.info("Queued transfer job {}: {} with priority {}".format(job.job_id, job.name, priority))
+        if not self.dispatch_pending:
+            self.dispatch_pending = True
+            QTimer.singleShot(0, self._dispatch)
+        return job
+
+    def is_busy(self) -> bool:
+        return len(self.running) > 0 or len(self.queue) > 0
+
+    def used_workers(self) -> int:
+        return sum(job.numworkers for job in self.running)
+
+    def _dispatch(self):
+        """ Start queued jobs while there is room, the free budget is divided over the jobs started now """
+        self.dispatch_pending = False
+        to_start = min(self.max_jobs - len(self.running), len(self.queue))
+        free_workers = self.total_workers - self.used_workers()
+        if to_start <= 0 or free_workers <= 0:
+            return
+        share = max(free_workers // to_start, 1)
+        for _ in range(to_start):
+            if self.total_workers - self.used_workers() < 1:
+                break
+            self._start(heapq.heappop(self.queue), share)
+
+    def _start(self, job: TransferJob, numworkers: int):
+        job.status = 'running'
+        job.numworkers = numworkers
+        job.thread = QThread()
+        job.worker = DataTransfer(job.stop_worker, self.data_operations)
+        local_path, scality_path = job.items[0]
+        job.worker.set_params(job.updown, local_path, scality_path, False, numworkers, job.sync, job.dry_run,
+                              job.pack)
+        for local_path, scality_path in job.items[1:]:
+            job.worker.add_item(local_path, scality_path)
+        job.worker.moveToThread(job.thread)
+        job.worker.progress.connect(job._message)
+        job.worker.transfer_progress.connect(job._progress)
+        job.worker.finished.connect(job._finished)
+        job.thread.started.connect(job.worker.run)
+        job.worker.finished.connect(job.thread.quit)
+        job.worker.finished.connect(job.worker.deleteLater)
+        job.thread.finished.connect(job._thread_finished)
+        job.thread.finished.connect(job.thread.deleteLater)
+        self.running.append(job)
+        logging.info("Starting transfer job {}: {} with {} workers".format(job.job_id, job.name, numworkers))
+        job.thread.start()
+
+    def _finish(self, job: TransferJob, success: bool):
+        # The worker reports once, a job is never finished twice
+        if job not in self.running:
+            return
+        self.running.remove(job)
+        job.status = 'done' if success else 'failed'
+        job.numworkers = 0
+        self.stopping.append(job)
+        self.job_finished.emit(job, success)
+        self._dispatch()
+        if not self.is_busy():
+            self.all_finished.emit()
+
+    def _release(self, job: TransferJob):
+        """ The thread of a job stopped, it is deleted by Qt """
+        if job in self.stopping:
+            self.stopping.remove(job)
+        job.thread = None
+        job.worker = None
+
+    def stop_all(self):
+        """ Drop the queued jobs and ask the running jobs to stop """
+        self.queue.clear()
+        for job in self.running:
+            job.stop_worker.set()
+
+    def fraction(self) -> float:
+        """ Fraction of the bytes done by the running jobs """
+        progresses = [job.progress for job in self.running if job.progress is not None]
+        bytes_total = sum(progress.bytes_total for progress in progresses)
+        if bytes_total == 0:
+            return 0.0
+        return min(sum(progress.bytes_done for progress in progresses) / bytes_total, 1.0)
+
+    def summary(self) -> str:
+        """ Combined progress of the running jobs for the progress bar """
+        progresses = [job.progress for job in self.running if job.progress is not None]
+        bytes_done = sum(progress.bytes_done for progress in progresses)
+        bytes_total = sum(progress.bytes_total for progress in progresses)
+        rate = sum(progress.throughput() for progress in progresses)
+        eta = timedelta(seconds=int(max(bytes_total - bytes_done, 0) / rate)) if rate > 0 else '?'
+        errors = sum(progress.errors for progress in progresses)
+        text = (f"{len(self.running)} running, {len(self.queue)} queued: "
+                f"{size_fmt(bytes_done)} / {size_fmt(bytes_total)}, {size_fmt(rate)}/s, ETA {eta}")
+        if errors > 0:
+            text += f", {errors} errors"
+        return text
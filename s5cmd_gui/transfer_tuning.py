@@ -0,0 +1,118 @@
+"""Choose the s5cmd --numworkers, --concurrency and --part-size of a transfer from its file size histogram.
+Many small files need many workers, a few large files need many parts per file in parallel.
+A mix of both is split in a run for the small files and a run for the large files.
+"""
+import math
+from os import getenv
+
+from local_scan import NUM_BINS, ScanResult
+from utils import size_fmt
+
+MB = 2 ** 20
+# Limits of S3 multipart uploads
+MIN_PART_SIZE = 5 * MB
+MAX_PART_SIZE = 5 * 2 ** 30
+MAX_PARTS = 10000
+# Aim for this number of parts for a typical file
+TARGET_PARTS = 100
+MAX_CONCURRENCY = 32
+# A histogram is bimodal when the median file and the file holding the median byte are 2 ** BIMODAL_GAP apart
+BIMODAL_GAP = 10
+
+
+class TransferSettings:
+    """ s5cmd parameters of one copy run """
+
+    def __init__(self, numworkers: int, concurrency: int, part_size: int):
+        """
+        Args:
+            numworkers : int
+                files copied in parallel, --numworkers
+            concurrency : int
+                parts of one file copied in parallel, --concurrency of cp
+            part_size : int
+                size of the parts in MB, --part-size of cp
+        """
+        self.numworkers = numworkers
+        self.concurrency = concurrency
+        self.part_size = part_size
+
+    def cp_options(self) -> list:
+        """ Arguments of the cp command """
+        return ['--concurrency', str(self.concurrency), '--part-size', str(self.part_size)]
+
+    def __str__(self) -> str:
+        return f"--numworkers {self.numworkers} --concurrency {self.concurrency} --part-size {self.part_size}MB"
+
+
+def _median_bin(counts: list) -> int:
+    """ Bin that holds the middle of the counts """
+    half = sum(counts) / 2
+    running = 0
+    for size_bin, count in enumerate(counts):
+        running += count
+        if running >= half:
+            return size_bin
+    return 0
+
+
+def typical_size(scan: ScanResult) -> int:
+    """ Average size of the files in the bin that holds the median byte, the size most bytes are copied at """
+    size_bin = _median_bin(scan.histogram_bytes)
+    if scan.histogram[size_bin] == 0:
+        return 0
+    return scan.histogram_bytes[size_bin] // scan.histogram[size_bin]
+
+
+def largest_size(scan: ScanResult) -> int:
+    """ Upper bound of the largest file """
+    for size_bin in range(NUM_BINS - 1, -1, -1):
+        if scan.histogram[size_bin] > 0:
+            return ScanResult.bin_upper_bound(size_bin)
+    return 0
+
+
+def split_threshold(scan: ScanResult):
+    """ Size in bytes that separates the small and the large files of a bimodal histogram, None otherwise
+        Most files are small and most bytes are in large files when the median file is far below the median byte.
+    """
+    if scan.num_files < 2:
+        return None
+    file_bin = _median_bin(scan.histogram)
+    byte_bin = _median_bin(scan.histogram_bytes)
+    if byte_bin - file_bin < BIMODAL_GAP:
+        return None
+    return ScanResult.bin_upper_bound((file_bin + byte_bin) // 2)
+
+
+def tune(scan: ScanResult, max_workers: int, memory: int = None) -> TransferSettings:
+    """ Choose the settings of a copy run
+        Args:
+            scan : ScanResult
+                sizes of the files to copy
+            max_workers : int
+                worker budget of the transfer, see TransferScheduler
+            memory : int
+                MB s5cmd may buffer for the parts, defaults to TUNING_MEMORY or 4096
+        Return:
+            TransferSettings
+    """
+    if memory is None:
+        memory = int(getenv('TUNING_MEMORY', 4096))
+    numworkers = max(min(scan.num_files, max_workers), 1)
+    # The budget left per file goes to its parts
+    concurrency = min(max(max_workers // numworkers, 1), MAX_CONCURRENCY)
+    # The largest file must fit in MAX_PARTS parts
+    min_part_size = max(MIN_PART_SIZE, math.ceil(largest_size(scan) / MAX_PARTS))
+    part_size = max(typical_size(scan) // TARGET_PARTS, min_part_size)
+    # The buffered parts must fit in memory, with smaller parts first and with fewer parts after that
+    part_size = max(min(part_size, memory * MB // (numworkers * concurrency)), min_part_size)
+    part_size = math.ceil(min(part_size, MAX_PART_SIZE) / MB)
+    concurrency = max(min(concurrency, memory // (numworkers * part_size)), 1)
+    return TransferSettings(numworkers, concurrency, part_size)
+
+
+def describe(scan: ScanResult) -> str:
+    """ The numbers the settings are based on, for the logs """
+    return (f"{scan.num_files} files, {size_fmt(scan.total_size)}, typical file {size_fmt(typical_size(scan))}, "
+            f"largest below {size_fmt(largest_size(scan))}")
@@ -0,0 +1,183 @@
+"""Verify a transfer by comparing the ETags of the objects with the local files.
+The ETag of an object uploaded in one part is the md5 of the file, the ETag of a multipart upload
+is the md5 of the md5s of its parts followed by -<number of parts>. The local files are hashed with
+memory mapped reads in a process pool, the objects are taken from one listing per item.
+"""
+import hashlib
+import logging
+import math
+import mmap
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from sync_plan import pair_files
+
+MB = 2 ** 20
+# Files per task of the process pool, small files are not worth a round trip each
+CHUNKSIZE = 16
+# Part sizes in MB of s5cmd (--part-size default) and of the aws cli
+DEFAULT_PART_SIZES = (50, 8)
+
+
+def candidate_part_sizes(size: int, parts: int, part_sizes: tuple = ()) -> list:
+    """ Part sizes in bytes that split a file in the number of parts of its multipart upload
+        The ETag does not tell the part size, so the sizes used by the copy and the defaults are tried
+        before the sizes guessed from the number of parts.
+        Args:
+            size : int
+                size of the file
+            parts : int
+                number of parts of the ETag
+            part_sizes : tuple
+                part sizes in MB the copy used, see TransferSettings
+        Return:
+            list of part sizes, the most likely first
+    """
+    guess = math.ceil(size / parts)
+    candidates = []
+    for part_size in [part_size * MB for part_size in (*part_sizes, *DEFAULT_PART_SIZES)] + \
+            [math.ceil(guess / MB) * MB, guess]:
+        if part_size > 0 and math.ceil(size / part_size) == parts and part_size not in candidates:
+            candidates.append(part_size)
+    return candidates
+
+
+def etag_matches(local_path: str, etag: str, part_sizes: tuple = ()) -> bool:
+    """ Compare a local file with the ETag of its object
+        Args:
+            local_path : str
+                path of the local file
+            etag : str
+                ETag of the object, without quotes
+            part_sizes : tuple
+                part sizes in MB the copy used, see candidate_part_sizes
+        Return:
+            True if the ETag of the file matches for one of the candidate part sizes
+    """
+    size = os.path.getsize(local_path)
+    parts = int(etag.split('-')[1]) if '-' in etag else 0
+    if size == 0:
+        return hashlib.md5(b'').hexdigest() == etag
+    with open(local_path, 'rb') as local_file, \
+            mmap.mmap(local_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        view = memoryview(mapped)
+        try:
+            if parts == 0:
+                return hashlib.md5(view).hexdigest() == etag
+            for part_size in candidate_part_sizes(size, parts, part_sizes):
+                digests = b''.join(hashlib.md5(view[offset:offset + part_size]).digest()
+                                   for offset in range(0, size, part_size))
+                if f"{hashlib.md5(digests).hexdigest()}-{parts}" == etag:
+                    return True
+            return False
+        finally:
+            view.release()
+
+
+def _check_file(task: tuple):
+    """ Process pool task: (local path, ETag, part sizes) -> (local path, matches, error) """
+    local_path, etag, part_sizes = task
+    try:
+        return local_path, etag_matches(local_path, etag, part_sizes), None
+    except OSError as e:
+        return local_path, False, str(e)
+
+
+class VerifyResult:
+    """ Outcome of a verification """
+
+    def __init__(self):
+        self.verified = 0
+        self.verified_bytes = 0
+        # (local path, key, reason) of the files to transfer again
+        self.mismatches = []
+        # Objects of which the ETag is not an md5, e.g. encrypted with SSE-KMS
+        self.unverifiable = 0
+
+    def ok(self) -> bool:
+        return len(self.mismatches) == 0
+
+    def summary(self) -> str:
+        text = f"{self.verified} files verified, {len(self.mismatches)} mismatches"
+        if self.unverifiable > 0:
+            text += f", {self.unverifiable} files could not be verified"
+        return text
+
+
+def verify_transfer(data_operations, updown: str, items: list, max_workers: int = None, progress=None,
+                    part_sizes: tuple = ()) -> VerifyResult:
+    """ Compare the local files of a transfer with their objects
+        Args:
+            data_operations : DataOperation
+                connection to the bucket
+            updown : str
+                upload or download
+            items : list
+                (source_path, destination_path) of the files or folders, see DataTransfer.transfer_batch
+            max_workers : int
+                number of hashing processes, defaults to VERIFY_WORKERS or the number of cpus
+            progress : callable
+                called with a message now and then, optional
+            part_sizes : tuple
+                part sizes in MB the copy used, see candidate_part_sizes
+        Return:
+            VerifyResult
+    """
+    if max_workers is None:
+        max_workers = int(os.getenv('VERIFY_WORKERS', os.cpu_count() or 1))
+    result = VerifyResult()
+    tasks = []
+    keys = {}
+    sizes = {}
+    for local_path, local, key, obj, _ in pair_files(data_operations, updown, items):
+        if updown == 'upload' and not local:
+            # Deleted while copying, see SourceReclaimer
+            continue
+        if not local or obj is None:
+            result.mismatches.append((local_path, key, 'missing'))
+        elif local[0] != obj['Size']:
+            result.mismatches.append((local_path, key, f"size {local[0]} != {obj['Size']}"))
+        else:
+            etag = obj.get('ETag', '').strip('"')
+            md5_part = etag.split('-')[0]
+            if len(md5_part) != 32:
+                result.unverifiable += 1
+                continue
+            tasks.append((local_path, etag, tuple(part_sizes)))
+            keys[local_path] = key
+            sizes[local_path] = obj['Size']
+    if progress is not None:
+        progress(f"Verifying {len(tasks)} files with {max_workers} processes")
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        for local_path, matches, error in executor.map(_check_file, tasks, chunksize=CHUNKSIZE):
+            if matches:
+                result.verified += 1
+                result.verified_bytes += sizes[local_path]
+            else:
+                result.mismatches.append((local_path, keys[local_path], error or 'ETag mismatch'))
+            if progress is not None and (result.verified + len(result.mismatches)) % 10000 == 0:
+                progress(f"Verified {result.verified} files")
+    logging.info("Verification: {}".format(result.summary()))
+    return result
+
+
+if __name__ == "__main__":
+    # Self check: multipart ETags of sizes that are no round multiple of the part size
+    from tempfile import TemporaryDirectory
+    with TemporaryDirectory() as folder:
+        for size, part_size in ((1010 * MB, 50), (1010 * MB + 12345, 50), (12 * MB + 123, 5), (123, 8)):
+            local_path = os.path.join(folder, f"{size}.bin")
+            with open(local_path, 'wb') as local_file:
+                local_file.write(os.urandom(MB))
+                local_file.truncate(size)
+            with open(local_path, 'rb') as local_file:
+                data = local_file.read()
+            parts = [data[offset:offset + part_size * MB] for offset in range(0, size, part_size * MB)]
+            digests = b''.join(hashlib.md5(part).digest() for part in parts)
+            etag = hashlib.md5(data).hexdigest()
+            if len(parts) > 1:
+                etag = f"{hashlib.md5(digests).hexdigest()}-{len(parts)}"
+            assert etag_matches(local_path, etag), (size, part_size)
+            assert etag_matches(local_path, etag, (part_size,)), (size, part_size)
+            assert not etag_matches(local_path, etag.replace(etag[0], 'f' if etag[0] != 'f' else '0', 1))
+            print(f"{size} bytes in parts of {part_size} MB: {etag} matches")
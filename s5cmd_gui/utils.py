@@ -39,6 +39,22 @@ def make_folder(parent: str, foldername: str):
         folder.mkdir(parents=True)
 
 
+def size_fmt(num: int):
+    """ For vizualisation it is nicer to show the value in a bigger unit than bytes
+        Args:
+            num: int
+                size in bytes
+        Return:
+            str
+                size unit
+    """
+    for unit in ("", "KB", "MB", "GB", "TB", "PB"):
+        if abs(num) < 2**10:
+            return f"{num:3.1f} {unit}"
+        num /= 2**10
+    return "Not implemented"
+
+
 def get_logfolder():
     """ Loads a config.json and returns the content """
     cfd = Path(__file__).resolve().parent
@@ -48,6 +64,15 @@ def get_logfolder():
     return log_path
 
 
+def get_cachefolder():
+    """ Returns the folder for the local caches, it is created if needed """
+    cfd = Path(__file__).resolve().parent
+    cache_path = cfd.joinpath("cache")
+    if not cache_path.exists():
+        cache_path.mkdir(parents=True)
+    return cache_path
+
+
 def setup_logger():
     """ Create logger, it is important to note that prints are not written to the logfile! """
     log_file = get_logfolder()